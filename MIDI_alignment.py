@@ -0,0 +1,152 @@
+import functools
+import math
+import numpy as np
+import MIDI_properties as mp
+import profiling as prof
+
+'''
+rhythm-aware, tempo tolerant alignment of a query against a collection track
+every window of the collection is aligned to the query with dynamic time warping (DTW), so a query with an extra or
+a missing note (ex: hummed or played by ear) still matches. warping is limited to a Sakoe-Chiba band of band notes and
+the window is allowed to end up to band notes early or late.
+the cost of aligning two notes is the squared semitone distance (as in sequence_distance) plus DURATION_WEIGHT times the
+squared log2 ratio of their durations. durations are compared relative to the window: the mean log2 duration
+difference between the query and the window's notes is taken out first, so the same tune played at another tempo
+costs nothing extra, wherever it is in the track and whatever the rest of the track is like.
+windows are aligned DTW_CHUNK cells at a time: the semitone costs of a chunk of windows are one (query notes,
+chunk + window) matrix, and every DTW row is computed for all the windows of the chunk at once (cell j of a row is a
+slice of the matrix). a window is dropped as soon as the cheapest cell of its row is over the limit, which is the lowest of the limit
+given, the best total so far and the cost of the diagonal path (every query note on its own note) of the chunk's
+windows, an upper bound of their DTW totals
+'''
+DEFAULT_BAND = 2
+DURATION_WEIGHT = 4.0
+# shortest duration used when taking the log (durations are rounded to 3 places, so some are 0)
+MIN_DURATION = 0.001
+# max number of cells (query notes x windows) aligned at once
+DTW_CHUNK = 1 << 18
+# number of rows aligned between checks for windows over the limit
+ABANDON_ROWS = 4
+
+
+# log2 of every duration
+def log_durations(durations: 'np.ndarray') -> 'np.ndarray':
+    return np.log2(np.maximum(np.asarray(durations, dtype=np.float64), MIN_DURATION))
+
+# (len(qp), len(cp)) matrix of the semitone cost of aligning every query note with every collection note
+def pitch_costs(qp, cp) -> 'np.ndarray':
+    return mp.SEMITONE_SQUARES[(np.asarray(cp, dtype=np.int16)[None, :] - np.asarray(qp, dtype=np.int16)[:, None]) % 12]
+
+# tempo shift of every window (starting at every note of cd): mean log2 duration of the query minus the mean of the
+# window's first len(qd) notes (fewer at the end of the track)
+def window_shifts(qd: 'np.ndarray', cd: 'np.ndarray') -> 'np.ndarray':
+    sums = np.concatenate(([0.0], np.cumsum(cd)))
+    starts = np.arange(len(cd))
+    ends = np.minimum(starts + len(qd), len(cd))
+    return np.mean(qd) - (sums[ends] - sums[starts]) / (ends - starts)
+
+'''
+DTW totals of n_windows consecutive windows of len(query) + band notes, cell(i, j, windows) being the costs of aligning
+query note i with note j of the windows (all of them if windows is None, else an array of window numbers).
+the query's first note is on the window's first note, warping is limited to band notes and the end is free within band
+notes of the query's last note. returns (totals, number of collection notes in each match), a window whose every path
+in a row costs more than limit gets inf
+'''
+def dtw_windows(cell, m: 'int', n_windows: 'int', band: 'int', limit=float('inf')) -> 'tuple':
+    width = m + band
+    # windows still aligned, None while it's all of them (so cells are slices, not gathers)
+    alive = None
+    prev = {}
+    for i in range(m):
+        row = {}
+        for j in range(max(0, i - band), min(width, i + band + 1)):
+            costs = cell(i, j, alive)
+            if i == 0:
+                row[j] = costs + row[j - 1] if j > 0 else costs
+                continue
+            # the same cells the scalar recurrence takes the min of (cells outside the band are inf)
+            best_prev = prev.get(j)
+            for other in ([prev.get(j - 1), row.get(j - 1)] if j > 0 else []):
+                if other is not None:
+                    best_prev = other if best_prev is None else np.minimum(best_prev, other)
+            row[j] = costs + best_prev
+        prev = row
+        if limit < float('inf') and (i + 1) % ABANDON_ROWS == 0 and i + 1 < m:
+            keep = functools.reduce(np.minimum, row.values()) <= limit
+            if not keep.all():
+                alive = np.flatnonzero(keep) if alive is None else alive[keep]
+                prev = {j: cells[keep] for j, cells in prev.items()}
+                if len(alive) == 0:
+                    return np.full(n_windows, np.inf), np.zeros(n_windows, dtype=np.int64)
+
+    first_end = max(0, m - 1 - band)
+    ends = np.stack([prev[j] for j in range(first_end, min(width, m + band))])
+    end = np.argmin(ends, axis=0)
+    totals, lengths = np.full(n_windows, np.inf), np.zeros(n_windows, dtype=np.int64)
+    windows = slice(None) if alive is None else alive
+    totals[windows] = ends[end, np.arange(ends.shape[1])]
+    lengths[windows] = first_end + end + 1
+    totals[totals > limit] = np.inf
+    return totals, lengths
+
+'''
+best DTW window of query pitch classes/log2 durations (qp, qd) in a collection track (cp, cd),
+returns (total, offset, length of the matched window), the first offset wins ties. (inf, -1, 0) if the collection is
+too short or nothing is under limit
+'''
+def best_dtw_window(qp, qd, cp, cd, band=DEFAULT_BAND, limit=float('inf'), duration_weight=DURATION_WEIGHT) -> 'tuple':
+    m = len(qp)
+    n_windows = len(cp) - max(m - band, 1) + 1
+    if m == 0 or n_windows <= 0:
+        return (0.0, 0, 0) if m == 0 else (float('inf'), -1, 0)
+
+    qd, cd = np.asarray(qd, dtype=np.float64), np.asarray(cd, dtype=np.float64)
+    shifts = window_shifts(qd, cd)
+    width = m + band
+    chunk = max(1, DTW_CHUNK // m)
+    best, best_offset, best_length = float('inf'), -1, 0
+    for start in range(0, n_windows, chunk):
+        count = min(chunk, n_windows - start)
+        end = min(len(cp), start + count + width - 1)
+        # notes past the end of the track cost inf
+        pitches = np.full((m, count + width - 1), np.inf)
+        pitches[:, :end - start] = pitch_costs(qp, cp[start:end])
+        durations = np.zeros(count + width - 1)
+        durations[:end - start] = cd[start:end]
+        chunk_shifts = shifts[start:start + count]
+
+        def cell(i, j, windows):
+            if windows is None:
+                notes, window_shift = slice(j, j + count), chunk_shifts
+            else:
+                notes, window_shift = windows + j, chunk_shifts[windows]
+            return pitches[i, notes] + duration_weight * (qd[i] - durations[notes] - window_shift)**2
+
+        # cost of the diagonal path of every window (inf if the window is shorter than the query)
+        diagonal = sum(cell(i, i, None) for i in range(m))
+        prof.count('dtw windows', count)
+        totals, lengths = dtw_windows(cell, m, count, band, min(limit, best, float(diagonal.min())))
+        k = int(np.argmin(totals))
+        if totals[k] < best:
+            best, best_offset, best_length = float(totals[k]), start + k, int(lengths[k])
+
+    if best_offset < 0 or best > limit:
+        return float('inf'), -1, 0
+    return best, best_offset, best_length
+
+'''
+DTW version of mp.sequence_distance: finds the distance an array of query notes (qn) is from a collection (cn),
+returns the closest sequence (which can be up to band notes longer or shorter than the query) and the distance
+'''
+def sequence_distance_dtw(qn: "list['mp.Note']", cn: "list['mp.Note']", band=DEFAULT_BAND,
+                          duration_weight=DURATION_WEIGHT) -> tuple['float', 'list']:
+    total, offset, length = best_dtw_window(mp.pitch_classes(qn), log_durations(mp.note_durations(qn)),
+                                            mp.pitch_classes(cn), log_durations(mp.note_durations(cn)),
+                                            band, duration_weight=duration_weight)
+    return round(math.sqrt(total), 3), list(cn[offset:offset + length]) if offset >= 0 else []
+
+# DTW distance between two tracks (NoteArrays, unrounded), inf if it is over limit (a sum of squares, see mp.pair_limit)
+def track_distance_dtw(query: 'mp.NoteArray', collection: 'mp.NoteArray', band=DEFAULT_BAND, limit=None) -> 'float':
+    total = best_dtw_window(query.pitches % 12, log_durations(query.durations), collection.pitches % 12,
+                            log_durations(collection.durations), band, float('inf') if limit is None else limit)[0]
+    return math.sqrt(total)
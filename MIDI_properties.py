@@ -1,6 +1,11 @@
-import pretty_midi as pm
+import numpy as np
+import heapq
 import math
 from dataclasses import dataclass
+from functools import lru_cache
+import profiling as prof
+
+# pretty_midi is only imported inside the functions that need it (see pretty_midi()), so importing this module is cheap
 
 '''
 Note class:
@@ -19,33 +24,114 @@ class Note:
 # stores distances from C to each base note, for example, it takes 2 'steps' to go from C to D
 NOTE_VALUES = {'C': 0, 'D': 2, 'E': 4, 'F': 5, 'G': 7, 'A': 9, 'B': 11}
 
-# collection and query files used for testing
-COLLECTION_TEST = pm.PrettyMIDI("GF_Theme.mid")
-QUERY_TEST = pm.PrettyMIDI("UT_Determination.mid")
+# squared semitone_distance for every difference in pitch class (mod 12)
+SEMITONE_SQUARES = np.array([min(d, 12 - d)**2 for d in range(12)], dtype=np.int64)
+# max number of notes compared per chunk of windows in window_distances
+WINDOW_CHUNK = 1 << 20
+# number of query notes scored between early abandoning checks in window_distances
+ABANDON_BLOCK = 8
+
+# (note, accidental, octave) for every MIDI pitch number, named the way pm.note_number_to_name does (sharps only)
+SHARP_NAMES = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
+PITCH_NAMES = [(SHARP_NAMES[p % 12][0], SHARP_NAMES[p % 12][1:], p // 12 - 1) for p in range(128)]
+
+
+'''
+NoteArray class: the notes of one instrument as arrays (structure of arrays) instead of one Note per note, it is also
+what the feature store saves for every instrument (see MIDI_store.py)
+    pitches: MIDI pitch number of every note (uint8)
+    starts: start time in seconds of every note (float32)
+    durations: seconds (to 3 places) of every note (float32)
+    program: MIDI program number of the instrument
+    is_drum: True if the instrument is a drum track
+    pitch_classes: pitch % 12, C being 0 (uint8)
+    octaves: octave of every note, as in pm.note_number_to_name (int8)
+the arrays can be views into the memory-mapped store, pitch_classes and octaves are only computed when they're read.
+it can be used like the list of Notes notes_details used to build: indexing gives a Note (made when it's asked for),
+slicing gives a NoteArray and iterating gives every Note in order
+'''
+class NoteArray:
+    def __init__(self, pitches: 'np.ndarray', starts: 'np.ndarray', durations: 'np.ndarray', program=0, is_drum=False):
+        self.pitches = np.asarray(pitches, dtype=np.uint8)
+        self.starts = np.asarray(starts, dtype=np.float32)
+        self.durations = np.asarray(durations, dtype=np.float32)
+        self.program = program
+        self.is_drum = is_drum
+
+    # bulk converts the notes of a pm.Instrument
+    @classmethod
+    def from_instrument(cls, instrument: 'pm.Instrument') -> 'NoteArray':
+        n = len(instrument.notes)
+        pitches = np.fromiter((note.pitch for note in instrument.notes), dtype=np.uint8, count=n)
+        starts = np.fromiter((note.start for note in instrument.notes), dtype=np.float64, count=n)
+        ends = np.fromiter((note.end for note in instrument.notes), dtype=np.float64, count=n)
+        prof.count('notes converted', n)
+        return cls(pitches, starts, np.round(ends - starts, 3), int(instrument.program), bool(instrument.is_drum))
+
+    @property
+    def pitch_classes(self) -> 'np.ndarray':
+        return self.pitches % 12
+
+    @property
+    def octaves(self) -> 'np.ndarray':
+        return (self.pitches // 12).astype(np.int8) - 1
+
+    def __len__(self) -> 'int':
+        return len(self.pitches)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return NoteArray(self.pitches[i], self.starts[i], self.durations[i], self.program, self.is_drum)
+        p = int(self.pitches[i])
+        return Note(*PITCH_NAMES[p], round(float(self.durations[i]), 3))
+
+    def __iter__(self):
+        for p, d in zip(self.pitches.tolist(), self.durations.tolist()):
+            yield Note(*PITCH_NAMES[p], round(d, 3))
+
+    def __repr__(self) -> 'str':
+        return f'NoteArray({len(self)} notes)'
+
+
+# the pretty_midi module, imported the first time it's needed
+def pretty_midi():
+    import pretty_midi
+    return pretty_midi
+
+# collection and query files used for testing, parsed the first time they're used
+@lru_cache(maxsize=None)
+def collection_test() -> 'pm.PrettyMIDI':
+    return pretty_midi().PrettyMIDI("GF_Theme.mid")
+
+@lru_cache(maxsize=None)
+def query_test() -> 'pm.PrettyMIDI':
+    return pretty_midi().PrettyMIDI("UT_Determination.mid")
 
 
 #####################
 
 
 '''
-adds every note in a given MIDI file to an array by using a dataclass, saves the note, accidental (if it exists), octave, and duration
+returns every note of the given instrument as a NoteArray (note, accidental (if it exists), octave and duration of each
+note can still be read as a Note). if a list is given, the Notes are added to it instead and it is returned
 '''
-def notes_details(instrument: 'pm.Instrument', collection_added: 'list'):
-    for note in instrument.notes:
-        curr_note = list(pm.note_number_to_name(note.pitch))
-        collection_added.append(Note(curr_note[0], curr_note[1] if len(curr_note) == 3 else '',     # pitch, accidental
-                                    int(curr_note[2] if len(curr_note) == 3 else curr_note[1]),     # octave
-                                        round(float(note.end - note.start), 3)))                    # duration
+@prof.timed('notes_details')
+def notes_details(instrument: 'pm.Instrument', collection_added=None):
+    notes = NoteArray.from_instrument(instrument)
+    if collection_added is None:
+        return notes
+    collection_added.extend(notes)
     return collection_added
 
 '''
 populates a dictionary with notes, stored according to each instrument in the given MIDI file
-ex: {['Lead 1 (square)']: [Note('G', '', 2, 1.2), Note('A', '', 2, 1.4))]}
+ex: {['Lead 1 (square)']: NoteArray([Note('G', '', 2, 1.2), Note('A', '', 2, 1.4))])}
 '''
 def generate_note_dict(midi_file: 'pm.PrettyMIDI') -> 'dict':
+    pm = pretty_midi()
     midi_dict = {}
     for instrument in midi_file.instruments:
-        midi_dict[pm.program_to_instrument_name(instrument.program)] = notes_details(instrument, [])
+        midi_dict[pm.program_to_instrument_name(instrument.program)] = notes_details(instrument)
     
     return midi_dict
 
@@ -53,33 +139,103 @@ def generate_note_dict(midi_file: 'pm.PrettyMIDI') -> 'dict':
 def tempo_difference(query_file: 'pm.PrettyMIDI', collection_file: 'pm.PrettyMIDI') -> float:
     return abs(query_file.estimate_tempo() - collection_file.estimate_tempo())
 
+# word overlap between the names of two MIDI programs, divided by the total number of distinct words (1 being the highest)
+def program_similarity(p1: 'int', p2: 'int') -> 'float':
+    pm = pretty_midi()
+    p1_name = pm.program_to_instrument_name(p1)
+    p2_name = pm.program_to_instrument_name(p2)
+    overlap = set(p1_name.split()) & set(p2_name.split())
+    return len(overlap) / (len(p1_name.split()) + len(p2_name.split()) - len(overlap))
+
+# number of General MIDI programs, drum tracks get their own row/column after them in PROGRAM_SIMILARITY
+N_PROGRAMS = 128
+DRUM_PROGRAM = N_PROGRAMS
+
 '''
-the total instrumment similarity is calculated based on how much overlap there is between instruments names (by chars)
-this is then normalized by dividing the total length, the higher this value, the more similar the instrument names are, 1 being the highest.
-instrument_similarity returns a dictionary with each similarity vlaue and the instruments assigned to those values
+(129, 129) matrix of program_similarity between every pair of General MIDI programs, computed once on first use.
+the last row/column is drum tracks (whatever their program number is), which are only similar to other drum tracks
 '''
-def instrument_similarity(query_instrmts: 'pm.PrettyMIDI', collection_instrmts: 'pm.PrettyMIDI'):
-    j = 0
-    max_sim = 0
-    similarities = {}
+@lru_cache(maxsize=None)
+def program_similarity_matrix() -> 'np.ndarray':
+    matrix = np.zeros((N_PROGRAMS + 1, N_PROGRAMS + 1))
+    for p1 in range(N_PROGRAMS):
+        for p2 in range(p1, N_PROGRAMS):
+            matrix[p1, p2] = matrix[p2, p1] = program_similarity(p1, p2)
+    matrix[DRUM_PROGRAM, DRUM_PROGRAM] = 1.0
+    matrix.setflags(write=False)
+    return matrix
 
-    qi = query_instrmts.instruments
-    ci = collection_instrmts.instruments
-    min_instrument = qi if len(qi) < len(ci) else ci
-    max_instrument = ci if len(qi) < len(ci) else qi
+# row of PROGRAM_SIMILARITY for an instrument (its program, or DRUM_PROGRAM for drum tracks)
+def similarity_row(program: 'int', is_drum: 'bool') -> 'int':
+    return DRUM_PROGRAM if is_drum else program
+
+'''
+optimal assignment (Hungarian algorithm, shortest augmenting paths) of the rows of a score matrix to its columns,
+maximizing the total score. every row is paired if there are at least as many columns (and the other way around),
+returns a list of (row, column) pairs sorted by row. the inner loop is vectorized over the columns
+'''
+def optimal_assignment(scores: 'np.ndarray') -> "list['tuple']":
+    scores = np.asarray(scores, dtype=np.float64)
+    if scores.shape[0] > scores.shape[1]:
+        return sorted((r, c) for c, r in optimal_assignment(scores.T))
+    n, m = scores.shape
+    if n == 0:
+        return []
 
-    for i in range(len(min_instrument)):
-        qi_name = pm.program_to_instrument_name(min_instrument[i].program)
-        ci_name = pm.program_to_instrument_name(max_instrument[j].program)
-        overlap = set((qi_name).split()) & set(ci_name.split())
-        tot_sim = len(overlap) / (len(qi_name.split()) + len(ci_name.split()) - len(overlap))
+    cost = scores.max() - scores
+    u = np.zeros(n + 1)
+    v = np.zeros(m + 1)
+    # row_of[j] is the (1 based) row assigned to column j (0 if none), column 0 is the row being added
+    row_of = np.zeros(m + 1, dtype=np.int64)
+    way = np.zeros(m + 1, dtype=np.int64)
+    for i in range(1, n + 1):
+        row_of[0] = i
+        j0 = 0
+        min_v = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, dtype=np.bool_)
+        while True:
+            used[j0] = True
+            i0 = row_of[j0]
+            reduced = cost[i0 - 1] - u[i0] - v[1:]
+            better = ~used[1:] & (reduced < min_v[1:])
+            min_v[1:][better] = reduced[better]
+            way[1:][better] = j0
+            j1 = int(np.argmin(np.where(used[1:], np.inf, min_v[1:]))) + 1
+            delta = min_v[j1]
+            u[row_of[used]] += delta
+            v[used] -= delta
+            min_v[~used] -= delta
+            j0 = j1
+            if row_of[j0] == 0:
+                break
+        while j0:
+            j1 = way[j0]
+            row_of[j0] = row_of[j1]
+            j0 = j1
 
-        if tot_sim > max_sim:
-            max_sim = tot_sim
-            similarities[max_sim] = [min_instrument[i], max_instrument[j]]
-            j += 1
+    return sorted((int(row_of[j]) - 1, j - 1) for j in range(1, m + 1) if row_of[j])
 
-    return dict(sorted(similarities.items(), key=lambda item: item[1]))
+'''
+pairs query instruments with collection instruments by program name similarity (see program_similarity_matrix),
+with the one to one pairing that has the highest total similarity. instruments are given as PROGRAM_SIMILARITY rows
+(see similarity_row), returns a list of (similarity, query index, collection index) sorted by query index.
+every instrument of the smaller side is paired, even with a dissimilar instrument (a tune can be played on anything)
+'''
+@prof.timed('instrument_pairing')
+def instrument_pairs(query_rows: "list['int']", collection_rows: "list['int']") -> "list['tuple']":
+    scores = program_similarity_matrix()[np.ix_(np.asarray(query_rows, dtype=np.int64),
+                                                np.asarray(collection_rows, dtype=np.int64))]
+    return [(float(scores[q, c]), q, c) for q, c in optimal_assignment(scores)]
+
+'''
+pm.PrettyMIDI version of instrument_pairs, returns a list of (similarity, query instrument, collection instrument)
+'''
+def instrument_similarity(query_instrmts: 'pm.PrettyMIDI', collection_instrmts: 'pm.PrettyMIDI'):
+    qi = query_instrmts.instruments
+    ci = collection_instrmts.instruments
+    pairs = instrument_pairs([similarity_row(i.program, i.is_drum) for i in qi],
+                             [similarity_row(i.program, i.is_drum) for i in ci])
+    return [(sim, qi[q], ci[c]) for sim, q, c in pairs]
 
 '''
 finds the distance between two notes based on:
@@ -94,73 +250,220 @@ def semitone_distance(n1: 'Note', n2: 'Note') -> 'int':
     
     return min((n2_val - n1_val) % 12, (n1_val - n2_val) % 12)
 
+# pitch class (0-11, C being 0) of a Note, the same integer value semitone_distance compares
+def note_pitch_class(n: 'Note') -> 'int':
+    return (NOTE_VALUES[n.note] + (1 if n.accidental == '#' else -1 if n.accidental == 'b' else 0)) % 12
+
+# pitch classes of a list of Notes (or a NoteArray) as an integer array
+def pitch_classes(notes: "list['Note']") -> 'np.ndarray':
+    if isinstance(notes, NoteArray):
+        return notes.pitch_classes.astype(np.int16)
+    return np.fromiter((note_pitch_class(n) for n in notes), dtype=np.int16, count=len(notes))
+
+# durations of a list of Notes (or a NoteArray) as an array
+def note_durations(notes: "list['Note']") -> 'np.ndarray':
+    if isinstance(notes, NoteArray):
+        return np.round(notes.durations.astype(np.float64), 3)
+    return np.array([n.duration for n in notes], dtype=np.float64)
+
+'''
+scores every alignment of the query pitch classes (qp) against the collection pitch classes (cp) at once,
+returns the sum of squared semitone distances of every window (offset in cp).
+windows are read through a strided view of cp, a chunk of offsets at a time so long pieces don't need a
+len(cp) x len(qp) matrix in memory.
+if a limit is given, windows are scored ABANDON_BLOCK query notes at a time and a window is dropped as soon as its partial
+sum is over the limit, the partial sum (> limit) is returned for dropped windows, only totals <= limit are exact
+'''
+def window_distances(qp: 'np.ndarray', cp: 'np.ndarray', limit=None) -> 'np.ndarray':
+    qp = np.asarray(qp, dtype=np.int16)
+    cp = np.asarray(cp, dtype=np.int16)
+    n_windows = len(cp) - len(qp) + 1
+    if n_windows <= 0:
+        return np.zeros(0, dtype=np.int64)
+    prof.count('windows scored', n_windows)
+    if len(qp) == 0:
+        return np.zeros(n_windows, dtype=np.int64)
+
+    windows = np.lib.stride_tricks.sliding_window_view(cp, len(qp))
+    totals = np.zeros(n_windows, dtype=np.int64)
+    chunk = max(1, WINDOW_CHUNK // len(qp))
+    for start in range(0, n_windows, chunk):
+        curr_windows = windows[start:start + chunk]
+        if limit is None:
+            totals[start:start + chunk] = SEMITONE_SQUARES[(curr_windows - qp) % 12].sum(axis=1)
+            continue
+
+        partial = totals[start:start + chunk]
+        alive = np.arange(len(curr_windows))
+        for k in range(0, len(qp), ABANDON_BLOCK):
+            partial[alive] += SEMITONE_SQUARES[(curr_windows[alive, k:k + ABANDON_BLOCK] - qp[k:k + ABANDON_BLOCK]) % 12].sum(axis=1)
+            alive = alive[partial[alive] <= limit]
+            if len(alive) == 0:
+                break
+    return totals
+
+# (distance, offset) of the closest window (the first offset wins ties), (inf, -1) if the query is longer than the collection
+def best_window(qp: 'np.ndarray', cp: 'np.ndarray', limit=None) -> 'tuple':
+    totals = window_distances(qp, cp, limit)
+    if len(totals) == 0:
+        return float('inf'), -1
+    offset = int(np.argmin(totals))
+    return math.sqrt(totals[offset]), offset
+
 '''
 finds the distance an array of query notes (qn) is from a collection (cn),
 returns the closest sequence and the standardized euclidian distance
 qn or cn comes from the dict from generate_note_dict for any given instrument (key)
 '''
+@prof.timed('sequence_distance')
 def sequence_distance(qn: "list['Note']", cn: "list['Note']") -> tuple['float', 'list']:
-    min_weight = float('inf')
-    best_match = []
-
-    for c in range(len(cn) - len(qn) + 1):
-        total_dist = 0
-        curr_match = []
-        for q in range(len(qn)):
-            note_dist = semitone_distance(cn[c + q], qn[q])
-            total_dist += note_dist**2
-            curr_match.append(cn[c + q])
-
-        if min_weight > math.sqrt(total_dist):
-            min_weight = math.sqrt(total_dist)
-            best_match = curr_match
-
+    min_weight, offset = best_window(pitch_classes(qn), pitch_classes(cn))
+    best_match = list(cn[offset:offset + len(qn)]) if offset >= 0 else []
     return round(min_weight, 3), best_match
 
 '''
-given a query and collection MIDI objects, creates an instrument similarity dict with each set of similar
-instruments, then iterating through and calculating the semitone sequence distance between each pair.
+given a query and collection MIDI objects, pairs up their instruments (see instrument_similarity),
+then iterating through and calculating the semitone sequence distance between each pair.
 This value is then squared, added to a total, the square root of this total is then the final returned val
 '''
 def rank_instruments(query: 'pm.PrettyMIDI', collection: 'pm.PrettyMIDI'):
     instrument_total = 0
-    instrmt_similarity = instrument_similarity(query, collection)
-    for instrmt in instrmt_similarity.keys():
-        query_intrmt = generate_note_dict(query)[
-            pm.program_to_instrument_name(instrmt_similarity[instrmt][0].program)]
-        collection_intrmt = generate_note_dict(collection)[
-            pm.program_to_instrument_name(instrmt_similarity[instrmt][1].program)]
-        instrument_total += math.pow(sequence_distance(query_intrmt, collection_intrmt)[0], 2)
+    for sim, query_intrmt, collection_intrmt in instrument_similarity(query, collection):
+        query_notes = notes_details(query_intrmt)
+        collection_notes = notes_details(collection_intrmt)
+        instrument_total += math.pow(sequence_distance(query_notes, collection_notes)[0], 2)
     return math.sqrt(instrument_total)
 
 '''
 given a query MIDI object and a list of file names from the collection, returns a dictionary for 
 each piece in the collection (as the key) and the instrument similarity value
 '''
-def rank_collection(query: 'pm.PrettyMIDI', total_collection: "list['str']") -> 'dict':
+def rank_collection(query: 'pm.PrettyMIDI', total_collection: "list['str']", store=None, **store_args) -> 'dict':
+    if store is not None:
+        return rank_collection_store(query, total_collection, store, **store_args)
+
+    pm = pretty_midi()
     ranking = {}
     for c in total_collection:
         curr_name = c.split('.')[0]#.split('/')[1]
-        curr_collection = pm.PrettyMIDI(c)
-        ranking[curr_name] = rank_instruments(query, curr_collection)
+        with prof.stage('parse_midi', c):
+            curr_collection = pm.PrettyMIDI(c)
+        with prof.stage('score_piece', c):
+            ranking[curr_name] = rank_instruments(query, curr_collection)
     return ranking
 
 '''
 returns the top r (default value 10) entries in the ranking dictionary where precision (the value) 
 is higher than the given p (default value of 20)
+if a query_cache.QueryCache is given, the ranking is cached until a file of the collection changes
+(a prefilter_report is only filled when the ranking is actually computed)
 '''
-def return_ranking(query: 'pm.PrettyMIDI', total_collection: "list['str']", p=2000, r=10) -> 'dict':
-    return dict((k, v) for k, v in dict(sorted(rank_collection(query, total_collection).items(), 
-                        key=lambda item: item[1])[:r]).items() if v < p)
+def return_ranking(query: 'pm.PrettyMIDI', total_collection: "list['str']", p=2000, r=10, store=None, cache=None,
+                   **store_args) -> 'dict':
+    if cache is not None:
+        import query_cache as qc
+        key = ('return_ranking', qc.midi_fingerprint(midi_tracks(query)), p, r,
+               tuple(sorted((k, v.n if k == 'index' else v) for k, v in store_args.items() if k != 'prefilter_report')))
+        version = cache.version(total_collection)
+        cached = cache.get(key, version)
+        if cached is not None:
+            prof.count('cache hits')
+            return cached
 
+    # the store path only has to score the pieces that can still be in the top r
+    ranking = rank_collection(query, total_collection, store, **(store_args if store is None else {**store_args, 'p': p, 'r': r}))
+    with prof.stage('sort_results'):
+        ranking = dict((k, v) for k, v in dict(sorted(ranking.items(), key=lambda item: item[1])[:r]).items() if v < p)
+    if cache is not None:
+        cache.put(key, version, ranking)
+    return ranking
+
+
+#####################
+# feature store path: the functions below work on NoteArrays (pre-parsed, read from the store) instead of pm objects
 
 
+# bulk converts every instrument in a MIDI file to a NoteArray, in the same order as midi_file.instruments
+def midi_tracks(midi_file: 'pm.PrettyMIDI') -> "list['NoteArray']":
+    return [NoteArray.from_instrument(instrument) for instrument in midi_file.instruments]
+
+'''
+NoteArray version of rank_instruments, gives the same scores as the pm.PrettyMIDI path.
+if a bound is given, the piece is abandoned (returns inf) as soon as it is known to score higher than the bound.
+if a band is given, instruments are aligned with rhythm-aware DTW (see MIDI_alignment.py) instead of the rigid scan
+'''
+def rank_tracks(query_tracks: "list['NoteArray']", collection_tracks: "list['NoteArray']", bound=float('inf'), band=None) -> 'float':
+    if band is not None:
+        import MIDI_alignment as ma
+    instrument_total = 0
+    for sim, q, c in instrument_pairs([similarity_row(t.program, t.is_drum) for t in query_tracks],
+                                      [similarity_row(t.program, t.is_drum) for t in collection_tracks]):
+        query_intrmt, collection_intrmt = query_tracks[q], collection_tracks[c]
+        limit = pair_limit(bound, instrument_total)
+        with prof.stage('sequence_distance'):
+            if band is None:
+                dist = best_window(query_intrmt.pitches % 12, collection_intrmt.pitches % 12, limit)[0]
+            else:
+                dist = ma.track_distance_dtw(query_intrmt, collection_intrmt, band, limit)
+        if limit is not None and dist**2 > limit:
+            return float('inf')
+        instrument_total += math.pow(round(dist, 3), 2)
+    return math.sqrt(instrument_total)
+
+'''
+the largest (unrounded) sum of squares an instrument pair can have without pushing the piece over the bound, given the
+total of the pairs before it. it is padded by 0.001 since distances are rounded to 3 places before being added up
+'''
+def pair_limit(bound: 'float', instrument_total: 'float'):
+    if math.isinf(bound):
+        return None
+    return (math.sqrt(max(bound**2 - instrument_total, 0)) + 0.001)**2
+
+'''
+rank_collection using a MIDI_store.FeatureStore, collection files are only parsed if they are new or have changed
+since they were last ingested, everything else is read from the (memory-mapped) store.
+if an interval_index.IntervalIndex is given, only the candidates it returns for the query are scored
+(max_candidates and min_overlap are passed on to IntervalIndex.candidates), band is passed on to rank_tracks.
+if a prefilter_cutoff is given, pieces whose cached metadata is too far from the query's are dropped first (see
+prefilter.py), the number of pruned pieces is written to prefilter_report (a dict) if one is given.
+if r is given only the top r pieces under p are wanted: the r-th best distance so far is the bound of the next piece
+(see rank_tracks), a piece that can't make it into the top r anymore is abandoned and scores inf
+'''
+def rank_collection_store(query: 'pm.PrettyMIDI', total_collection: "list['str']", store, 
+                          index=None, max_candidates=None, min_overlap=0.0, band=None,
+                          prefilter_cutoff=None, prefilter_report=None, p=float('inf'), r=None) -> 'dict':
+    ranking = {}
+    with prof.stage('ingest'):
+        store.ingest(total_collection)
+    query_tracks = midi_tracks(query)
+    if prefilter_cutoff is not None:
+        import prefilter
+        total_collection, report = prefilter.prefilter(query, total_collection, store, prefilter_cutoff, query_tracks)
+        if prefilter_report is not None:
+            prefilter_report.update(report)
+    if index is not None:
+        candidates = set(index.candidates([t.pitches % 12 for t in query_tracks], max_candidates, min_overlap))
+        total_collection = [c for c in total_collection if c in candidates]
+
+    # max heap (negated) of the r best distances so far
+    top = []
+    for c in total_collection:
+        bound = min(p, -top[0]) if r is not None and 0 < r == len(top) else p
+        with prof.stage('score_piece', c):
+            dist = rank_tracks(query_tracks, store.tracks(c), bound if r is not None else float('inf'), band)
+        ranking[c.split('.')[0]] = dist
+        if r is not None and r > 0 and dist < float('inf'):
+            (heapq.heappush if len(top) < r else heapq.heappushpop)(top, -dist)
+    return ranking
+
 # TESTING
-test_collection_intrmts = [instrument for instrument in COLLECTION_TEST.instruments]
-test_query_intrmts = [instrument for instrument in QUERY_TEST.instruments]
+if __name__ == '__main__':
+    pm = pretty_midi()
+    test_collection_intrmts = [instrument for instrument in collection_test().instruments]
+    test_query_intrmts = [instrument for instrument in query_test().instruments]
 
-print(rank_instruments(pm.PrettyMIDI('Collection/Piece1.mid'), COLLECTION_TEST))
-print(return_ranking(pm.PrettyMIDI('UT_Determination.mid'), ['GF_Theme.mid']))
+    print(rank_instruments(pm.PrettyMIDI('Collection/Piece1.mid'), collection_test()))
+    print(return_ranking(pm.PrettyMIDI('UT_Determination.mid'), ['GF_Theme.mid']))
 #instrmt_similarity = instrument_similarity(QUERY_TEST, COLLECTION_TEST) #FDFFDG vs FDADFD
 #print(generate_note_dict(COLLECTION_TEST)[pm.program_to_instrument_name(instruments[1].program)])
 #print(rank_instruments(QUERY_TEST, COLLECTION_TEST))
@@ -0,0 +1,261 @@
+import numpy as np
+import json
+import os
+import manifest
+import MIDI_properties as mp
+
+'''
+persistent feature store for the MIDI collection
+every file is parsed once, its per-instrument features (program, pitches, note starts/durations) and estimated
+tempo are saved as flat NumPy arrays in STORE_DIR, later runs memory-map these arrays instead of re-parsing the MIDI.
+files are tracked by size, mtime and content hash (see manifest.py), so only added or edited files are parsed again.
+
+the store is made of segments: every ingest writes the files it parsed as one new segment and leaves the others as they
+are, so adding a few pieces to a large collection doesn't rewrite it. the tracks of changed or removed files are left
+in their segment as dead tracks until compact() rewrites every live track into a single segment (done automatically
+once there are more dead notes than live ones)
+
+layout of STORE_DIR:
+    index.json: {'next_segment': id, 'segments': {id: {tracks, notes, dead_notes}},
+                 'files': {file name: {size, mtime, hash, tempo, segment, first track, last track}}}
+    seg{id}_programs.npy / seg{id}_is_drum.npy: one entry per track (instrument)
+    seg{id}_note_offsets.npy: track t's notes are note_offsets[t]:note_offsets[t + 1] in the note arrays
+    seg{id}_pitches.npy / seg{id}_starts.npy / seg{id}_durations.npy: one entry per note, every track back to back
+'''
+STORE_DIR = '.midi_store'
+TRACK_ARRAYS = {'programs': np.int16, 'is_drum': np.bool_}
+NOTE_ARRAYS = {'pitches': np.uint8, 'starts': np.float32, 'durations': np.float32}
+
+
+# number of General MIDI program families (8 programs each: pianos, chromatic percussion, organs, ...), plus drums
+N_FAMILIES = 17
+
+
+# metadata of a piece cached in its index entry for the prefilter stage (see prefilter.py): total number of notes,
+# mean note duration and a histogram of the instrument families (drum tracks count in the last bin)
+def piece_metadata(tracks: "list['mp.NoteArray']") -> 'dict':
+    families = [0] * N_FAMILIES
+    for t in tracks:
+        families[N_FAMILIES - 1 if t.is_drum else t.program // 8] += 1
+    notes = sum(len(t.durations) for t in tracks)
+    total_duration = sum(float(np.sum(t.durations, dtype=np.float64)) for t in tracks)
+    return {'notes': notes, 'mean_duration': total_duration / notes if notes else 0.0, 'families': families}
+
+# estimated tempo of a MIDI file, nan if pretty_midi can't estimate it (less than 2 onsets)
+def safe_tempo(midi_file: 'pm.PrettyMIDI') -> 'float':
+    try:
+        return float(midi_file.estimate_tempo())
+    except ValueError:
+        return float('nan')
+
+
+class FeatureStore:
+    def __init__(self, path=STORE_DIR):
+        self.path = path
+        self.files = {}
+        self.segments = {}
+        self.next_segment = 0
+        self.arrays = {}
+        self.cached_metadata = None
+        # file name: {size, mtime, hash, error} of the files ingest(skip_errors=True) couldn't parse
+        self.errors = {}
+        self.load()
+
+    # reads the index and memory-maps the arrays of every segment (if the store exists)
+    def load(self):
+        index_path = os.path.join(self.path, 'index.json')
+        index = {}
+        if os.path.exists(index_path):
+            with open(index_path, 'r') as index_file:
+                index = json.load(index_file)
+
+        # a store written before segments existed is ignored, it is only a cache and gets rebuilt
+        self.files = index.get('files', {}) if 'segments' in index else {}
+        self.segments = index.get('segments', {})
+        self.next_segment = index.get('next_segment', 0)
+        self.cached_metadata = None
+        self.arrays = {}
+        for seg in self.segments:
+            self.arrays[seg] = {name: np.load(self.segment_path(seg, name), mmap_mode='r')
+                                for name in [*TRACK_ARRAYS, *NOTE_ARRAYS, 'note_offsets']}
+
+    def segment_path(self, seg: 'str', name: 'str') -> 'str':
+        return os.path.join(self.path, f'seg{seg}_{name}.npy')
+
+    # list of the given files that are not in the store yet or whose contents changed since they were ingested
+    def stale(self, total_collection: "list['str']") -> "list['str']":
+        changes = manifest.diff(self.files, total_collection, prune=False)
+        return changes['added'] + changes['changed']
+
+    '''
+    parses every new or changed file in the collection and saves its features in the store as a new segment,
+    returns the list of files that were (re-)parsed. files in the store but not in total_collection are kept.
+    with skip_errors, a file that fails to parse is left out of the store (a changed one is dropped) and recorded in
+    errors instead of raising, it isn't parsed again until it changes
+    '''
+    def ingest(self, total_collection: "list['str']", skip_errors=False) -> "list['str']":
+        changes = manifest.diff(self.files, total_collection, prune=False)
+        stale_files = [c for c in changes['added'] + changes['changed']
+                       if not skip_errors or self.errors.get(c, {}).get('hash') != changes['states'][c]['hash']]
+        touched = [c for c in set(total_collection) - set(changes['added'] + changes['changed'])
+                   if changes['states'][c]['mtime'] != self.files[c]['mtime']]
+        for c in touched:
+            self.files[c].update(changes['states'][c])
+        if not stale_files:
+            if touched:
+                self.save_index()
+            return []
+
+        pm = mp.pretty_midi()
+        tracks = []
+        new_entries = {}
+        for c in stale_files:
+            try:
+                midi_file = pm.PrettyMIDI(c)
+            except Exception as e:
+                if not skip_errors:
+                    raise
+                self.errors[c] = {**changes['states'][c], 'error': f'{type(e).__name__}: {e}'}
+                continue
+            self.errors.pop(c, None)
+            curr_tracks = mp.midi_tracks(midi_file)
+            new_entries[c] = {**changes['states'][c], 'tempo': safe_tempo(midi_file), **piece_metadata(curr_tracks),
+                              'first': len(tracks), 'last': len(tracks) + len(curr_tracks)}
+            tracks.extend(curr_tracks)
+
+        self.drop([c for c in changes['changed'] if c in stale_files])
+        if new_entries:
+            seg = self.write_segment(tracks)
+            for c, entry in new_entries.items():
+                self.files[c] = {**entry, 'segment': seg}
+        self.save_index()
+        self.compact_if_needed()
+        return list(new_entries)
+
+    '''
+    brings the store in line with the collection: removes the files that are no longer in it, then ingests the new
+    and changed ones. returns {'added': [...], 'changed': [...], 'removed': [...]} so derived indexes can be patched.
+    with skip_errors (see ingest) the files that fail to parse are left out, a stored file that fails once edited is removed
+    '''
+    def sync(self, total_collection: "list['str']", skip_errors=False) -> 'dict':
+        changes = manifest.diff(self.files, total_collection, prune=True)
+        self.remove(changes['removed'])
+        for c in changes['removed']:
+            self.errors.pop(c, None)
+        self.ingest(total_collection, skip_errors)
+        return {'added': [c for c in changes['added'] if c in self.files],
+                'changed': [c for c in changes['changed'] if c in self.files],
+                'removed': changes['removed'] + [c for c in changes['changed'] if c not in self.files]}
+
+    # removes files from the store (their tracks become dead until the next compaction)
+    def remove(self, files: "list['str']"):
+        if not files:
+            return
+        self.drop(files)
+        self.save_index()
+        self.compact_if_needed()
+
+    # marks the tracks of files as dead and forgets the files, segments no file points to anymore are deleted
+    def drop(self, files: "list['str']"):
+        for c in files:
+            entry = self.files.pop(c, None)
+            if entry is None:
+                continue
+            offsets = self.arrays[entry['segment']]['note_offsets']
+            self.segments[entry['segment']]['dead_notes'] += int(offsets[entry['last']] - offsets[entry['first']])
+
+        live_segments = set(entry['segment'] for entry in self.files.values())
+        for seg in [s for s in self.segments if s not in live_segments]:
+            del self.segments[seg]
+            del self.arrays[seg]
+            for name in [*TRACK_ARRAYS, *NOTE_ARRAYS, 'note_offsets']:
+                os.remove(self.segment_path(seg, name))
+
+    # writes tracks as a new segment, returns its id
+    def write_segment(self, tracks: "list['mp.NoteArray']") -> 'str':
+        os.makedirs(self.path, exist_ok=True)
+        seg = str(self.next_segment)
+        self.next_segment += 1
+        arrays = {'programs': np.array([t.program for t in tracks], dtype=np.int16),
+                  'is_drum': np.array([t.is_drum for t in tracks], dtype=np.bool_),
+                  'note_offsets': np.cumsum([0] + [len(t.pitches) for t in tracks], dtype=np.int64)}
+        for name, dtype in NOTE_ARRAYS.items():
+            arrays[name] = np.concatenate([getattr(t, name) for t in tracks] + [np.zeros(0, dtype=dtype)]).astype(dtype)
+
+        # arrays are written to a temporary file first so a reader never maps a half written array
+        for name, array in arrays.items():
+            tmp_path = os.path.join(self.path, f'seg{seg}_{name}.tmp.npy')
+            np.save(tmp_path, array)
+            os.replace(tmp_path, self.segment_path(seg, name))
+            arrays[name] = np.load(self.segment_path(seg, name), mmap_mode='r')
+
+        self.arrays[seg] = arrays
+        self.segments[seg] = {'tracks': len(tracks), 'notes': int(arrays['note_offsets'][-1]), 'dead_notes': 0}
+        return seg
+
+    def save_index(self):
+        self.cached_metadata = None
+        os.makedirs(self.path, exist_ok=True)
+        tmp_path = os.path.join(self.path, 'index.tmp.json')
+        with open(tmp_path, 'w') as index:
+            json.dump({'next_segment': self.next_segment, 'segments': self.segments, 'files': self.files}, index)
+        os.replace(tmp_path, os.path.join(self.path, 'index.json'))
+
+    # compacts the store once more than half of its notes belong to dead tracks
+    def compact_if_needed(self):
+        dead = sum(info['dead_notes'] for info in self.segments.values())
+        if dead and dead > sum(info['notes'] for info in self.segments.values()) - dead:
+            self.compact()
+
+    # rewrites every live track into a single new segment and deletes the old segments
+    def compact(self):
+        old_segments = list(self.segments)
+        tracks = []
+        new_entries = {}
+        for c in self.files:
+            new_entries[c] = {**self.files[c], 'first': len(tracks)}
+            tracks.extend(self.tracks(c))
+            new_entries[c]['last'] = len(tracks)
+
+        seg = self.write_segment(tracks)
+        self.files = {c: {**entry, 'segment': seg} for c, entry in new_entries.items()}
+        for old in old_segments:
+            del self.segments[old]
+            del self.arrays[old]
+        self.save_index()
+        for old in old_segments:
+            for name in [*TRACK_ARRAYS, *NOTE_ARRAYS, 'note_offsets']:
+                os.remove(self.segment_path(old, name))
+
+    # the tracks (NoteArrays) of an ingested file, the note arrays are views into the memory-mapped store
+    def tracks(self, file_name: 'str') -> "list['mp.NoteArray']":
+        entry = self.files[file_name]
+        a = self.arrays[entry['segment']]
+        tracks = []
+        for t in range(entry['first'], entry['last']):
+            start, end = a['note_offsets'][t], a['note_offsets'][t + 1]
+            tracks.append(mp.NoteArray(a['pitches'][start:end], a['starts'][start:end], a['durations'][start:end],
+                                       int(a['programs'][t]), bool(a['is_drum'][t])))
+        return tracks
+
+    # estimated tempo of an ingested file
+    def tempo(self, file_name: 'str') -> 'float':
+        return self.files[file_name]['tempo']
+
+    '''
+    metadata of every file in the store as arrays (one row per file), cached until the store changes:
+    {'rows': {file name: row}, 'tempo': (n,), 'notes': (n,), 'mean_duration': (n,), 'families': (n, N_FAMILIES)}
+    '''
+    def metadata(self) -> 'dict':
+        if self.cached_metadata is None:
+            for c, entry in self.files.items():
+                if 'families' not in entry:
+                    entry.update(piece_metadata(self.tracks(c)))
+            files = list(self.files)
+            self.cached_metadata = {'rows': {c: i for i, c in enumerate(files)},
+                                    'tempo': np.array([self.files[c]['tempo'] for c in files], dtype=np.float64),
+                                    'notes': np.array([self.files[c]['notes'] for c in files], dtype=np.int64),
+                                    'mean_duration': np.array([self.files[c]['mean_duration'] for c in files]),
+                                    'families': np.array([self.files[c]['families'] for c in files],
+                                                         dtype=np.float64).reshape(len(files), N_FAMILIES)}
+        return self.cached_metadata
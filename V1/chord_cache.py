@@ -0,0 +1,102 @@
+import json
+import os
+import re
+import manifest
+import V1.chord_similarity as cs
+import V1.note_similarity as ns
+import interval_index as ii
+
+'''
+in memory copy of the text collection (collection/pieceN.txt) that is kept up to date incrementally:
+every piece is stored split into chords (see ns.split_notes) and compiled (see cs.compile_chords), refresh() only
+reads the pieces that were added or edited since the last refresh (see manifest.py) and drops the deleted ones.
+a piece that doesn't compile (a note that isn't in ns.notes_array) is kept uncompiled and its error is listed in errors,
+it is left out of collection() (so it isn't scored) until it is fixed, the rest of the collection is still ranked.
+if a cache path is given the chords and file states are saved there, so the next run starts from them as well
+'''
+PIECE_NAME = re.compile(r'piece(\d+)\.txt$')
+
+
+class ChordCache:
+    def __init__(self, collection_dir='collection', path=None):
+        self.collection_dir = collection_dir
+        self.path = path
+        self.entries = {}
+        self.compiled = {}
+        # file name: error of the pieces that didn't compile
+        self.errors = {}
+        if path is not None and os.path.exists(path):
+            with open(path, 'r') as cache:
+                self.entries = json.load(cache)
+            for f, entry in self.entries.items():
+                self.compile(f, entry['chords'])
+
+    # compiles a piece's chords, None (and the error kept in errors) if one of its notes isn't in ns.notes_array
+    def compile(self, file_name: 'str', chords: 'list'):
+        self.errors.pop(file_name, None)
+        try:
+            self.compiled[file_name] = cs.compile_chords(chords)
+        except ValueError as e:
+            self.errors[file_name] = str(e)
+            self.compiled[file_name] = None
+
+    # file names of the pieces in the collection directory, ordered by piece number
+    def piece_files(self) -> "list['str']":
+        if not os.path.isdir(self.collection_dir):
+            return []
+        names = [f for f in os.listdir(self.collection_dir) if PIECE_NAME.match(f)]
+        return [os.path.join(self.collection_dir, f) for f in sorted(names, key=lambda f: int(PIECE_NAME.match(f)[1]))]
+
+    '''
+    re-reads the added and changed pieces and forgets the removed ones, returns {'added', 'changed', 'removed'}
+    (file names). if an interval_index.IntervalIndex is given it is patched in place (documents are 0 based piece numbers),
+    the pieces it doesn't have yet are added to it as well
+    '''
+    def refresh(self, index=None) -> 'dict':
+        changes = manifest.diff(self.entries, self.piece_files())
+        for f in changes['removed']:
+            del self.entries[f]
+            del self.compiled[f]
+            self.errors.pop(f, None)
+            if index is not None:
+                index.remove(document(f))
+
+        stale = set(changes['added'] + changes['changed'])
+        for f, state in changes['states'].items():
+            if f in stale:
+                with open(f, 'r') as piece:
+                    chords = ns.split_notes(piece.read())
+                self.entries[f] = {**state, 'chords': chords}
+                self.compile(f, chords)
+                if index is not None:
+                    index.add(document(f), [ii.chord_roots(chords)])
+            else:
+                self.entries[f].update(state)
+        # pieces read before the index was given
+        if index is not None:
+            for f, entry in self.entries.items():
+                if document(f) not in index.doc_grams:
+                    index.add(document(f), [ii.chord_roots(entry['chords'])])
+
+        if self.path is not None:
+            self.save()
+        return {'added': changes['added'], 'changed': changes['changed'], 'removed': changes['removed']}
+
+    def save(self):
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as cache:
+            json.dump(self.entries, cache)
+        os.replace(tmp_path, self.path)
+
+    '''
+    (pieces, compiled pieces, piece numbers) in piece number order, the first two as cs.load_collection/compile_collection.
+    the pieces in errors are left out
+    '''
+    def collection(self) -> 'tuple':
+        files = sorted((f for f in self.entries if f not in self.errors), key=document)
+        return [self.entries[f]['chords'] for f in files], [self.compiled[f] for f in files], [document(f) + 1 for f in files]
+
+
+# 0 based piece number of a collection file (collection/piece3.txt -> 2), same as the documents of ii.build_chord_index
+def document(file_name: 'str') -> 'int':
+    return int(PIECE_NAME.search(file_name)[1]) - 1
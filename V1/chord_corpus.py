@@ -0,0 +1,162 @@
+import json
+import os
+import shutil
+import numpy as np
+import manifest
+import V1.chord_similarity as cs
+import V1.note_similarity as ns
+import profiling as prof
+
+'''
+the text collection (collection/pieceN.txt) compiled into one binary corpus, so ranking doesn't open and split every piece
+for every query. a corpus is a directory of
+    chords.npy   every chord of every piece, in piece order: root, shape id (see cs.compile_chords) and the byte range of
+                 its text in text.npy
+    offsets.npy  index of the first chord of every piece in chords.npy (plus the total), piece j is chords[offsets[j]:offsets[j + 1]]
+    text.npy     the pieces' text (utf-8), read back only for the chords a result prints
+    corpus.json  the files, their states (see manifest.py), the shapes the ids refer to and the pieces that failed to compile
+the arrays are memory-mapped, so opening a corpus costs the same whatever the collection size. open_corpus recompiles it
+when a piece was added or edited since.
+path itself is a symlink to the current generation (path.N, a directory), a recompiled corpus is written to a new
+generation and swapped in by replacing the link. a reader resolves the link once, so it always opens the four files of
+a single generation, the generation before the current one is kept for the readers that resolved it just before a swap
+'''
+CORPUS_DIR = '.chord_corpus'
+CHORD_DTYPE = np.dtype([('root', np.int16), ('shape', np.int32), ('start', np.int64), ('end', np.int64)])
+
+
+class ChordCorpus:
+    def __init__(self, path=CORPUS_DIR):
+        # resolved once, a corpus swapped in meanwhile doesn't mix with this one
+        path = os.path.realpath(path)
+        self.path = path
+        with open(os.path.join(path, 'corpus.json'), 'r') as info_file:
+            info = json.load(info_file)
+        self.files = info['files']
+        self.states = info['states']
+        self.errors = {int(j): error for j, error in info['errors'].items()}
+        # the shape ids of another process are mapped to this one's
+        shapes = [tuple(shape) for shape in info['shapes']]
+        cs.register_shapes(shapes)
+        self.shape_map = np.array([cs.shape_ids[shape] for shape in shapes] or [0], dtype=np.int32)
+        self.chords = np.load(os.path.join(path, 'chords.npy'), mmap_mode='r')
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'), mmap_mode='r')
+        self.text = np.load(os.path.join(path, 'text.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.files)
+
+    # True if the corpus was compiled from these files and none of them changed since
+    def fresh(self, files: "list['str']") -> 'bool':
+        if list(files) != self.files:
+            return False
+        changes = manifest.diff(self.states, files, prune=False)
+        return not changes['added'] and not changes['changed']
+
+    # (roots, shape ids) of piece j, as cs.compile_chords gives them
+    def compiled(self, j: 'int') -> 'tuple':
+        if j in self.errors:
+            raise ValueError(self.errors[j])
+        chords = self.chords[self.offsets[j]:self.offsets[j + 1]]
+        return chords['root'], self.shape_map[chords['shape']]
+
+    # chords start to start + length of piece j, as ns.split_notes gives them
+    def chord_text(self, j: 'int', start: 'int', length: 'int') -> 'list':
+        chords = self.chords[self.offsets[j] + start:min(self.offsets[j] + start + length, self.offsets[j + 1])]
+        return [self.text[s:e].tobytes().decode().strip().split(" ") for s, e in zip(chords['start'].tolist(), chords['end'].tolist())]
+
+    # cs.min_chord_weighted of piece j against a query (split and compiled), the chords of the best window are only decoded here
+    @prof.timed('min_chord_weighted')
+    def min_chord_weighted(self, j: 'int', query_sequence: 'list', compiled_query: 'tuple') -> 'tuple':
+        totals = cs.chord_window_distances(self.compiled(j), compiled_query)
+        if len(totals) == 0:
+            return float('inf'), []
+        i = int(np.argmin(totals))
+        return round(float(totals[i]), 3), self.chord_text(j, i, len(query_sequence))
+
+
+'''
+compiles the pieces (in order, piece j of the corpus is files[j]) into a corpus at path. a piece with a note that isn't in
+ns.notes_array is kept empty and its error is raised when it's scored, like reading it would
+'''
+def compile_corpus(files: "list['str']", path=CORPUS_DIR) -> 'ChordCorpus':
+    states = manifest.diff({}, files, prune=False)['states']
+    chords, offsets, text, errors = [], [0], [], {}
+    size = 0
+    for j, f in enumerate(files):
+        with prof.stage('read_piece', f):
+            with open(f, 'r') as piece:
+                piece_text = piece.read()
+        # byte range of every chord (the text between two |), the same chords ns.split_notes gives
+        segments, starts = [], []
+        for segment in piece_text.split("|"):
+            segment = segment.encode()
+            starts.append(size)
+            segments.append(segment)
+            size += len(segment) + 1
+        text.append(piece_text.encode() + b"|")
+        try:
+            roots, shapes = cs.compile_chords(ns.split_notes(piece_text))
+        except ValueError as e:
+            errors[j] = str(e)
+            offsets.append(offsets[-1])
+            continue
+        piece_chords = np.empty(len(roots), dtype=CHORD_DTYPE)
+        piece_chords['root'] = roots
+        piece_chords['shape'] = shapes
+        piece_chords['start'] = starts
+        piece_chords['end'] = [s + len(segment) for s, segment in zip(starts, segments)]
+        chords.append(piece_chords)
+        offsets.append(offsets[-1] + len(roots))
+
+    previous = os.path.realpath(path) if os.path.islink(path) else None
+    if previous is None and os.path.isdir(path):
+        shutil.rmtree(path)
+    generation = int(previous.rsplit('.', 1)[1]) + 1 if previous is not None else 0
+    gen_path = f'{path}.{generation}'
+    shutil.rmtree(gen_path, ignore_errors=True)
+    os.makedirs(gen_path)
+    arrays = {'chords': np.concatenate(chords + [np.zeros(0, dtype=CHORD_DTYPE)]),
+              'offsets': np.array(offsets, dtype=np.int64),
+              'text': np.frombuffer(b''.join(text), dtype=np.uint8)}
+    for name, array in arrays.items():
+        np.save(os.path.join(gen_path, f'{name}.npy'), array)
+    info = {'files': list(files), 'states': states, 'shapes': [list(shape) for shape in cs.chord_shapes], 'errors': errors}
+    with open(os.path.join(gen_path, 'corpus.json'), 'w') as info_file:
+        json.dump(info, info_file)
+
+    # the link is replaced in one rename, readers of the previous generation keep their (already open) mappings
+    if os.path.lexists(f'{path}.tmp'):
+        os.remove(f'{path}.tmp')
+    os.symlink(os.path.basename(gen_path), f'{path}.tmp')
+    os.replace(f'{path}.tmp', path)
+    shutil.rmtree(f'{path}.{generation - 2}', ignore_errors=True)
+    prof.count('pieces compiled', len(files))
+    return ChordCorpus(path)
+
+# the corpus of the first music_f_count pieces of a collection, compiled again if it's missing or out of date
+def open_corpus(music_f_count: 'int', collection_dir="collection", path=CORPUS_DIR) -> 'ChordCorpus':
+    files = [f"{collection_dir}/piece{j + 1}.txt" for j in range(music_f_count)]
+    with prof.stage('load_collection'):
+        if os.path.islink(path) and os.path.exists(os.path.join(path, 'corpus.json')):
+            corpus = ChordCorpus(path)
+            if corpus.fresh(files):
+                return corpus
+        return compile_corpus(files, path)
+
+'''
+the top r pieces (piece number, distance, best chords) under p for a query, the pieces are scored one at a time straight
+from the corpus into a bounded heap (see cs.top_ranked), and only the winners' chords are decoded
+'''
+def rank_corpus(query: 'str', corpus: 'ChordCorpus', p=float('inf'), r=10) -> 'list':
+    query_sequence = ns.split_notes(query)
+    compiled_query = cs.compile_chords(query_sequence)
+
+    def distances():
+        for j in range(len(corpus)):
+            with prof.stage('score_piece', f'{query} (document {j + 1})'):
+                totals = cs.chord_window_distances(corpus.compiled(j), compiled_query)
+            yield j, round(float(totals.min()), 3) if len(totals) else float('inf')
+
+    return [(j + 1, d, corpus.min_chord_weighted(j, query_sequence, compiled_query)[1])
+            for j, _, d in cs.top_ranked(distances(), p, r)]
@@ -1,4 +1,9 @@
+import heapq
+import numpy as np
 import V1.note_similarity as ns
+import interval_index as ii
+import query_cache as qc
+import profiling as prof
 
 # dictionary of the chord progression indexes (compared to notes_array)
 # example: C major would be notes_array[0], notes_array[4], notes_array[7] -> C E G
@@ -64,45 +69,214 @@ def calc_chord_similarity(collection, query_chord, chord_dists):
 def rank_distances(collection_dict):
     return dict(sorted(collection_dict.items(), key=lambda item: item[1]))
 
-def min_chord_weighted(collection, query_sequence):
-    min_weight = float('inf')
-    best_match = []
-
-    for i in range(len(collection) - len(query_sequence) + 1):
-        total_dist = 0
-        curr_match = []
-        for j in range(len(query_sequence)):
-            chord_dists = calc_chord_similarity([collection[j + i]], query_sequence[j], {})
-            total_dist += ns.euclidian_mult_weights(chord_dists)
-            curr_match.append(collection[i + j])
-        
-        if min_weight > total_dist:
-            min_weight = total_dist
-            best_match = curr_match
-
-    return round(min_weight, 3), best_match
-
-def ranking_calc(query_collection, music_f_count):
+# integer chord encoding: a chord is stored as (root, shape), the root is its first note's index in ns.notes_array and the
+# shape is an id in chord_shapes (the determine_chord list of the chord), the chord_prog_diff shapes always come first
+chord_shapes = []
+shape_ids = {}
+# shape_dists[query shape, collection shape] is chord_prog_size of the two shapes, -1 if it can't compare them
+shape_dists = np.zeros((0, 0), dtype=np.int32)
+# chord_weights[root distance (mod 12), shape distance] is the value calc_chord_similarity gives a pair of chords,
+# the last column is nan so incomparable shapes (shape distance -1) give nan
+chord_weights = np.full((12, 1), np.nan)
+
+
+# chord_prog_size of shape against every shape in chord_shapes at once, -1 where the shorter of the two has 1 note
+def shape_row(shape):
+    lens = np.array([len(s) for s in chord_shapes])
+    padded = np.zeros((len(chord_shapes), max(lens.max(), len(shape))), dtype=np.int64)
+    for i, s in enumerate(chord_shapes):
+        padded[i, :len(s)] = s
+    curr = np.zeros(padded.shape[1], dtype=np.int64)
+    curr[:len(shape)] = shape
+
+    short = np.minimum(lens, len(shape))
+    in_short = np.arange(padded.shape[1]) < short[:, None]
+    dists = (np.abs(padded - curr) * in_short).sum(axis=1)
+    # when the lengths differ, the gap between the last two notes of the shorter shape is added
+    shorter = np.where((lens < len(shape))[:, None], padded, curr)
+    last = np.take_along_axis(shorter, (short - 1)[:, None], axis=1)[:, 0]
+    second_last = np.take_along_axis(shorter, np.maximum(short - 2, 0)[:, None], axis=1)[:, 0]
+    differ = lens != len(shape)
+    dists += np.where(differ, last - second_last, 0)
+    return np.where(differ & (short < 2), -1, dists).astype(np.int32)
+
+# adds any new shapes to chord_shapes and extends shape_dists (and chord_weights if needed) to cover them
+def register_shapes(shapes):
+    global shape_dists, chord_weights
+    for shape in shapes:
+        if shape in shape_ids:
+            continue
+        shape_ids[shape] = len(chord_shapes)
+        chord_shapes.append(shape)
+        row = shape_row(shape)
+        dists = np.empty((len(chord_shapes), len(chord_shapes)), dtype=np.int32)
+        dists[:-1, :-1] = shape_dists
+        dists[-1, :] = row
+        dists[:, -1] = row
+        shape_dists = dists
+
+    max_dist = int(shape_dists.max()) if shape_dists.size else 0
+    if max_dist + 1 >= chord_weights.shape[1]:
+        chord_weights = np.array([[round(ns.euclidian_dist(min(d, 12 - d), c), 3) for c in range(2 * max_dist + 2)] + [np.nan]
+                                  for d in range(12)])
+
+register_shapes([tuple(c) for c in chord_prog_diff.values()])
+
+# compiles a list of chords (from ns.split_notes) into (roots, shapes) integer arrays
+def compile_chords(chords):
+    roots = np.empty(len(chords), dtype=np.int16)
+    shapes = []
+    for i, chord in enumerate(chords):
+        notes = [ns.notes_array.index(ns.note_equivalence(n)) for n in chord]
+        roots[i] = notes[0]
+        shape = [0]
+        for k in range(1, len(notes)):
+            shape.append(shape[k - 1] + min((notes[k] - notes[k - 1]) % 12, (notes[k - 1] - notes[k]) % 12))
+        shapes.append(tuple(shape))
+
+    register_shapes(shapes)
+    prof.count('chords compiled', len(chords))
+    return roots, np.array([shape_ids[shape] for shape in shapes], dtype=np.int32)
+
+'''
+total weight of every window (offset) of the compiled collection against the compiled query, scored with one lookup into
+shape_dists and chord_weights per query chord for all windows at once. the query chords are added in order, so the totals are the
+exact same floats the chord by chord loop adds up
+'''
+def chord_window_distances(compiled_collection, compiled_query):
+    c_roots, c_shapes = compiled_collection
+    q_roots, q_shapes = compiled_query
+    n_windows = len(c_roots) - len(q_roots) + 1
+    totals = np.zeros(max(n_windows, 0))
+    prof.count('chord windows scored', max(n_windows, 0))
+    for j in range(len(q_roots) if n_windows > 0 else 0):
+        totals += chord_weights[(c_roots[j:j + n_windows] - q_roots[j]) % 12, shape_dists[q_shapes[j], c_shapes[j:j + n_windows]]]
+    if np.isnan(totals).any():
+        raise IndexError("list index out of range")
+    return totals
+
+# finds the window of the collection with the lowest total chord weight to the query sequence, returns the 
+# (rounded) weight and the chords of that window. compiled_collection can be passed to skip compiling the collection
+@prof.timed('min_chord_weighted')
+def min_chord_weighted(collection, query_sequence, compiled_collection=None):
+    if compiled_collection is None:
+        compiled_collection = compile_chords(collection)
+    totals = chord_window_distances(compiled_collection, compile_chords(query_sequence))
+    if len(totals) == 0:
+        return float('inf'), []
+
+    i = int(np.argmin(totals))
+    return round(float(totals[i]), 3), collection[i:i + len(query_sequence)]
+
+# if an interval_index.IntervalIndex of the collection is given (see interval_index.build_chord_index), 
+# only the candidate pieces it returns for each query are scored.
+# if a query_cache.QueryCache is given, the scores of each query are cached until the collection changes.
+# if a chord_corpus.ChordCorpus is given, the pieces are read from it instead of their text files
+def ranking_calc(query_collection, music_f_count, index=None, max_candidates=None, min_overlap=0.0, cache=None, corpus=None):
     ranking = {}
+    if cache is not None:
+        version = cache.version([f"collection/piece{j + 1}.txt" for j in range(music_f_count)])
     for i in range(len(query_collection)):
-        for j in range(music_f_count):
-            collection_text = ns.split_notes(open(f"collection/piece{j + 1}.txt", "r").read())
+        if cache is not None:
+            key = ('ranking_calc', qc.text_fingerprint(query_collection[i]), music_f_count,
+                   None if index is None else index.n, max_candidates, min_overlap)
+            cached = cache.get(key, version)
+            if cached is not None:
+                prof.count('cache hits')
+                ranking.update(cached)
+                continue
+        query_ranking = {}
+        pieces = range(music_f_count)
+        if index is not None:
+            chord_roots = ii.chord_roots(ns.split_notes(query_collection[i]))
+            pieces = sorted(index.candidates([chord_roots], max_candidates, min_overlap))
+        if corpus is not None and pieces:
+            query_text = ns.split_notes(query_collection[i])
+            compiled_query = compile_chords(query_text)
+        for j in pieces:
+            if corpus is not None:
+                with prof.stage('score_piece', f'query {i + 1}, piece{j + 1}'):
+                    min_dist, best_chords = corpus.min_chord_weighted(j, query_text, compiled_query)
+                query_ranking[' | '.join([' '.join(chord) for chord in best_chords])] = min_dist
+                continue
+            with prof.stage('read_piece'):
+                collection_text = ns.split_notes(open(f"collection/piece{j + 1}.txt", "r").read())
             query_text = ns.split_notes(query_collection[i])
             #print(f"\nQuery {i + 1}, Document {j + 1}")
-            min_dist, best_chords = min_chord_weighted(collection_text, query_text)
-            ranking[' | '.join([' '.join(best_chords[i]) for i in range(len(best_chords))])] = min_dist
+            with prof.stage('score_piece', f'query {i + 1}, piece{j + 1}'):
+                min_dist, best_chords = min_chord_weighted(collection_text, query_text)
+            query_ranking[' | '.join([' '.join(best_chords[i]) for i in range(len(best_chords))])] = min_dist
             #print(f"min dist: {min_dist} \nchords: {' | '.join([' '.join(best_chords[i]) for i in range(len(best_chords))])}")
+        ranking.update(query_ranking)
+        if cache is not None:
+            cache.put(key, version, query_ranking)
     return ranking
 
+# loads every piece of the text collection into memory once, split into chords (see ns.split_notes)
+def load_collection(music_f_count, collection_dir="collection"):
+    collection = []
+    for j in range(music_f_count):
+        with open(f"{collection_dir}/piece{j + 1}.txt", "r") as piece:
+            collection.append(ns.split_notes(piece.read()))
+    return collection
+
+# compiles every loaded piece (see compile_chords) so queries don't recompile them
+def compile_collection(collection):
+    return [compile_chords(piece) for piece in collection]
+
+'''
+scores a single query (string of chords) against every loaded piece, returns (min dist, best chords) per document.
+if a V1.chord_corpus.ChordCorpus is given its pieces are scored instead of collection, a piece that failed to compile
+scores (inf, [])
+'''
+def score_query(query, collection, compiled=None, corpus=None):
+    query_text = ns.split_notes(query)
+    if corpus is not None:
+        compiled_query = compile_chords(query_text)
+        scores = []
+        for j in range(len(corpus)):
+            with prof.stage('score_piece', f'{query} (document {j + 1})'):
+                scores.append((float('inf'), []) if j in corpus.errors else corpus.min_chord_weighted(j, query_text, compiled_query))
+        return scores
+    compiled = compiled or [None] * len(collection)
+    scores = []
+    for j in range(len(collection)):
+        with prof.stage('score_piece', f'{query} (document {j + 1})'):
+            scores.append(min_chord_weighted(collection[j], query_text, compiled[j]))
+    return scores
+
+'''
+top r (position, key, distance) of a stream of (key, distance) pairs under the precision p, closest first.
+a bounded heap keeps the r best seen so far (the worst on top), pairs at or over p are dropped as they come, so
+nothing is sorted but the r results. ties keep stream order
+'''
+def top_ranked(scores, p=5, r=2):
+    heap = []
+    if r <= 0:
+        return []
+    for i, (key, d) in enumerate(scores):
+        if not d < p:
+            continue
+        entry = (-d, -i, key)
+        if len(heap) < r:
+            heapq.heappush(heap, entry)
+        elif entry > heap[0]:
+            heapq.heapreplace(heap, entry)
+    return [(-i, key, -d) for d, i, key in sorted(heap, reverse=True)]
+
+# top r (document index, distance) pairs of a row of the distance matrix under the precision p, ties keep document order
+@prof.timed('sort_results')
+def rank_row(distances, p=5, r=2):
+    return [(j, d) for j, _, d in top_ranked(enumerate(distances), p, r)]
 
+# prints the top r chords of a ranking_calc dict under the precision p (document = position in the dict), returns them as {chords: distance}
 def rank_return(ranking_dict, p=5, r=2):
-    ranked_chords = rank_distances(ranking_dict)
-    ranked_w_indexes = [(list(ranking_dict.keys()).index(key), key, value) for key, value in ranked_chords]
+    with prof.stage('sort_results'):
+        ranked = top_ranked(ranking_dict.items(), p, r)
 
-    for i, c, d in ranked_w_indexes[:r]:
-        if d < p:
-            print(f"Document {i + 1}: \nChord: '{c}', distance: {d}")
-    return ranked_chords
+    for i, c, d in ranked:
+        print(f"Document {i + 1}: \nChord: '{c}', distance: {d}")
+    return {c: d for i, c, d in ranked}
 
 
 # TESTING
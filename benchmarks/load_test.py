@@ -0,0 +1,79 @@
+import argparse
+import asyncio
+import json
+import time
+import numpy as np
+
+'''
+load test for the query service (service.py): replays a JSONL file of requests over concurrent connections and reports
+p50/p99 latency and throughput. lines that are already service requests ("text", "file" or "midi") are sent as they
+are, for any other JSON object the value of --field is sent as a text query (ex: --field body for requests.jsonl)
+run with the service up: python benchmarks/load_test.py queries.jsonl -c 8 --repeat 10 --json report.json
+'''
+
+
+# service requests made from the lines of a JSONL file (lines without a query are skipped)
+def load_requests(path: 'str', field='text') -> "list['dict']":
+    requests = []
+    with open(path, 'r') as lines:
+        for line in lines:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if {'text', 'file', 'midi'} & set(entry):
+                requests.append(entry)
+            elif isinstance(entry.get(field), str):
+                requests.append({'text': entry[field]})
+    return requests
+
+# sends requests one at a time over a single connection, appends (latency, error) for every response
+async def client(requests: "list['dict']", connect, latencies: 'list'):
+    reader, writer = await connect()
+    for request in requests:
+        start = time.perf_counter()
+        writer.write((json.dumps(request) + '\n').encode())
+        await writer.drain()
+        response = json.loads(await reader.readline())
+        latencies.append((time.perf_counter() - start, 'error' in response))
+    writer.close()
+
+'''
+replays the requests (repeat times) over `concurrency` connections, each taking every concurrency-th request,
+returns {'requests', 'errors', 'seconds', 'throughput', 'p50_ms', 'p99_ms'}
+'''
+async def run_load(requests: "list['dict']", socket_path=None, port=None, concurrency=4, repeat=1) -> 'dict':
+    if port is None:
+        connect = lambda: asyncio.open_unix_connection(socket_path)
+    else:
+        connect = lambda: asyncio.open_connection('127.0.0.1', port)
+    requests = [{**request, 'id': i} for i, request in enumerate(requests * repeat)]
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*[client(requests[k::concurrency], connect, latencies) for k in range(concurrency)])
+    seconds = time.perf_counter() - start
+
+    times = np.array([t for t, error in latencies]) * 1000
+    return {'requests': len(latencies), 'errors': sum(error for t, error in latencies), 'seconds': seconds,
+            'throughput': len(latencies) / seconds if seconds else 0.0,
+            'p50_ms': float(np.percentile(times, 50)) if len(times) else 0.0,
+            'p99_ms': float(np.percentile(times, 99)) if len(times) else 0.0}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('requests', help='JSONL file to replay')
+    parser.add_argument('--socket', default='.retrieval.sock')
+    parser.add_argument('--port', type=int)
+    parser.add_argument('--field', default='text', help='field sent as a text query for lines that are not requests')
+    parser.add_argument('-c', '--concurrency', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--json')
+    args = parser.parse_args()
+
+    report = asyncio.run(run_load(load_requests(args.requests, args.field), args.socket, args.port,
+                                  args.concurrency, args.repeat))
+    print(f"{report['requests']} requests ({report['errors']} errors) in {report['seconds']:.2f}s: "
+          f"{report['throughput']:.1f} req/s, p50 {report['p50_ms']:.2f} ms, p99 {report['p99_ms']:.2f} ms")
+    if args.json:
+        with open(args.json, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
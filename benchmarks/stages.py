@@ -0,0 +1,203 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import MIDI_properties as mp
+import MIDI_store as ms
+import V1.chord_similarity as cs
+import V1.note_similarity as ns
+
+'''
+per stage benchmark over seeded synthetic collections
+MIDI and chord text corpora are generated (deterministically, from the seed) for every size and piece length, and cached
+in CORPUS_DIR so later runs only time the retrieval code. every stage is timed on its own and written to a JSON report,
+reports from two commits can be compared with --compare.
+run from anywhere: python benchmarks/stages.py --sizes 10 100 1000 --lengths short long --json report.json
+'''
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpora')
+# (min, max) instruments per piece and notes per instrument for each piece length, chords per text piece
+LENGTHS = {'short': {'instruments': (2, 4), 'notes': (50, 150), 'chords': (5, 15)},
+           'long': {'instruments': (4, 8), 'notes': (1000, 3000), 'chords': (200, 500)}}
+QUERY_NOTES = 20
+QUERY_CHORDS = 4
+
+
+# a random MIDI file with n_instruments instruments (the first one a lead synth, like the test files) of n_notes notes
+def synthetic_midi(rng: 'np.random.Generator', n_instruments: 'int', notes_range: 'tuple') -> 'pm.PrettyMIDI':
+    pm = mp.pretty_midi()
+    midi_file = pm.PrettyMIDI()
+    programs = [80] + rng.integers(0, 128, n_instruments - 1).tolist()
+    for program in programs:
+        n_notes = int(rng.integers(*notes_range))
+        starts = np.cumsum(rng.choice([0.125, 0.25, 0.5], n_notes))
+        pitches = rng.integers(36, 84, n_notes)
+        instrument = pm.Instrument(program=int(program))
+        instrument.notes = [pm.Note(velocity=90, pitch=int(p), start=float(s), end=float(s) + 0.2)
+                            for p, s in zip(pitches, starts)]
+        midi_file.instruments.append(instrument)
+    return midi_file
+
+# a random string of chords (chord_prog_diff shapes on random roots), formatted like collection/pieceN.txt
+def synthetic_chords(rng: 'np.random.Generator', n_chords: 'int') -> 'str':
+    shapes = list(cs.chord_prog_diff.values())
+    chords = []
+    for i in range(n_chords):
+        root = int(rng.integers(12))
+        shape = shapes[int(rng.integers(len(shapes)))]
+        chords.append(' '.join(ns.notes_array[(root + s) % 12] for s in shape))
+    return ' | '.join(chords)
+
+'''
+builds (or reuses) the corpora for a size and length, returns (MIDI file names, text collection dir, MIDI queries,
+text queries). queries are cut out of random pieces so every query has a real match
+'''
+def build_corpus(size: 'int', length: 'str', seed: 'int', n_queries: 'int') -> 'tuple':
+    settings = LENGTHS[length]
+    corpus_dir = os.path.join(CORPUS_DIR, f'{length}_{size}_{seed}')
+    midi_dir = os.path.join(corpus_dir, 'midi')
+    text_dir = os.path.join(corpus_dir, 'text')
+    files = [os.path.join(midi_dir, f'piece{i + 1}.mid') for i in range(size)]
+
+    if not os.path.exists(os.path.join(corpus_dir, 'done')):
+        os.makedirs(midi_dir, exist_ok=True)
+        os.makedirs(text_dir, exist_ok=True)
+        rng = np.random.default_rng(seed)
+        for i in range(size):
+            synthetic_midi(rng, int(rng.integers(*settings['instruments'])), settings['notes']).write(files[i])
+            with open(os.path.join(text_dir, f'piece{i + 1}.txt'), 'w') as piece:
+                piece.write(synthetic_chords(rng, int(rng.integers(*settings['chords']))))
+        open(os.path.join(corpus_dir, 'done'), 'w').close()
+
+    rng = np.random.default_rng(seed + 1)
+    pm = mp.pretty_midi()
+    midi_queries, text_queries = [], []
+    for i in range(n_queries):
+        source = pm.PrettyMIDI(files[int(rng.integers(size))])
+        lead = source.instruments[0]
+        start = int(rng.integers(max(1, len(lead.notes) - QUERY_NOTES)))
+        lead.notes = lead.notes[start:start + QUERY_NOTES]
+        source.instruments = [lead]
+        midi_queries.append(source)
+
+        with open(os.path.join(text_dir, f'piece{int(rng.integers(size)) + 1}.txt')) as piece:
+            chords = piece.read().split(' | ')
+        start = int(rng.integers(max(1, len(chords) - QUERY_CHORDS)))
+        text_queries.append(' | '.join(chords[start:start + QUERY_CHORDS]))
+    return files, text_dir, midi_queries, text_queries
+
+# timing of a stage that took total seconds over count items
+def timing(total: 'float', count: 'int') -> 'dict':
+    return {'total_s': round(total, 6), 'count': count, 'per_item_us': round(total / max(count, 1) * 1e6, 3)}
+
+'''
+runs fn on every item, returns the total time and the time per item (and the results, for the next stage).
+count is the number of items the time is divided by, if it isn't the number of calls (ex: one call over every file)
+'''
+def time_stage(fn, items: 'list', count=None) -> 'tuple':
+    count = len(items) if count is None else count
+    start = time.perf_counter()
+    results = [fn(item) for item in items]
+    return timing(time.perf_counter() - start, count), results
+
+'''
+times the per file MIDI stages (parse, generate_note_dict, instrument_similarity, sequence_distance) one file at a time:
+a file's parsed PrettyMIDI and note dict are freed before the next file is parsed, so memory doesn't grow with the corpus
+'''
+def time_midi_files(files: "list['str']", midi_queries: "list['pm.PrettyMIDI']") -> 'dict':
+    pm = mp.pretty_midi()
+    query_notes = [mp.generate_note_dict(q)[pm.program_to_instrument_name(80)] for q in midi_queries]
+    totals = {'parse': 0.0, 'generate_note_dict': 0.0, 'instrument_similarity': 0.0, 'sequence_distance': 0.0}
+    for f in files:
+        start = time.perf_counter()
+        parsed = pm.PrettyMIDI(f)
+        parse_end = time.perf_counter()
+        note_dict = mp.generate_note_dict(parsed)
+        note_dict_end = time.perf_counter()
+        for q in midi_queries:
+            mp.instrument_similarity(q, parsed)
+        similarity_end = time.perf_counter()
+        for q in query_notes:
+            for notes in note_dict.values():
+                mp.sequence_distance(q, notes)
+        end = time.perf_counter()
+        totals['parse'] += parse_end - start
+        totals['generate_note_dict'] += note_dict_end - parse_end
+        totals['instrument_similarity'] += similarity_end - note_dict_end
+        totals['sequence_distance'] += end - similarity_end
+        del parsed, note_dict
+    return {stage: timing(total, len(files)) for stage, total in totals.items()}
+
+# times every stage on one corpus, returns {stage: timing}
+def run_corpus(size: 'int', length: 'str', seed: 'int', n_queries: 'int', store_dir: 'str') -> 'dict':
+    files, text_dir, midi_queries, text_queries = build_corpus(size, length, seed, n_queries)
+    stages = time_midi_files(files, midi_queries)
+
+    collection = cs.load_collection(size, text_dir)
+    stages['compile_chords'], compiled = time_stage(cs.compile_chords, collection)
+    query_chords = [ns.split_notes(q) for q in text_queries]
+    stages['min_chord_weighted'], _ = time_stage(lambda j: [cs.min_chord_weighted(collection[j], q, compiled[j])
+                                                            for q in query_chords], list(range(size)))
+
+    store = ms.FeatureStore(os.path.join(store_dir, f'{length}_{size}_{seed}'))
+    stages['ingest'], _ = time_stage(store.ingest, [files], size)
+    stages['rank_midi'], _ = time_stage(lambda q: mp.return_ranking(q, files, store=store), midi_queries)
+    stages['rank_text'], _ = time_stage(lambda q: cs.rank_row([d for d, c in cs.score_query(q, collection, compiled)]),
+                                        text_queries)
+    return stages
+
+# current git commit (short hash), so reports can be matched to the code they measured
+def git_commit() -> 'str':
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ''
+
+# prints the speedup (old / new time per item) of every stage found in both reports
+def compare(old: 'dict', new: 'dict'):
+    print(f"comparing {old['commit']} -> {new['commit']}")
+    for corpus, stages in new['results'].items():
+        for stage, timing in stages.items():
+            if stage in old['results'].get(corpus, {}):
+                old_time = old['results'][corpus][stage]['per_item_us']
+                ratio = old_time / timing['per_item_us'] if timing['per_item_us'] else float('inf')
+                print(f"{corpus:20} {stage:22} {old_time:12.1f} us -> {timing['per_item_us']:12.1f} us  x{ratio:.2f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100])
+    parser.add_argument('--lengths', nargs='+', choices=list(LENGTHS), default=['short'])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--queries', type=int, default=5)
+    parser.add_argument('--json')
+    parser.add_argument('--compare')
+    args = parser.parse_args()
+
+    # a fresh feature store every run, so ingest always parses the whole corpus
+    store_dir = tempfile.mkdtemp()
+    report = {'commit': git_commit(), 'python': platform.python_version(), 'numpy': np.__version__,
+              'seed': args.seed, 'queries': args.queries, 'results': {}}
+    for length in args.lengths:
+        for size in args.sizes:
+            corpus = f'{length}/{size}'
+            report['results'][corpus] = run_corpus(size, length, args.seed, args.queries, store_dir)
+            for stage, timing in report['results'][corpus].items():
+                print(f"{corpus:20} {stage:22} {timing['total_s']:10.4f} s  {timing['per_item_us']:12.1f} us/item")
+
+    shutil.rmtree(store_dir)
+
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump(report, out, indent=2)
+    if args.compare:
+        with open(args.compare) as old:
+            compare(json.load(old), report)
@@ -0,0 +1,57 @@
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+'''
+cold start benchmark: times fresh python processes importing the library and starting the CLI,
+the cost of starting python itself (python -c pass) is measured too so it can be subtracted
+run from the repository root: python benchmarks/startup.py [-n runs] [--json out.json]
+'''
+TARGETS = {'python': 'pass',
+           'retrieval': 'import retrieval',
+           'MIDI_properties': 'import MIDI_properties',
+           'MIDI_store': 'import MIDI_store',
+           'chord_similarity': 'import V1.chord_similarity',
+           'main': 'import main'}
+
+
+# median wall clock time (ms) of n fresh python processes running code
+def time_process(code: 'str', n: 'int') -> 'float':
+    times = []
+    for i in range(n):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], check=True)
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+# runs every target, returns {target: {'median_ms': ..., 'over_python_ms': ...}}
+def run(n=10) -> 'dict':
+    results = {}
+    for name, code in TARGETS.items():
+        results[name] = {'median_ms': round(time_process(code, n), 2)}
+    base = results['python']['median_ms']
+    for name in results:
+        results[name]['over_python_ms'] = round(results[name]['median_ms'] - base, 2)
+
+    start = time.perf_counter()
+    subprocess.run([sys.executable, 'main.py', '--help'], check=True, stdout=subprocess.DEVNULL)
+    results['main.py --help'] = {'median_ms': round((time.perf_counter() - start) * 1000, 2)}
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--runs', type=int, default=10)
+    parser.add_argument('--json')
+    args = parser.parse_args()
+
+    results = run(args.runs)
+    for name, result in results.items():
+        print(f"{name:20} {result['median_ms']:8.2f} ms" + 
+              (f"  (+{result['over_python_ms']:.2f} ms)" if 'over_python_ms' in result else ''))
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump(results, out, indent=2)
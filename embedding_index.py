@@ -0,0 +1,188 @@
+import json
+import os
+import numpy as np
+import MIDI_properties as mp
+
+'''
+approximate retrieval tier for very large MIDI collections: instead of scoring every piece, every instrument track is
+turned into fixed size vectors (one per window of WINDOW notes, every HOP notes) made of
+    the pitch class histogram (12), the pitch class transition matrix (12 x 12) and log2 duration mean and spread (2)
+all from the notes generate_note_dict gives (see mp.NoteArray). the vectors go into a random projection LSH index:
+each of n_tables tables hashes a vector to n_bits signs of random projections, and keeps the codes sorted, so a lookup
+is a binary search per table (and per probe, the codes one bit away) whatever the collection size.
+a query's tracks are looked up the same way, the pieces colliding in the most tables are the shortlist, and only the
+shortlist is scored exactly (mp.rank_tracks, the rank_instruments score) for the final ranking
+'''
+WINDOW = 24
+HOP = 8
+DEFAULT_TABLES = 12
+DEFAULT_BITS = 16
+DEFAULT_SHORTLIST = 100
+# weight of each part of a vector (histograms are normalized to sum to 1 first)
+HISTOGRAM_WEIGHT = 1.0
+TRANSITION_WEIGHT = 2.0
+DURATION_WEIGHT = 0.25
+DIMENSIONS = 12 + 144 + 2
+# the vectors are centered on the mean vector of (up to) MEAN_SAMPLE documents spread over the collection
+MEAN_SAMPLE = 1000
+# number of vectors hashed at once
+HASH_CHUNK = 1 << 16
+
+
+'''
+(n windows, DIMENSIONS) vectors of a note sequence (pitch classes and durations), windows of window notes every hop notes
+(the last window always ends on the last note). a sequence shorter than window is a single window, None gives one
+vector for the whole sequence
+'''
+def window_embeddings(pitch_classes: 'np.ndarray', durations: 'np.ndarray', window=WINDOW, hop=HOP) -> 'np.ndarray':
+    pitch_classes = np.asarray(pitch_classes, dtype=np.int64)
+    n = len(pitch_classes)
+    if n == 0:
+        return np.zeros((0, DIMENSIONS), dtype=np.float32)
+    if window is None or n <= window:
+        starts, ends = np.array([0]), np.array([n])
+    else:
+        starts = np.unique(np.append(np.arange(0, n - window + 1, hop), n - window))
+        ends = starts + window
+
+    # every feature is a sum over the window, read from cumulative sums
+    def window_sums(values):
+        sums = np.concatenate([np.zeros((1,) + values.shape[1:]), np.cumsum(values, axis=0)])
+        return sums[ends] - sums[starts]
+
+    histogram = window_sums(np.eye(12)[pitch_classes])
+    bigrams = np.zeros((n, 144))
+    bigrams[np.arange(n - 1), pitch_classes[:-1] * 12 + pitch_classes[1:]] = 1
+    # the transition out of the last note of a window belongs to the next one
+    transitions = window_sums(bigrams) - bigrams[ends - 1]
+    log_durations = np.log2(np.maximum(np.asarray(durations, dtype=np.float64), 0.001))
+    counts = (ends - starts)[:, None]
+    mean = window_sums(log_durations[:, None]) / counts
+    spread = np.sqrt(np.maximum(window_sums(log_durations[:, None]**2) / counts - mean**2, 0))
+
+    vectors = np.concatenate([HISTOGRAM_WEIGHT * histogram / counts,
+                              TRANSITION_WEIGHT * transitions / np.maximum(transitions.sum(axis=1, keepdims=True), 1),
+                              DURATION_WEIGHT * mean, DURATION_WEIGHT * spread], axis=1)
+    return vectors.astype(np.float32)
+
+# vectors of every (non drum) instrument of a list of tracks (NoteArrays), the query's are made of each whole track (window=None)
+def track_embeddings(tracks: "list['mp.NoteArray']", window=WINDOW, hop=HOP) -> 'np.ndarray':
+    vectors = [window_embeddings(notes.pitch_classes, notes.durations, window, hop)
+               for notes in tracks if not notes.is_drum]
+    return np.concatenate(vectors + [np.zeros((0, DIMENSIONS), dtype=np.float32)])
+
+
+class EmbeddingIndex:
+    def __init__(self, n_tables=DEFAULT_TABLES, n_bits=DEFAULT_BITS, seed=0):
+        self.n_tables = n_tables
+        self.n_bits = n_bits
+        self.seed = seed
+        self.planes = np.random.default_rng(seed).standard_normal((n_tables, n_bits, DIMENSIONS)).astype(np.float32)
+        self.mean = np.zeros(DIMENSIONS, dtype=np.float32)
+        self.docs = []
+        self.positions = {}
+        # per table: codes sorted, and the document (position in docs) of each sorted code, both in the smallest
+        # unsigned type that holds them (uint16 codes for 16 bits)
+        self.code_dtype = np.min_scalar_type((1 << n_bits) - 1)
+        self.codes = np.zeros((n_tables, 0), dtype=self.code_dtype)
+        self.code_docs = np.zeros((n_tables, 0), dtype=np.uint8)
+
+    # (n_tables, len(vectors)) LSH codes: bit b of table t is the sign of the b-th random projection of the centered vector
+    def hash(self, vectors: 'np.ndarray') -> 'np.ndarray':
+        codes = np.empty((self.n_tables, len(vectors)), dtype=self.code_dtype)
+        bits = 1 << np.arange(self.n_bits, dtype=np.int64)
+        for start in range(0, len(vectors), HASH_CHUNK):
+            chunk = vectors[start:start + HASH_CHUNK] - self.mean
+            codes[:, start:start + HASH_CHUNK] = (np.einsum('tbd,nd->tnb', self.planes, chunk) > 0) @ bits
+        return codes
+
+    '''
+    builds the tables (replacing any index) from every document's vectors, vectors_of(doc) gives them.
+    only the codes are kept, one document at a time, so the vectors of the whole collection are never in memory at once
+    '''
+    def build(self, docs: 'list', vectors_of):
+        self.docs = list(docs)
+        self.positions = {doc: i for i, doc in enumerate(self.docs)}
+        sample = [vectors_of(doc) for doc in self.docs[::max(1, len(self.docs) // MEAN_SAMPLE)]]
+        sample = np.concatenate(sample + [np.zeros((0, DIMENSIONS), dtype=np.float32)])
+        self.mean = sample.mean(axis=0).astype(np.float32) if len(sample) else np.zeros(DIMENSIONS, dtype=np.float32)
+
+        codes, code_docs = [], []
+        doc_dtype = np.min_scalar_type(max(len(self.docs) - 1, 0))
+        for d, doc in enumerate(self.docs):
+            codes.append(self.hash(vectors_of(doc)))
+            code_docs.append(np.full(codes[-1].shape[1], d, dtype=doc_dtype))
+        codes = np.concatenate(codes + [np.zeros((self.n_tables, 0), dtype=self.code_dtype)], axis=1)
+        code_docs = np.concatenate(code_docs + [np.zeros(0, dtype=doc_dtype)])
+        order = np.argsort(codes, axis=1, kind='stable')
+        self.codes = np.take_along_axis(codes, order, axis=1)
+        self.code_docs = code_docs[order]
+
+    '''
+    up to shortlist documents whose vectors collide with the query vectors, most collisions first (ties in document order).
+    with probe, codes one bit away from the query's are looked up as well (counting half as much as an exact collision)
+    '''
+    def candidates(self, vectors: 'np.ndarray', shortlist=DEFAULT_SHORTLIST, probe=True) -> 'list':
+        if len(vectors) == 0 or self.codes.shape[1] == 0:
+            return []
+        codes = self.hash(vectors)
+        flips = np.concatenate([[0], 1 << np.arange(self.n_bits)]) if probe else np.zeros(1, dtype=np.int64)
+        # same type as the tables, so searchsorted doesn't convert a whole table per lookup
+        flips = flips.astype(self.code_dtype)
+        votes = np.zeros(len(self.docs))
+        for t in range(self.n_tables):
+            probes = (codes[t][:, None] ^ flips[None, :])
+            weights = np.where(flips == 0, 1.0, 0.5)[None, :].repeat(len(codes[t]), axis=0)
+            left = np.searchsorted(self.codes[t], probes.ravel(), side='left')
+            right = np.searchsorted(self.codes[t], probes.ravel(), side='right')
+            # each document counts once per probe, however many of its windows are in the bucket
+            for lo, hi, w in zip(left.tolist(), right.tolist(), weights.ravel().tolist()):
+                if hi > lo:
+                    votes[np.unique(self.code_docs[t, lo:hi])] += w
+        hit = np.flatnonzero(votes)
+        ranked = hit[np.argsort(-votes[hit], kind='stable')][:shortlist]
+        return [self.docs[d] for d in ranked.tolist()]
+
+    def save(self, path: 'str'):
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, 'codes.npy'), self.codes)
+        np.save(os.path.join(path, 'code_docs.npy'), self.code_docs)
+        np.save(os.path.join(path, 'mean.npy'), self.mean)
+        with open(os.path.join(path, 'index.json'), 'w') as index:
+            json.dump({'n_tables': self.n_tables, 'n_bits': self.n_bits, 'seed': self.seed, 'docs': self.docs}, index)
+
+    # index saved with save(), the codes are memory-mapped
+    @classmethod
+    def load(cls, path: 'str') -> 'EmbeddingIndex':
+        with open(os.path.join(path, 'index.json'), 'r') as index_file:
+            info = json.load(index_file)
+        index = cls(info['n_tables'], info['n_bits'], info['seed'])
+        index.docs = info['docs']
+        index.positions = {doc: i for i, doc in enumerate(index.docs)}
+        index.codes = np.load(os.path.join(path, 'codes.npy'), mmap_mode='r')
+        index.code_docs = np.load(os.path.join(path, 'code_docs.npy'), mmap_mode='r')
+        index.mean = np.load(os.path.join(path, 'mean.npy'))
+        return index
+
+
+# builds an index of MIDI files from a MIDI_store.FeatureStore, one document per file (every window of every instrument)
+def build_embedding_index(store, total_collection: "list['str']", n_tables=DEFAULT_TABLES, n_bits=DEFAULT_BITS,
+                          seed=0, window=WINDOW, hop=HOP) -> 'EmbeddingIndex':
+    store.ingest(total_collection)
+    index = EmbeddingIndex(n_tables, n_bits, seed)
+    index.build(total_collection, lambda c: track_embeddings(store.tracks(c), window, hop))
+    return index
+
+'''
+approximate version of mp.return_ranking (store path): the query's shortlist from the index is scored exactly
+(mp.rank_tracks), returns the top r pieces with a distance under p. pieces outside the shortlist are never scored,
+so a raise in shortlist trades speed for recall
+'''
+def approximate_ranking(query: 'pm.PrettyMIDI', store, index: 'EmbeddingIndex', p=2000, r=10,
+                        shortlist=DEFAULT_SHORTLIST, probe=True) -> 'dict':
+    query_tracks = mp.midi_tracks(query)
+    candidates = index.candidates(track_embeddings(query_tracks, window=None), shortlist, probe)
+    # scored in collection order, so ties are broken the way mp.return_ranking breaks them
+    candidates = sorted(candidates, key=index.positions.get)
+    ranking = {c.split('.')[0]: mp.rank_tracks(query_tracks, store.tracks(c)) for c in candidates}
+    return dict((k, v) for k, v in sorted(ranking.items(), key=lambda item: item[1])[:r] if v < p)
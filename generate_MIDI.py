@@ -1,80 +1,123 @@
 import pretty_midi as pm
-from numpy import random as r
+import numpy as np
+import argparse
+import concurrent.futures
+import os
 import MIDI_properties as mp
 
 '''
 generate midi files for testing and the like
+every function takes a np.random.Generator (rng), a fresh unseeded one is used if none is given,
+pass a seeded one (or use create_collection with a seed) to get the same files every time
+
+USAGE
+2 random files in Collection: generate_MIDI.py
+10000 seeded files using every core: generate_MIDI.py 10000 -d corpus -s 42 -w 0
 '''
 INSTRUMENTS_RANGE = 127
-TEMPOS = {'Largo': [40, 60], 'Adagio':[60, 72], 'Andante': [72, 84], 
+TEMPOS = {'Largo': [40, 60], 'Adagio':[60, 72], 'Andante': [72, 84],
             'Moderato': [85, 110], 'Allegro': [110, 140], 'Presto': [140, 160]}
+# semitones above C of every base note (see mp.NOTE_VALUES), used to draw pitches in bulk
+NOTE_PITCHES = np.array(list(mp.NOTE_VALUES.values()))
 
 
 '''
 returns a list of n integers within the range of 0-127 (INSTRUMENT_RANGE), each instrument has the possibility of being a drum
 '''
-def choose_instruments(num_instr: 'int') -> 'list':
-    return [pm.Instrument(program=r.randint(INSTRUMENTS_RANGE), is_drum=r.choice([True, False])) for i in range(num_instr)]
+def choose_instruments(num_instr: 'int', rng=None) -> 'list':
+    rng = rng or np.random.default_rng()
+    programs = rng.integers(INSTRUMENTS_RANGE, size=num_instr)
+    drums = rng.choice([True, False], size=num_instr)
+    return [pm.Instrument(program=int(programs[i]), is_drum=bool(drums[i])) for i in range(num_instr)]
 
 '''
 returns randomly selected name and tempo selected from the range
 '''
-def choose_tempo(tempo_name = '') -> 'tuple':
-    tempo_name = r.choice(list(TEMPOS.keys())) if tempo_name not in TEMPOS else tempo_name
-    return str(tempo_name), r.randint(TEMPOS[tempo_name][0], TEMPOS[tempo_name][1])
+def choose_tempo(tempo_name = '', rng=None) -> 'tuple':
+    rng = rng or np.random.default_rng()
+    tempo_name = rng.choice(list(TEMPOS.keys())) if tempo_name not in TEMPOS else tempo_name
+    return str(tempo_name), int(rng.integers(TEMPOS[tempo_name][0], TEMPOS[tempo_name][1]))
 
 '''
-given an overall duration in seconds and number of notes, creates a 2D list with [start, end] times within the 
-interval, where the length is the number of notes, durations are randomly assigned based on duration and note #
+given an overall duration in seconds and number of notes, splits the duration into n equal windows and creates an (n, 2)
+array with a [start, end] time for each, the start is in the first half of the window and the end in the second half
 '''
-def note_durations(dur_s: 'int', n: 'int') -> 'list':
-    durations = []
-    curr_min = 0
-    for i in range(n):
-        while curr_min < dur_s:
-            # logic is a bit funky, but should create dur frame from start of curr window to half, and half to end
-            durations.append([r.randint(curr_min, (curr_min + (dur_s / n)))/2,
-                                r.randint((curr_min + (dur_s / n))/2, curr_min + (dur_s / n))])
-            curr_min += (dur_s / n)
-    return durations
+def note_durations(dur_s: 'int', n: 'int', rng=None) -> 'np.ndarray':
+    rng = rng or np.random.default_rng()
+    window = dur_s / n
+    window_starts = np.arange(n) * window
+    return np.column_stack([window_starts + rng.uniform(0, window / 2, n),
+                            window_starts + rng.uniform(window / 2, window, n)])
 
 '''
 returns list of notes length of the number of notes from a given list (from note_durations)
 '''
-def generate_notes(note_durs: 'int') -> 'list':
-    return [r.choice(list(mp.NOTE_VALUES.keys())) for i in range(note_durs)]
+def generate_notes(note_durs: 'int', rng=None) -> 'list':
+    rng = rng or np.random.default_rng()
+    return rng.choice(list(mp.NOTE_VALUES.keys()), size=note_durs).tolist()
+
+# MIDI pitch numbers of n random base notes in the given octave (same as pm.note_name_to_number(f"{note}{octave}"))
+def generate_pitches(n: 'int', octave: 'int', rng=None) -> 'np.ndarray':
+    rng = rng or np.random.default_rng()
+    return 12 * (octave + 1) + rng.choice(NOTE_PITCHES, size=n)
 
 '''
-returns a randomly populated MIDI file (pm object) with intruments and notes
+returns a randomly populated MIDI file (pm object) with intruments and notes, a new file is made unless m_file is given.
+i_len (number of instruments) and tot_dur (seconds) are drawn for every file if not given, each instrument plays one
+note per beat of the tempo unless n_notes is given
 '''
-def generate_file(m_file=pm.PrettyMIDI(), t='', i_len=r.randint(5, 10), tot_dur=r.randint(10, 50)):
-    tempo = choose_tempo(t)
-    instruments = choose_instruments(i_len)
+def generate_file(m_file=None, t='', i_len=None, tot_dur=None, n_notes=None, rng=None):
+    rng = rng or np.random.default_rng()
+    m_file = pm.PrettyMIDI() if m_file is None else m_file
+    i_len = int(rng.integers(5, 10)) if i_len is None else i_len
+    tot_dur = int(rng.integers(10, 50)) if tot_dur is None else tot_dur
+
+    tempo = choose_tempo(t, rng)
+    velocity = max(40, min(120, int(160 - tempo[1]/2)))
+    instruments = choose_instruments(i_len, rng)
     for i in instruments:
-        durations = note_durations(tot_dur, len(instruments))
-        note_names = generate_notes(len(durations))
-        curr_pitch = r.randint(1, 7)
+        n = n_notes or max(1, int(tot_dur * tempo[1] / 60))
+        durations = note_durations(tot_dur, n, rng).tolist()
+        pitches = generate_pitches(n, int(rng.integers(1, 7)), rng).tolist()
         curr_instr = pm.Instrument(program=i.program)
-        
-        for note in note_names:
-            curr_instr.notes.append(pm.Note(
-                                velocity=max(40, min(120, int(160 - tempo[1]/2))),
-                                pitch=pm.note_name_to_number(f"{note}{curr_pitch}"), 
-                                start=durations[note_names.index(note)][0],
-                                end=durations[note_names.index(note)][1]))
-
+        curr_instr.notes = [pm.Note(velocity=velocity, pitch=pitches[k], start=durations[k][0], end=durations[k][1])
+                            for k in range(n)]
         m_file.instruments.append(curr_instr)
-    
+
     return m_file
 
+# generates and writes a single file from its own seed, run by the worker processes of create_collection
+def write_file(job: 'tuple'):
+    file_name, seed, file_args = job
+    generate_file(rng=np.random.default_rng(seed), **file_args).write(file_name)
+    return file_name
+
 '''
-creates n randomly generated MIDI files in the Collection directory, simply named after the index
+creates n randomly generated MIDI files in the given directory (Collection by default), simply named after the index.
+every file gets an independent seed spawned from seed, so the same seed always gives the same collection no matter
+how many workers (processes, 0 for every core) generate it. file_args are passed on to generate_file
 '''
-def create_collection(n_docs: 'int'):
-    for i in range(n_docs):
-        generate_file().write(f'Collection/Piece{i + 1}.mid')
+def create_collection(n_docs: 'int', directory='Collection', seed=None, workers=1, first=1, **file_args) -> "list['str']":
+    os.makedirs(directory, exist_ok=True)
+    seeds = np.random.SeedSequence(seed).spawn(n_docs)
+    jobs = [(os.path.join(directory, f'Piece{i + first}.mid'), seeds[i], file_args) for i in range(n_docs)]
+    if workers == 1:
+        return [write_file(job) for job in jobs]
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        return list(pool.map(write_file, jobs, chunksize=max(1, n_docs // (4 * (workers or os.cpu_count())))))
 
-create_collection(2)
 
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('n_docs', type=int, nargs='?', default=2)
+    parser.add_argument('-d', '--directory', default='Collection')
+    parser.add_argument('-s', '--seed', type=int)
+    parser.add_argument('-w', '--workers', type=int, default=1)
+    parser.add_argument('-i', '--instruments', type=int, dest='i_len')
+    parser.add_argument('-t', '--duration', type=int, dest='tot_dur')
+    parser.add_argument('-n', '--notes', type=int, dest='n_notes')
+    parser.add_argument('--tempo', default='', dest='t', choices=['', *TEMPOS])
+    args = vars(parser.parse_args())
 
-query_instr = [instrument for instrument in generate_file().instruments]
\ No newline at end of file
+    create_collection(args.pop('n_docs'), args.pop('directory'), args.pop('seed'), args.pop('workers'), **args)
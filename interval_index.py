@@ -0,0 +1,98 @@
+import numpy as np
+import V1.note_similarity as ns
+
+'''
+transposition-invariant inverted index used to prune the collection before exact scoring
+every pitch class sequence is turned into its intervals ((next - current) % 12, the same pitch classes semitone_distance
+and ns.find_note_dist compare), each n-gram of intervals is encoded as one integer and mapped to the documents containing it.
+a query only gets exactly scored against the documents sharing the most interval n-grams with it
+'''
+DEFAULT_N = 3
+
+
+# set of the interval n-grams in a pitch class sequence, each n-gram encoded as a base 12 integer
+def interval_ngrams(pitch_classes: 'np.ndarray', n=DEFAULT_N) -> 'set':
+    intervals = np.diff(np.asarray(pitch_classes, dtype=np.int64)) % 12
+    if len(intervals) < n:
+        return set()
+    windows = np.lib.stride_tricks.sliding_window_view(intervals, n)
+    return set((windows @ (12 ** np.arange(n, dtype=np.int64))).tolist())
+
+# pitch classes of the roots (first notes) of a list of chords from ns.split_notes, unknown note names are skipped
+def chord_roots(chords: "list['list']") -> 'np.ndarray':
+    roots = [ns.notes_array.index(ns.note_equivalence(c[0])) for c in chords
+             if c and ns.note_equivalence(c[0]) in ns.notes_array]
+    return np.array(roots, dtype=np.int64)
+
+
+class IntervalIndex:
+    def __init__(self, n=DEFAULT_N):
+        self.n = n
+        self.postings = {}
+        self.doc_grams = {}
+
+    # adds (or replaces) a document made up of one or more pitch class sequences (ex: one per instrument)
+    def add(self, doc, sequences: "list['np.ndarray']"):
+        self.remove(doc)
+        grams = set()
+        for seq in sequences:
+            grams |= interval_ngrams(seq, self.n)
+        self.doc_grams[doc] = grams
+        for g in grams:
+            self.postings.setdefault(g, set()).add(doc)
+
+    # removes a document from the index, does nothing if it was never added
+    def remove(self, doc):
+        for g in self.doc_grams.pop(doc, set()):
+            self.postings[g].discard(doc)
+            if not self.postings[g]:
+                del self.postings[g]
+
+    '''
+    returns the documents sharing at least min_overlap (fraction, 0-1) of the query's distinct interval n-grams,
+    most shared first, cut to the max_candidates best. these two are the recall/speed knob:
+    lower min_overlap and higher max_candidates find more matches but leave more documents to score exactly.
+    at min_overlap 0 the documents sharing no n-gram are candidates too (after the others), so the loosest setting
+    (min_overlap 0, no max_candidates) prunes nothing. if the query is too short to have any n-grams nothing can be
+    pruned either, so every document is returned
+    '''
+    def candidates(self, sequences: "list['np.ndarray']", max_candidates=None, min_overlap=0.0) -> 'list':
+        query_grams = set()
+        for seq in sequences:
+            query_grams |= interval_ngrams(seq, self.n)
+        if not query_grams:
+            return list(self.doc_grams)[:max_candidates]
+
+        shared = {}
+        for g in query_grams:
+            for doc in self.postings.get(g, ()):
+                shared[doc] = shared.get(doc, 0) + 1
+
+        docs = self.doc_grams if min_overlap <= 0 else shared
+        ranked = sorted((doc for doc in docs if shared.get(doc, 0) / len(query_grams) >= min_overlap),
+                        key=lambda doc: -shared.get(doc, 0))
+        return ranked[:max_candidates]
+
+
+# builds an index of MIDI files from a MIDI_store.FeatureStore, one document per file (every instrument's notes)
+def build_midi_index(store, total_collection: "list['str']", n=DEFAULT_N) -> 'IntervalIndex':
+    index = IntervalIndex(n)
+    store.ingest(total_collection)
+    for c in total_collection:
+        index.add(c, [t.pitches % 12 for t in store.tracks(c)])
+    return index
+
+# patches a MIDI index in place with the changes returned by MIDI_store.FeatureStore.sync
+def patch_midi_index(index: 'IntervalIndex', store, changes: 'dict'):
+    for c in changes['removed']:
+        index.remove(c)
+    for c in changes['added'] + changes['changed']:
+        index.add(c, [t.pitches % 12 for t in store.tracks(c)])
+
+# builds an index of the text collection (collection/pieceN.txt), documents are the 0 based piece index
+def build_chord_index(music_f_count: 'int', n=DEFAULT_N, collection_dir='collection') -> 'IntervalIndex':
+    index = IntervalIndex(n)
+    for j in range(music_f_count):
+        with open(f"{collection_dir}/piece{j + 1}.txt", "r") as piece:
+            index.add(j, [chord_roots(ns.split_notes(piece.read()))])
+    return index
@@ -4,60 +4,121 @@ DON'T USE: Generate sample collection: main.py -g [num of docs] [min len] [max l
 Clear collection: main.py -g 0
 Use query file with precision 5.0: main.py query.txt -p 5
 Generate fractal: main.py query.txt -f
+Batch mode (one JSON line per query in query.txt): main.py query.txt -b
+Per stage timings and counters: main.py query.txt --profile (or --profile-json profile.json to write them as JSON)
 '''
 
 # external imports
 import argparse
-import os
+import json
 import sys
 
 # imports from other local files
+import retrieval
+import profiling as prof
 import V1.note_similarity as ns
 import V1.chord_similarity as cs
 import V1.generate_collection as gc
+import V1.chord_cache as cc
+import V1.chord_corpus as ccorp
 
-# contants
-music_f_count = 0
-for path in os.scandir("collection"):
-    if path.is_file():
-        music_f_count += 1
+# split chords of the text collection, kept between runs by batch mode
+CHORD_CACHE = '.chord_cache.json'
+# the text collection compiled into one memory-mapped corpus (see V1/chord_corpus.py), recompiled when a piece changes
+CHORD_CORPUS = '.chord_corpus'
 
-# command line args
+# command line args, recall defaults to 10 (or the number of files in the collection if there are less)
 parser = argparse.ArgumentParser()
 parser.add_argument('query', nargs='?')
-parser.add_argument('-r', '--recall', type=int, default= 10 if music_f_count > 10 else music_f_count)
+parser.add_argument('-r', '--recall', type=int, default=None)
 parser.add_argument('-p', '--precision', type=float, default=float('inf'))
 parser.add_argument('-g', '--generate_files', type=int, nargs='*', default=[5, 5, 15])
 parser.add_argument('-f', '--fractal', action='store_true')
+parser.add_argument('-b', '--batch', action='store_true')
+parser.add_argument('--profile', action='store_true')
+parser.add_argument('--profile-json', default=None)
+
+'''
+batch mode: the collection is loaded once (only new or edited pieces are re-read, see V1/chord_cache.py), then every (non empty) line of the query file is scored against it and 
+written to stdout as soon as it's done, one JSON line per query:
+{"query": 1, "text": "A C# E | C E G", "results": [{"document": 3, "distance": 1.414, "chords": "A C# E | C E G"}]}
+'''
+def run_batch(query_file, precision, recall):
+    with prof.stage('load_collection'):
+        cache = cc.ChordCache("collection", CHORD_CACHE)
+        cache.refresh()
+        collection, compiled, documents = cache.collection()
+    with open(query_file, "r") as queries:
+        query_collection = [q.strip() for q in queries.read().split("\n") if q.strip()]
+
+    for q_i in range(len(query_collection)):
+        line = {"query": q_i + 1, "text": query_collection[q_i]}
+        try:
+            scores = cs.score_query(query_collection[q_i], collection, compiled)
+            distances = [min_dist for min_dist, chords in scores]
+            line["results"] = [{"document": documents[j], "distance": d, 
+                                "chords": ' | '.join([' '.join(c) for c in scores[j][1]])} 
+                               for j, d in cs.rank_row(distances, precision, recall)]
+        except Exception as e:
+            line["error"] = str(e)
+        print(json.dumps(line), flush=True)
+
 
 def main():
     args = parser.parse_args()
+    if args.profile or args.profile_json is not None:
+        prof.enable()
+        with prof.stage('total'):
+            run(args)
+        profile = prof.report()
+        if args.profile_json is not None:
+            prof.write_report(profile, args.profile_json)
+        # printed to stderr so batch mode output stays one JSON line per query
+        if args.profile:
+            print(f"\n{prof.format_report(profile)}", file=sys.stderr)
+    else:
+        run(args)
+
+
+def run(args):
+    music_f_count = retrieval.text_collection_size()
+    args.recall = min(10, music_f_count) if args.recall is None else args.recall
     if args.generate_files is not None and not args.query:
         if args.generate_files[0] == 0:
             gc.clear_files()
         else: gc.gen_files(*args.generate_files)
-        sys.exit(0)
+        return
+
+    if args.query and args.batch:
+        run_batch(args.query, args.precision, args.recall)
 
-    if args.query:
+    elif args.query:
         # first assume is a file
         try:
-            query_collection = open(args.query, "r").read().split("\n")
-            ra = cs.ranking_calc(query_collection, music_f_count)
-
+            with prof.stage('read_query'):
+                query_collection = [q.strip() for q in open(args.query, "r").read().split("\n") if q.strip()]
+            corpus = ccorp.open_corpus(music_f_count, "collection", CHORD_CORPUS)
             for q_i in range(len(query_collection)):
                 print(f"\nQ{q_i + 1}: {query_collection[q_i]}")
-                chunk = len(ra) // len(query_collection)
-                ranking = cs.rank_return(dict(list(ra.items())[(q_i * chunk):((q_i + 1) * chunk)]), args.precision, args.recall)
-                print(ranking)
+                print_ranking(query_collection[q_i], corpus, args.precision, args.recall)
                 
         # if not, assume is a string of notes/chords
         except FileNotFoundError:
             print(f"Results for query {args.query}:\n")
-            cs.rank_return(cs.ranking_calc([args.query], music_f_count), args.precision, args.recall)
+            corpus = ccorp.open_corpus(music_f_count, "collection", CHORD_CORPUS)
+            print_ranking(args.query, corpus, args.precision, args.recall)
        
         # else return error
         except Exception as e:
             print(f"Error: {e}")
 
 
-main()
\ No newline at end of file
+# prints the top r documents under p for a query, every document is scored on its own (see cs.score_query)
+def print_ranking(query, corpus, precision, recall):
+    scores = cs.score_query(query, None, corpus=corpus)
+    for j, d in cs.rank_row([min_dist for min_dist, chords in scores], precision, recall):
+        print(f"Document {j + 1}: \nChord: '{' | '.join([' '.join(c) for c in scores[j][1]])}', distance: {d}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+import hashlib
+import os
+
+'''
+change detection for collection directories: every file is recorded with its size, modification time and content hash.
+the hash is only recomputed when the size or mtime changed, so scanning an unchanged collection only costs a stat per file,
+and a file that was touched but not edited is not treated as changed
+'''
+HASH_BLOCK = 1 << 20
+
+
+# blake2b hash of the file's contents
+def content_hash(file_name: 'str') -> 'str':
+    h = hashlib.blake2b(digest_size=16)
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK), b''):
+            h.update(block)
+    return h.hexdigest()
+
+# {size, mtime, hash} of a file, the previous state (from the manifest) is reused if size and mtime are the same
+def file_state(file_name: 'str', previous=None) -> 'dict':
+    stat = os.stat(file_name)
+    if previous is not None and previous.get('size') == stat.st_size and previous.get('mtime') == stat.st_mtime_ns:
+        return {'size': previous['size'], 'mtime': previous['mtime'], 'hash': previous['hash']}
+    return {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'hash': content_hash(file_name)}
+
+'''
+compares the files of a collection to the entries recorded for them ({file name: {size, mtime, hash, ...}}),
+returns {'added': [...], 'changed': [...], 'removed': [...], 'states': {file name: current state}}.
+removed is only filled if prune is True (files in entries that aren't in files anymore)
+'''
+def diff(entries: 'dict', files: "list['str']", prune=True) -> 'dict':
+    changes = {'added': [], 'changed': [], 'removed': [], 'states': {}}
+    for f in files:
+        previous = entries.get(f)
+        state = file_state(f, previous if previous is not None and 'hash' in previous else None)
+        changes['states'][f] = state
+        if previous is None:
+            changes['added'].append(f)
+        elif state['hash'] != previous.get('hash'):
+            changes['changed'].append(f)
+
+    if prune:
+        current = set(files)
+        changes['removed'] = [f for f in entries if f not in current]
+    return changes
@@ -0,0 +1,165 @@
+import numpy as np
+import MIDI_properties as mp
+import V1.note_similarity as ns
+import V1.chord_similarity as cs
+import profiling as prof
+
+'''
+chord extraction from polyphonic MIDI, so the chord engine (V1/chord_similarity.py) can rank a MIDI collection.
+the notes of every (non drum) instrument are put on one timeline, with times snapped to ONSET_RESOLUTION seconds so notes
+played together land on the same onset. a sort and sweep over the start/end events (ends before starts at the same
+time, O(n log n)) gives how many notes of each pitch class are sounding at every onset, the set of sounding pitch classes
+is the chord at that onset. sets with fewer than MIN_CHORD_NOTES pitch classes (a melody note on its own) are skipped.
+every set is mapped to the closest chord_prog_diff shape (root + shape, see chord_shape_table), and consecutive onsets
+mapped to the same chord are one chord.
+chords come out as note names (like a line of a collection text file) and compiled (see cs.compile_chords)
+'''
+ONSET_RESOLUTION = 0.05
+MIN_CHORD_NOTES = 2
+SHAPE_NAMES = list(cs.chord_prog_diff)
+
+
+# index in ns.notes_array (A being 0) of a MIDI pitch class (C being 0)
+def note_index(pitch_class):
+    return (pitch_class - 9) % 12
+
+'''
+(12 * len(SHAPE_NAMES), 12) table of every chord_prog_diff shape on every root (row root * len(SHAPE_NAMES) + shape),
+as a 0/1 mask over MIDI pitch classes
+'''
+def chord_shape_table() -> 'np.ndarray':
+    table = np.zeros((12, len(SHAPE_NAMES), 12), dtype=np.int8)
+    for root in range(12):
+        for s, name in enumerate(SHAPE_NAMES):
+            table[root, s, [(root + i) % 12 for i in cs.chord_prog_diff[name]]] = 1
+    return table.reshape(12 * len(SHAPE_NAMES), 12)
+
+CHORD_SHAPES = chord_shape_table()
+
+'''
+closest chord_prog_diff chord to every pitch class set (rows of a (n, 12) 0/1 matrix), returns (roots, shape indexes).
+a chord scores the pitch classes it shares with the set minus the ones it adds, ties go to the chord rooted on the
+bass (lowest pitch starting at the onset), then to the first chord in chord_prog_diff order
+'''
+def match_shapes(sets: 'np.ndarray', bass: 'np.ndarray') -> 'tuple':
+    sets = sets.astype(np.int16)
+    shared = sets @ CHORD_SHAPES.T.astype(np.int16)
+    added = CHORD_SHAPES.sum(axis=1).astype(np.int16) - shared
+    roots = np.arange(len(CHORD_SHAPES)) // len(SHAPE_NAMES)
+    # scores are doubled so the bass bonus only breaks ties
+    scores = 2 * (shared - added) + (roots[None, :] == bass[:, None])
+    best = np.argmax(scores, axis=1)
+    return best // len(SHAPE_NAMES), best % len(SHAPE_NAMES)
+
+'''
+pitch class sets sounding at every onset of a list of tracks (NoteArrays), returns (sets (n, 12) 0/1, bass pitch classes, onset times)
+with the sets under MIN_CHORD_NOTES pitch classes dropped
+'''
+def onset_sets(tracks: "list['mp.NoteArray']", resolution=ONSET_RESOLUTION) -> 'tuple':
+    tracks = [t for t in tracks if not t.is_drum and len(t.pitches)]
+    if not tracks:
+        return np.zeros((0, 12), dtype=np.int8), np.zeros(0, dtype=np.int64), np.zeros(0)
+    pitches = np.concatenate([np.asarray(t.pitches, dtype=np.int64) for t in tracks])
+    starts = np.concatenate([np.asarray(t.starts, dtype=np.float64) for t in tracks])
+    ends = starts + np.concatenate([np.asarray(t.durations, dtype=np.float64) for t in tracks])
+    start_ticks = np.round(starts / resolution).astype(np.int64)
+    end_ticks = np.maximum(np.round(ends / resolution).astype(np.int64), start_ticks + 1)
+    prof.count('notes swept', len(pitches))
+
+    # events sorted by (tick, ends first), each one adding or removing a note of its pitch class
+    n = len(pitches)
+    ticks = np.concatenate([end_ticks, start_ticks])
+    is_start = np.concatenate([np.zeros(n, dtype=np.int64), np.ones(n, dtype=np.int64)])
+    order = np.lexsort((is_start, ticks))
+    deltas = np.zeros((2 * n, 12), dtype=np.int32)
+    deltas[np.arange(2 * n), np.concatenate([pitches, pitches])[order] % 12] = np.where(is_start[order], 1, -1)
+    sounding = np.cumsum(deltas, axis=0)
+
+    # the state at an onset is the one after its last event (every note ending there removed, every one starting added)
+    sorted_ticks = ticks[order]
+    last_event = np.flatnonzero(np.append(sorted_ticks[1:] != sorted_ticks[:-1], True))
+    onsets = np.unique(start_ticks)
+    rows = last_event[np.searchsorted(sorted_ticks[last_event], onsets)]
+    sets = (sounding[rows] > 0).astype(np.int8)
+
+    # lowest pitch starting at each onset
+    lowest = np.full(len(onsets), 128)
+    np.minimum.at(lowest, np.searchsorted(onsets, start_ticks), pitches)
+    bass = lowest % 12
+
+    keep = sets.sum(axis=1) >= MIN_CHORD_NOTES
+    return sets[keep], bass[keep], onsets[keep] * resolution
+
+'''
+chords of a list of tracks (NoteArrays) as (roots, shape indexes): the roots are indexes in ns.notes_array and the shapes indexes in
+SHAPE_NAMES, consecutive onsets mapped to the same chord are one chord
+'''
+def chord_indexes(tracks: "list['mp.NoteArray']", resolution=ONSET_RESOLUTION) -> 'tuple':
+    sets, bass, onsets = onset_sets(tracks, resolution)
+    roots, shapes = match_shapes(sets, bass)
+    keep = np.ones(len(roots), dtype=np.bool_)
+    keep[1:] = (roots[1:] != roots[:-1]) | (shapes[1:] != shapes[:-1])
+    prof.count('chords extracted', int(keep.sum()))
+    return note_index(roots[keep]).astype(np.int16), shapes[keep]
+
+# chords (lists of note names) and compiled chords (as cs.compile_chords gives them) of chord_indexes
+def named_chords(roots: 'np.ndarray', shapes: 'np.ndarray') -> 'tuple':
+    chords = [[ns.notes_array[(root + i) % 12] for i in cs.chord_prog_diff[SHAPE_NAMES[s]]]
+              for root, s in zip(roots.tolist(), shapes.tolist())]
+    return chords, compiled_chords(roots, shapes)
+
+# compiled chords (roots, shape ids) of chord_indexes
+def compiled_chords(roots: 'np.ndarray', shapes: 'np.ndarray') -> 'tuple':
+    shape_ids = np.array([cs.shape_ids[tuple(cs.chord_prog_diff[name])] for name in SHAPE_NAMES], dtype=np.int32)
+    return np.asarray(roots, dtype=np.int16), shape_ids[shapes]
+
+'''
+chords of a list of tracks (NoteArrays), returns (chords as lists of note names, compiled (roots, shape ids) as cs.compile_chords
+gives them) ready for cs.min_chord_weighted
+'''
+@prof.timed('extract_chords')
+def midi_chords(tracks: "list['mp.NoteArray']", resolution=ONSET_RESOLUTION) -> 'tuple':
+    return named_chords(*chord_indexes(tracks, resolution))
+
+'''
+(roots, shape indexes) of every file of a MIDI collection, read from a MIDI_store.FeatureStore. the chords of a file are
+only extracted once per version of it: they are kept in its store entry (as root * len(SHAPE_NAMES) + shape), which
+ingest replaces when the file changes, and saved with the store index
+'''
+def stored_chords(store, total_collection: "list['str']", resolution=ONSET_RESOLUTION) -> 'list':
+    store.ingest(total_collection)
+    extracted = False
+    for c in total_collection:
+        entry = store.files[c]
+        if entry.get('chords', {}).get('resolution') != resolution:
+            with prof.stage('extract_chords', c):
+                roots, shapes = chord_indexes(store.tracks(c), resolution)
+            entry['chords'] = {'resolution': resolution, 'codes': (roots.astype(np.int64) * len(SHAPE_NAMES) + shapes).tolist()}
+            extracted = True
+    if extracted:
+        store.save_index()
+    codes = [np.array(store.files[c]['chords']['codes'], dtype=np.int64) for c in total_collection]
+    return [(c // len(SHAPE_NAMES), c % len(SHAPE_NAMES)) for c in codes]
+
+# chords of every file of a MIDI collection, read from a MIDI_store.FeatureStore, as (collection, compiled collection)
+def chord_collection(store, total_collection: "list['str']", resolution=ONSET_RESOLUTION) -> 'tuple':
+    named = [named_chords(roots, shapes) for roots, shapes in stored_chords(store, total_collection, resolution)]
+    return [chords for chords, compiled in named], [compiled for chords, compiled in named]
+
+'''
+ranks a MIDI collection with the chord engine, the query is a string of chords (like a query file line) or a
+pm.PrettyMIDI (its chords are extracted the same way). returns the top r pieces (name: distance) under p.
+the collection's chords come from the store (see stored_chords), only the chords of new or edited files are extracted
+'''
+def rank_midi_chords(query, total_collection: "list['str']", store, p=float('inf'), r=10,
+                     resolution=ONSET_RESOLUTION) -> 'dict':
+    if isinstance(query, str):
+        compiled_query = cs.compile_chords(ns.split_notes(query))
+    else:
+        compiled_query = midi_chords(mp.midi_tracks(query), resolution)[1]
+    distances = []
+    for j, (roots, shapes) in enumerate(stored_chords(store, total_collection, resolution)):
+        with prof.stage('score_piece', total_collection[j]):
+            totals = cs.chord_window_distances(compiled_chords(roots, shapes), compiled_query)
+        distances.append(round(float(totals.min()), 3) if len(totals) else float('inf'))
+    return {total_collection[j].split('.')[0]: d for j, d in cs.rank_row(distances, p, r)}
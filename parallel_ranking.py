@@ -0,0 +1,83 @@
+import concurrent.futures
+import heapq
+import multiprocessing
+import os
+import MIDI_properties as mp
+import MIDI_store as ms
+
+'''
+parallel version of MIDI_properties.return_ranking (store path): the collection is split into chunks that are scored
+by a pool of processes, each reading the memory-mapped feature store. a bounded top r heap is kept and the current
+r-th best distance is shared with the workers, so pieces (and windows in sequence_distance) that can't make it into
+the top r anymore are abandoned early. results are the same as the serial path, ties are broken by collection order
+'''
+DEFAULT_CHUNK_SIZE = 32
+
+# state of a worker process, set once by init_worker
+worker_state = {}
+
+
+def init_worker(store_path: 'str', query_tracks: "list['mp.NoteArray']", shared_bound, r: 'int', p: 'float', band=None):
+    worker_state['store'] = ms.FeatureStore(store_path)
+    worker_state['query'] = query_tracks
+    worker_state['bound'] = shared_bound
+    worker_state['r'] = r
+    worker_state['p'] = p
+    worker_state['band'] = band
+
+'''
+scores a chunk of (position, file name) pairs, returns (distance, position, name) for the pieces that could still be
+in the top r. the bound is the lowest of p, the shared r-th best and the r-th best of this chunk
+'''
+def rank_chunk(chunk: "list['tuple']") -> "list['tuple']":
+    state = worker_state
+    local_top = []
+    results = []
+    for position, c in chunk:
+        bound = min(state['p'], state['bound'].value, -local_top[0] if len(local_top) == state['r'] else float('inf'))
+        dist = mp.rank_tracks(state['query'], state['store'].tracks(c), bound, state['band'])
+        if dist > bound:
+            continue
+        results.append((dist, position, c.split('.')[0]))
+
+        heapq.heappush(local_top, -dist)
+        if len(local_top) > state['r']:
+            heapq.heappop(local_top)
+        if len(local_top) == state['r'] and -local_top[0] < state['bound'].value:
+            with state['bound'].get_lock():
+                state['bound'].value = min(state['bound'].value, -local_top[0])
+    return results
+
+# adds chunk results to the top r heap (max heap on (distance, position)), returns the new r-th best distance
+def push_results(top: 'list', results: "list['tuple']", r: 'int') -> 'float':
+    for dist, position, name in results:
+        heapq.heappush(top, (-dist, -position, name))
+        if len(top) > r:
+            heapq.heappop(top)
+    return -top[0][0] if len(top) == r else float('inf')
+
+'''
+same output as mp.return_ranking(query, total_collection, p, r, store): the top r pieces with a distance under p.
+workers is the number of processes (os.cpu_count() by default), chunk_size the number of files sent to a worker at once,
+band (DTW alignment) is passed on to mp.rank_tracks
+'''
+def return_ranking_parallel(query: 'pm.PrettyMIDI', total_collection: "list['str']", store, p=2000, r=10,
+                            workers=None, chunk_size=DEFAULT_CHUNK_SIZE, band=None) -> 'dict':
+    if r <= 0:
+        return {}
+    store.ingest(total_collection)
+    query_tracks = mp.midi_tracks(query)
+    items = list(enumerate(total_collection))
+    chunks = [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+    shared_bound = multiprocessing.Value('d', float('inf'))
+
+    top = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers or os.cpu_count(), initializer=init_worker,
+                                                initargs=(store.path, query_tracks, shared_bound, r, p, band)) as pool:
+        for future in concurrent.futures.as_completed([pool.submit(rank_chunk, chunk) for chunk in chunks]):
+            kth_best = push_results(top, future.result(), r)
+            with shared_bound.get_lock():
+                shared_bound.value = min(shared_bound.value, kth_best)
+
+    ranked = sorted((-neg_dist, -neg_position, name) for neg_dist, neg_position, name in top)
+    return dict((name, dist) for dist, position, name in ranked if dist < p)
@@ -0,0 +1,53 @@
+import numpy as np
+import MIDI_properties as mp
+import MIDI_store as ms
+
+'''
+cheap first stage filter for the MIDI collection: every piece is compared to the query by the metadata cached when it was
+ingested in the feature store (estimated tempo, instrument family histogram and note stats), for the whole collection at
+once with array arithmetic, and pieces that are clearly dissimilar are dropped before the note-level scoring.
+the metadata score of a piece is the sum of:
+    TEMPO_WEIGHT * |log2(query tempo / piece tempo)| (0 if either tempo can't be estimated)
+    FAMILY_WEIGHT * (1 - overlap of the normalized instrument family histograms)
+    DURATION_WEIGHT * |log2(query mean note duration / piece mean note duration)|
+and pieces with fewer notes than the query's shortest instrument get inf, the rigid scan can't match them at all.
+pieces scoring over the cutoff are pruned
+'''
+DEFAULT_CUTOFF = 2.0
+TEMPO_WEIGHT = 1.0
+FAMILY_WEIGHT = 1.0
+DURATION_WEIGHT = 0.5
+
+
+# metadata score of every piece in the store metadata (see ms.FeatureStore.metadata) against the query's
+def metadata_scores(query: 'dict', metadata: 'dict') -> 'np.ndarray':
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tempo = np.nan_to_num(np.abs(np.log2(query['tempo'] / metadata['tempo'])), nan=0.0, posinf=0.0)
+        families = metadata['families'] / np.maximum(metadata['families'].sum(axis=1, keepdims=True), 1)
+        query_families = query['families'] / max(query['families'].sum(), 1)
+        overlap = np.minimum(families, query_families).sum(axis=1)
+        duration = np.nan_to_num(np.abs(np.log2(query['mean_duration'] / metadata['mean_duration'])),
+                                 nan=0.0, posinf=0.0)
+
+    scores = TEMPO_WEIGHT * tempo + FAMILY_WEIGHT * (1 - overlap) + DURATION_WEIGHT * duration
+    return np.where(metadata['notes'] < query['min_notes'], np.inf, scores)
+
+# metadata of the query, in the same form as a row of ms.FeatureStore.metadata
+def query_metadata(query: 'pm.PrettyMIDI', query_tracks: "list['mp.NoteArray']") -> 'dict':
+    metadata = ms.piece_metadata(query_tracks)
+    return {'tempo': ms.safe_tempo(query), 'mean_duration': metadata['mean_duration'],
+            'families': np.array(metadata['families'], dtype=np.float64),
+            'min_notes': min((len(t.pitches) for t in query_tracks), default=0)}
+
+'''
+returns (the files of total_collection whose metadata score is at most cutoff, in collection order, and a report
+{'candidates': number of files checked, 'pruned': number of files dropped}). the files must be ingested in the store
+'''
+def prefilter(query: 'pm.PrettyMIDI', total_collection: "list['str']", store, cutoff=DEFAULT_CUTOFF,
+              query_tracks=None) -> 'tuple':
+    query_tracks = mp.midi_tracks(query) if query_tracks is None else query_tracks
+    metadata = store.metadata()
+    scores = metadata_scores(query_metadata(query, query_tracks), metadata)
+    rows = metadata['rows']
+    kept = [c for c in total_collection if scores[rows[c]] <= cutoff]
+    return kept, {'candidates': len(total_collection), 'pruned': len(total_collection) - len(kept)}
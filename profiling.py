@@ -0,0 +1,116 @@
+import functools
+import heapq
+import json
+import time
+
+'''
+lightweight per stage profiling: wall clock timers and counters that the MIDI and chord engines report to.
+everything is off by default, a disabled stage() or count() is a single flag check, so instrumented code runs at full speed.
+stages can be given a label (ex: the collection piece or the query being scored), the SLOWEST labelled calls of every
+stage are kept so pathological pieces or queries show up in the report.
+    profiling.enable()
+    ... run queries ...
+    print(profiling.format_report(profiling.report()))
+'''
+SLOWEST = 5
+
+enabled = False
+# stage name: [calls, seconds]
+timers = {}
+# counter name: total
+counters = {}
+# stage name: heap of the SLOWEST (seconds, label) labelled calls
+slowest = {}
+
+
+class Stage:
+    def __init__(self, name: 'str', label=None):
+        self.name = name
+        self.label = label
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        timer = timers.setdefault(self.name, [0, 0.0])
+        timer[0] += 1
+        timer[1] += seconds
+        if self.label is not None:
+            heap = slowest.setdefault(self.name, [])
+            (heapq.heappush if len(heap) < SLOWEST else heapq.heappushpop)(heap, (seconds, str(self.label)))
+        return False
+
+
+# stand in for Stage when profiling is disabled
+class NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_STAGE = NullStage()
+
+
+def enable():
+    global enabled
+    enabled = True
+
+def disable():
+    global enabled
+    enabled = False
+
+def reset():
+    timers.clear()
+    counters.clear()
+    slowest.clear()
+
+# context manager timing a stage (ex: with profiling.stage('parse_midi', file_name): ...)
+def stage(name: 'str', label=None):
+    return Stage(name, label) if enabled else NULL_STAGE
+
+# adds n to a counter (ex: windows scored, notes converted)
+def count(name: 'str', n=1):
+    if enabled:
+        counters[name] = counters.get(name, 0) + n
+
+# decorator timing every call of a function as a stage
+def timed(name: 'str'):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return fn(*args, **kwargs)
+            with Stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# {'stages': {name: {'calls', 'seconds'}}, 'counters': {name: total}, 'slowest': {stage: [{'label', 'seconds'}]}}
+def report() -> 'dict':
+    return {'stages': {name: {'calls': calls, 'seconds': seconds}
+                       for name, (calls, seconds) in sorted(timers.items(), key=lambda item: -item[1][1])},
+            'counters': dict(sorted(counters.items())),
+            'slowest': {name: [{'label': label, 'seconds': seconds} for seconds, label in sorted(heap, reverse=True)]
+                        for name, heap in slowest.items()}}
+
+# text breakdown of a report, slowest stage first
+def format_report(profile: 'dict') -> 'str':
+    lines = ['stage                          calls     seconds   ms/call']
+    for name, timer in profile['stages'].items():
+        lines.append(f"{name:<28} {timer['calls']:>7} {timer['seconds']:>11.4f} {1000 * timer['seconds'] / timer['calls']:>9.3f}")
+    if profile['counters']:
+        lines.append('')
+        lines.extend(f'{name:<28} {total:>19}' for name, total in profile['counters'].items())
+    for name, calls in profile['slowest'].items():
+        lines.append(f'\nslowest {name}:')
+        lines.extend(f"    {call['seconds'] * 1000:>10.3f} ms  {call['label']}" for call in calls)
+    return '\n'.join(lines)
+
+# writes a report as JSON
+def write_report(profile: 'dict', path: 'str'):
+    with open(path, 'w') as report_file:
+        json.dump(profile, report_file, indent=2)
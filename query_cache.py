@@ -0,0 +1,163 @@
+import hashlib
+import os
+import pickle
+import time
+from collections import OrderedDict
+import numpy as np
+import manifest
+
+'''
+cache of query results, so repeated queries don't rescore the whole collection.
+results are keyed by a fingerprint of the normalized query (see text_fingerprint and midi_fingerprint) plus the
+ranking parameters, and saved with the version of the collection they were scored against (see version): a lookup
+whose collection changed since is a miss, and the stale entry is dropped.
+the fingerprints are not transposition invariant on purpose: chord and note distances compare absolute roots/pitch
+classes, so a transposed query has different scores. equivalent spellings (A# and Bb, see ns.note_equivalence) do share a key.
+entries are evicted least recently used first once there are more than max_entries or their (pickled) size goes
+over max_bytes. if a path is given, entries are also written there and read back on a memory miss (a second tier that
+outlives the process), bounded the same way by max_disk_entries and max_disk_bytes.
+a collection is checked for changes at most every check_interval seconds (a stat per file), so a lookup right after
+another one doesn't pay for the whole collection, and an edit can go unnoticed for up to check_interval seconds
+'''
+MAX_ENTRIES = 1024
+MAX_DISK_ENTRIES = 16 * MAX_ENTRIES
+CHECK_INTERVAL = 1.0
+
+
+# canonical form of a text query: its chords (as ns.split_notes gives them) with every note spelled as in ns.notes_array
+def text_fingerprint(query: 'str') -> 'str':
+    import V1.note_similarity as ns
+    return ' | '.join(' '.join(ns.note_equivalence(n) for n in chord) for chord in ns.split_notes(query))
+
+# hash of what mp.rank_tracks reads from the query tracks (NoteArrays): instrument (similarity row), pitch classes and durations
+def midi_fingerprint(query_tracks: "list['mp.NoteArray']") -> 'str':
+    import MIDI_properties as mp
+    h = hashlib.blake2b(digest_size=16)
+    for t in query_tracks:
+        h.update(np.int64(mp.similarity_row(t.program, t.is_drum)).tobytes())
+        h.update((np.asarray(t.pitches, dtype=np.uint8) % 12).tobytes())
+        h.update(np.asarray(t.durations, dtype=np.float32).tobytes())
+        h.update(b'|')
+    return h.hexdigest()
+
+
+class QueryCache:
+    def __init__(self, max_entries=MAX_ENTRIES, max_bytes=None, path=None, check_interval=CHECK_INTERVAL,
+                 max_disk_entries=MAX_DISK_ENTRIES, max_disk_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.path = path
+        self.max_disk_entries = max_disk_entries
+        self.max_disk_bytes = max_disk_bytes
+        # disk file name: size of the entries on disk, least recently used first (by modification time for the files
+        # found when the cache is opened)
+        self.disk_entries = OrderedDict()
+        self.disk_size = 0
+        if path is not None and os.path.isdir(path):
+            files = [f.path for f in os.scandir(path) if f.name.endswith('.pkl')]
+            for f in sorted(files, key=lambda f: os.stat(f).st_mtime_ns):
+                self.disk_entries[f] = os.stat(f).st_size
+                self.disk_size += self.disk_entries[f]
+        # a collection is only re-checked for changes if it was last checked more than check_interval seconds ago
+        self.check_interval = check_interval
+        self.entries = OrderedDict()
+        self.size = 0
+        self.states = {}
+        self.versions = {}
+        self.hits = 0
+        self.misses = 0
+
+    '''
+    version id of a collection (list of file names), changes whenever a file is added, removed or edited.
+    files are tracked like MIDI_store/ChordCache do (see manifest.py), so an unchanged collection only costs a stat per file
+    '''
+    def version(self, files: "list['str']") -> 'str':
+        files = tuple(files)
+        checked = self.versions.get(files)
+        if checked is not None and time.monotonic() - checked[1] < self.check_interval:
+            return checked[0]
+        changes = manifest.diff(self.states, files, prune=False)
+        self.states.update(changes['states'])
+        h = hashlib.blake2b(digest_size=16)
+        for f in files:
+            h.update(f'{f}\0{self.states[f]["hash"]}\0'.encode())
+        self.versions[files] = (h.hexdigest(), time.monotonic())
+        return self.versions[files][0]
+
+    def disk_path(self, key) -> 'str':
+        return os.path.join(self.path, hashlib.blake2b(repr(key).encode(), digest_size=16).hexdigest() + '.pkl')
+
+    # cached result of key for the given collection version, None on a miss
+    def get(self, key, version: 'str'):
+        entry = self.entries.get(key)
+        if entry is None and self.path is not None and os.path.exists(self.disk_path(key)):
+            with open(self.disk_path(key), 'rb') as cached:
+                entry_key, entry_version, data = pickle.load(cached)
+            if entry_key == key:
+                entry = (entry_version, data)
+                self.insert(key, entry_version, data, write=False)
+                if self.disk_path(key) in self.disk_entries:
+                    self.disk_entries.move_to_end(self.disk_path(key))
+                    os.utime(self.disk_path(key))
+        if entry is None or entry[0] != version:
+            if entry is not None:
+                self.discard(key)
+            self.misses += 1
+            return None
+        if key in self.entries:
+            self.entries.move_to_end(key)
+        self.hits += 1
+        return pickle.loads(entry[1])
+
+    # saves the result of key for the given collection version
+    def put(self, key, version: 'str', value):
+        self.insert(key, version, pickle.dumps(value))
+
+    def insert(self, key, version: 'str', data: 'bytes', write=True):
+        self.discard(key, keep_disk=True)
+        self.entries[key] = (version, data)
+        self.size += len(data)
+        if write and self.path is not None:
+            os.makedirs(self.path, exist_ok=True)
+            tmp_path = self.disk_path(key) + '.tmp'
+            with open(tmp_path, 'wb') as cached:
+                pickle.dump((key, version, data), cached)
+            os.replace(tmp_path, self.disk_path(key))
+            self.disk_size += os.path.getsize(self.disk_path(key)) - self.disk_entries.pop(self.disk_path(key), 0)
+            self.disk_entries[self.disk_path(key)] = os.path.getsize(self.disk_path(key))
+            self.evict_disk()
+        while self.entries and (len(self.entries) > self.max_entries or
+                                (self.max_bytes is not None and self.size > self.max_bytes)):
+            old_key, (old_version, old_data) = self.entries.popitem(last=False)
+            self.size -= len(old_data)
+
+    # forgets an entry (in memory, and on disk unless keep_disk)
+    def discard(self, key, keep_disk=False):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+        if not keep_disk and self.path is not None:
+            self.remove_disk(self.disk_path(key))
+
+    # removes an entry's file (another process sharing the directory may have removed it already)
+    def remove_disk(self, disk_path: 'str'):
+        self.disk_size -= self.disk_entries.pop(disk_path, 0)
+        try:
+            os.remove(disk_path)
+        except FileNotFoundError:
+            pass
+
+    # removes the least recently used files once there are more than max_disk_entries or they take over max_disk_bytes
+    def evict_disk(self):
+        while self.disk_entries and (len(self.disk_entries) > self.max_disk_entries or
+                                     (self.max_disk_bytes is not None and self.disk_size > self.max_disk_bytes)):
+            self.remove_disk(next(iter(self.disk_entries)))
+
+    # forgets every entry, in memory and on disk
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+        if self.path is not None and os.path.isdir(self.path):
+            for f in os.listdir(self.path):
+                if f.endswith('.pkl'):
+                    self.remove_disk(os.path.join(self.path, f))
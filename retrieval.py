@@ -0,0 +1,75 @@
+import os
+
+'''
+library entry point for the retrieval system, importing it has no side effects and is cheap:
+the MIDI and chord engines (and pretty_midi) are only imported by the functions that use them,
+and the collections are discovered when a function asks for them, not at import time
+'''
+MIDI_COLLECTION_DIR = 'Collection'
+TEXT_COLLECTION_DIR = 'collection'
+
+
+# sorted list of the MIDI files in the given directory
+def midi_collection(collection_dir=MIDI_COLLECTION_DIR) -> "list['str']":
+    return sorted(os.path.join(collection_dir, f) for f in os.listdir(collection_dir) if f.lower().endswith('.mid'))
+
+# number of files in the text collection (they are named piece1.txt to pieceN.txt), 0 if the directory doesn't exist
+def text_collection_size(collection_dir=TEXT_COLLECTION_DIR) -> 'int':
+    if not os.path.isdir(collection_dir):
+        return 0
+    return sum(1 for path in os.scandir(collection_dir) if path.is_file())
+
+'''
+top r pieces of the MIDI collection for a query (file name or pm.PrettyMIDI), with a distance under p.
+the collection is read through a MIDI_store.FeatureStore (opened at store_dir if no store is given).
+if an interval_index.IntervalIndex is given, only the candidates it returns for the query are scored (see
+IntervalIndex.candidates for max_candidates and min_overlap). it is patched in place to match the collection first, so
+the same index (empty to begin with) can be passed to every call
+'''
+def rank_midi(query, collection_dir=MIDI_COLLECTION_DIR, p=2000, r=10, store=None, store_dir=None,
+              index=None, max_candidates=None, min_overlap=0.0) -> 'dict':
+    import MIDI_properties as mp
+    import MIDI_store as ms
+    import interval_index as ii
+
+    if isinstance(query, str):
+        query = mp.pretty_midi().PrettyMIDI(query)
+    store = store or ms.FeatureStore(store_dir or ms.STORE_DIR)
+    total_collection = midi_collection(collection_dir)
+    if index is None:
+        return mp.return_ranking(query, total_collection, p, r, store)
+
+    parsed = store.ingest(total_collection)
+    ii.patch_midi_index(index, store, {'added': [c for c in total_collection if c not in index.doc_grams],
+                                       'changed': [c for c in parsed if c in index.doc_grams],
+                                       'removed': [c for c in index.doc_grams if c not in set(total_collection)]})
+    return mp.return_ranking(query, total_collection, p, r, store, index=index, max_candidates=max_candidates,
+                             min_overlap=min_overlap)
+
+'''
+scores every query (string of chords) against the text collection, loaded once, returns one list of
+(document number, distance, best chords) per query, with the top r documents under p.
+a V1.chord_cache.ChordCache can be passed to reuse its pieces, it is refreshed first so only changed pieces are re-read.
+an interval_index.IntervalIndex can be passed to only score the candidates it returns for each query (documents are 0
+based piece numbers), it is patched along with the cache
+'''
+def rank_text(query_collection: "list['str']", collection_dir=TEXT_COLLECTION_DIR, p=float('inf'), r=10,
+              cache=None, index=None, max_candidates=None, min_overlap=0.0) -> 'list':
+    import V1.chord_similarity as cs
+    import V1.chord_cache as cc
+    import V1.note_similarity as ns
+    import interval_index as ii
+
+    cache = cache or cc.ChordCache(collection_dir)
+    cache.refresh(index)
+    collection, compiled, documents = cache.collection()
+    rankings = []
+    for query in query_collection:
+        pieces = range(len(documents))
+        if index is not None:
+            candidates = set(index.candidates([ii.chord_roots(ns.split_notes(query))], max_candidates, min_overlap))
+            pieces = [k for k in pieces if documents[k] - 1 in candidates]
+        scores = cs.score_query(query, [collection[k] for k in pieces], [compiled[k] for k in pieces])
+        distances = [min_dist for min_dist, chords in scores]
+        rankings.append([(documents[pieces[j]], d, scores[j][1]) for j, d in cs.rank_row(distances, p, r)])
+    return rankings
@@ -0,0 +1,271 @@
+import asyncio
+import concurrent.futures
+import json
+import os
+import sys
+import time
+import retrieval
+
+'''
+long running query service: the text and MIDI collections are loaded once and kept in memory (the chord cache and the
+memory-mapped feature store), so a query doesn't pay for imports, directory scans and parsing every time.
+clients send one JSON request per line over a Unix socket (or localhost TCP) and get one JSON line back per request:
+    {"id": 1, "text": "A C# E | C E G"}  ->  {"id": 1, "results": [{"document": 3, "distance": 1.414, "chords": "..."}]}
+    {"id": 2, "file": "query1.txt"}      ->  {"id": 2, "queries": [{"query": 1, "text": "...", "results": [...]}, ...]}
+    {"id": 3, "midi": "query.mid"}       ->  {"id": 3, "results": [{"piece": "Collection/Piece1", "distance": 12.5}]}
+"p" and "r" can be given in a request to override the service's precision and recall, errors come back as {"error"}.
+requests arriving within BATCH_WAIT of each other (up to BATCH_SIZE) are scored together: the text queries of a batch
+are split in one chunk per worker process and every MIDI query is a task of its own.
+the collections are checked for changes at most every REFRESH_INTERVAL seconds, workers reload when they changed.
+files that fail to parse are left out of the rankings until they are fixed and reported on stderr once per version of
+the file, an error while scoring a batch is sent back to every request of the batch
+run: python service.py [--socket .retrieval.sock | --port 8765]
+'''
+SOCKET_PATH = '.retrieval.sock'
+BATCH_SIZE = 64
+BATCH_WAIT = 0.005
+REFRESH_INTERVAL = 1.0
+
+# state of a worker process, set once by init_worker
+worker_state = {}
+
+
+def init_worker(text_dir: 'str', store_path: 'str'):
+    import MIDI_store as ms
+    import V1.chord_cache as cc
+
+    worker_state['cache'] = cc.ChordCache(text_dir)
+    worker_state['store'] = ms.FeatureStore(store_path)
+    worker_state['version'] = None
+
+# brings the worker's copy of the collections up to date if they changed since it last scored anything
+def refresh_worker(version: 'int'):
+    if worker_state['version'] != version:
+        worker_state['cache'].refresh()
+        worker_state['store'].load()
+        worker_state['version'] = version
+
+# scores text queries (strings of chords), returns one list of {"document", "distance", "chords"} per query
+def score_text(version: 'int', queries: "list['str']", p: 'float', r: 'int') -> 'list':
+    import V1.chord_similarity as cs
+
+    refresh_worker(version)
+    collection, compiled, documents = worker_state['cache'].collection()
+    results = []
+    for query in queries:
+        try:
+            scores = cs.score_query(query, collection, compiled)
+            distances = [min_dist for min_dist, chords in scores]
+            results.append([{"document": documents[j], "distance": d,
+                             "chords": ' | '.join([' '.join(c) for c in scores[j][1]])}
+                            for j, d in cs.rank_row(distances, p, r)])
+        except Exception as e:
+            results.append({"error": str(e)})
+    return results
+
+# scores a MIDI query file against the stored collection (read only, the service keeps the store in sync)
+def score_midi(version: 'int', query_file: 'str', total_collection: "list['str']", p: 'float', r: 'int') -> 'list':
+    import MIDI_properties as mp
+
+    refresh_worker(version)
+    store = worker_state['store']
+    query_tracks = mp.midi_tracks(mp.pretty_midi().PrettyMIDI(query_file))
+    ranking = [(mp.rank_tracks(query_tracks, store.tracks(c)), c.split('.')[0]) for c in total_collection
+               if c in store.files]
+    ranking = sorted(ranking, key=lambda item: item[0])[:r]
+    return [{"piece": name, "distance": dist} for dist, name in ranking if dist < p]
+
+
+class RetrievalService:
+    def __init__(self, text_dir=retrieval.TEXT_COLLECTION_DIR, midi_dir=retrieval.MIDI_COLLECTION_DIR,
+                 store_path=None, workers=None, p=float('inf'), r=10):
+        import MIDI_store as ms
+        import V1.chord_cache as cc
+
+        self.text_dir = text_dir
+        self.midi_dir = midi_dir
+        self.p = p
+        self.r = r
+        self.workers = workers or os.cpu_count()
+        self.cache = cc.ChordCache(text_dir)
+        self.store = ms.FeatureStore(store_path or ms.STORE_DIR)
+        self.midi_files = []
+        # file name: error of the collection files that failed to parse
+        self.errors = {}
+        self.version = 0
+        self.last_refresh = None
+        self.queue = None
+        self.pool = None
+
+    # checks both collections for changes (at most every REFRESH_INTERVAL seconds), bumps the version if anything changed
+    def refresh(self):
+        if self.last_refresh is not None and time.monotonic() - self.last_refresh < REFRESH_INTERVAL:
+            return
+        changed = any(self.cache.refresh().values())
+        self.midi_files = retrieval.midi_collection(self.midi_dir) if os.path.isdir(self.midi_dir) else []
+        changed = any(self.store.sync(self.midi_files, skip_errors=True).values()) or changed
+        self.version += changed
+        self.last_refresh = time.monotonic()
+        errors = {**self.cache.errors, **{f: entry['error'] for f, entry in self.store.errors.items()}}
+        for f, error in errors.items():
+            if self.errors.get(f) != error:
+                print(f"skipped {f}: {error}", file=sys.stderr)
+        self.errors = errors
+
+    # answers one request line, the response is written once the batch it ended up in is scored
+    async def answer(self, line: 'bytes') -> 'dict':
+        try:
+            request = json.loads(line)
+        except json.JSONDecodeError as e:
+            return {"error": f"invalid request: {e}"}
+        response = {"id": request.get("id")} if isinstance(request, dict) else {}
+        if not isinstance(request, dict) or not {"text", "file", "midi"} & set(request):
+            return {**response, "error": 'a request needs a "text", "file" or "midi" query'}
+
+        queries = [request["text"]] if "text" in request else []
+        if "file" in request:
+            try:
+                with open(request["file"], "r") as query_file:
+                    queries = [q.strip() for q in query_file.read().split("\n") if q.strip()]
+            except OSError as e:
+                return {**response, "error": str(e)}
+
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((request, queries, future))
+        results = await future
+        if isinstance(results, Exception):
+            return {**response, "error": str(results)}
+        if "file" in request:
+            return {**response, "queries": [{"query": i + 1, "text": q, **({"results": res} if isinstance(res, list) else res)}
+                                            for i, (q, res) in enumerate(zip(queries, results))]}
+        result = results[0] if "text" in request else results
+        return {**response, **({"results": result} if isinstance(result, list) else result)}
+
+    # collects the requests arriving within BATCH_WAIT of the first one (up to BATCH_SIZE)
+    async def next_batch(self) -> 'list':
+        batch = [await self.queue.get()]
+        deadline = asyncio.get_running_loop().time() + BATCH_WAIT
+        while len(batch) < BATCH_SIZE:
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    # scores every batch, an error scoring one is sent to each of its requests that isn't answered yet
+    async def batcher(self):
+        while True:
+            batch = await self.next_batch()
+            try:
+                await self.score_batch(batch)
+            except Exception as e:
+                print(f"batch failed: {type(e).__name__}: {e}", file=sys.stderr)
+                for request, queries, future in batch:
+                    if not future.done():
+                        future.set_result(e)
+
+    # text queries in one chunk per worker, MIDI queries one task each
+    async def score_batch(self, batch: 'list'):
+        await asyncio.get_running_loop().run_in_executor(None, self.refresh)
+        tasks = []
+        text_batch = [(request, queries, future) for request, queries, future in batch if "midi" not in request]
+        for p, r in set((request.get("p", self.p), request.get("r", self.r)) for request, q, f in text_batch):
+            group = [(queries, future) for request, queries, future in text_batch
+                     if (request.get("p", self.p), request.get("r", self.r)) == (p, r)]
+            tasks.append(self.score_text_group(group, p, r))
+        for request, queries, future in batch:
+            if "midi" in request:
+                tasks.append(self.resolve(future, self.pool.submit(
+                    score_midi, self.version, request["midi"], self.midi_files,
+                    request.get("p", self.p), request.get("r", self.r))))
+        # every task runs to the end before an error is raised, so none of them answers a request after the batcher did
+        errors = [e for e in await asyncio.gather(*tasks, return_exceptions=True) if isinstance(e, Exception)]
+        if errors:
+            raise errors[0]
+
+    # splits the queries of a group of requests in one chunk per worker and hands each request its own results
+    async def score_text_group(self, group: 'list', p: 'float', r: 'int'):
+        queries = [q for request_queries, future in group for q in request_queries]
+        chunk_size = max(1, -(-len(queries) // self.workers))
+        chunks = [self.pool.submit(score_text, self.version, queries[i:i + chunk_size], p, r)
+                  for i in range(0, len(queries), chunk_size)]
+        try:
+            results = [res for chunk in chunks for res in await asyncio.wrap_future(chunk)]
+        except Exception as e:
+            results = [e] * len(queries)
+        position = 0
+        for request_queries, future in group:
+            request_results = results[position:position + len(request_queries)]
+            position += len(request_queries)
+            error = next((res for res in request_results if isinstance(res, Exception)), None)
+            future.set_result(error or request_results)
+
+    async def resolve(self, future: 'asyncio.Future', task: 'concurrent.futures.Future'):
+        try:
+            future.set_result(await asyncio.wrap_future(task))
+        except Exception as e:
+            future.set_result(e)
+
+    # one connection, requests can be pipelined: each line is answered as soon as its batch is done
+    async def handle(self, reader: 'asyncio.StreamReader', writer: 'asyncio.StreamWriter'):
+        lock = asyncio.Lock()
+
+        async def reply(line):
+            response = await self.answer(line)
+            async with lock:
+                writer.write((json.dumps(response) + "\n").encode())
+                await writer.drain()
+
+        pending = set()
+        while line := await reader.readline():
+            if line.strip():
+                task = asyncio.create_task(reply(line))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+        await asyncio.gather(*pending)
+        writer.close()
+
+    # runs the service on a Unix socket (or localhost TCP if a port is given) until cancelled
+    async def serve(self, socket_path=SOCKET_PATH, port=None, ready=None):
+        self.queue = asyncio.Queue()
+        await asyncio.get_running_loop().run_in_executor(None, self.refresh)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker,
+                                                    initargs=(self.text_dir, self.store.path)) as self.pool:
+            if port is None:
+                server = await asyncio.start_unix_server(self.handle, path=socket_path)
+            else:
+                server = await asyncio.start_server(self.handle, host='127.0.0.1', port=port)
+            batcher = asyncio.create_task(self.batcher())
+            if ready is not None:
+                ready.set()
+            try:
+                async with server:
+                    await server.serve_forever()
+            finally:
+                batcher.cancel()
+                if port is None and os.path.exists(socket_path):
+                    os.remove(socket_path)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='long running query service (one JSON request per line)')
+    parser.add_argument('--socket', default=SOCKET_PATH, help='Unix socket to listen on')
+    parser.add_argument('--port', type=int, help='listen on this localhost TCP port instead of the Unix socket')
+    parser.add_argument('--text', default=retrieval.TEXT_COLLECTION_DIR, help='text collection directory')
+    parser.add_argument('--midi', default=retrieval.MIDI_COLLECTION_DIR, help='MIDI collection directory')
+    parser.add_argument('--store', help='feature store directory')
+    parser.add_argument('-w', '--workers', type=int, help='number of worker processes')
+    parser.add_argument('-p', '--precision', type=float, default=float('inf'))
+    parser.add_argument('-r', '--recall', type=int, default=10)
+    args = parser.parse_args()
+
+    service = RetrievalService(args.text, args.midi, args.store, args.workers, args.precision, args.recall)
+    try:
+        asyncio.run(service.serve(args.socket, args.port))
+    except KeyboardInterrupt:
+        pass
@@ -1,2 +1,733 @@
 import MIDI_properties
+import MIDI_store
+import pretty_midi as pm
 
+
+# the feature store path should give the same scores as ranking straight from the pm objects
+def test_store_matches_midi(tmp_path):
+    files = ['GF_Theme.mid', 'Collection/Piece1.mid', 'Collection/Piece2.mid']
+    store = MIDI_store.FeatureStore(str(tmp_path))
+    assert store.ingest(files) == files
+    assert store.ingest(files) == []
+
+    query = pm.PrettyMIDI('Collection/Piece1.mid')
+    for c in files:
+        assert MIDI_properties.rank_tracks(MIDI_properties.midi_tracks(query), store.tracks(c)) == \
+            MIDI_properties.rank_instruments(query, pm.PrettyMIDI(c))
+
+
+# reference version of sequence_distance (the original python double loop)
+def loop_sequence_distance(qn, cn):
+    min_weight = float('inf')
+    best_match = []
+    for c in range(len(cn) - len(qn) + 1):
+        total_dist = sum(MIDI_properties.semitone_distance(cn[c + q], qn[q])**2 for q in range(len(qn)))
+        if min_weight > total_dist**0.5:
+            min_weight = total_dist**0.5
+            best_match = cn[c:c + len(qn)]
+    return round(min_weight, 3), best_match
+
+
+def random_notes(rng, n):
+    return [MIDI_properties.Note(rng.choice('CDEFGAB'), rng.choice(['', '#', 'b']), 4, 0.5) for i in range(n)]
+
+
+# the vectorized engine should return the same (distance, best_match) as the python loop
+def test_sequence_distance_matches_loop():
+    import random
+    rng = random.Random(0)
+    for qn_len, cn_len in [(0, 3), (1, 1), (3, 20), (5, 4), (8, 200)]:
+        qn, cn = random_notes(rng, qn_len), random_notes(rng, cn_len)
+        assert MIDI_properties.sequence_distance(qn, cn) == loop_sequence_distance(qn, cn)
+
+
+# a transposed copy of a document should share all of its interval n-grams, and so be the first candidate
+def test_interval_index_transposition():
+    import interval_index
+    import numpy as np
+    index = interval_index.IntervalIndex(3)
+    index.add('a', [np.array([0, 4, 7, 0, 2, 4, 5])])
+    index.add('b', [np.array([0, 1, 2, 3, 4, 5, 6])])
+    assert index.candidates([np.array([5, 9, 0, 5, 7])], max_candidates=1) == ['a']
+    index.remove('a')
+    assert index.candidates([np.array([5, 9, 0, 5, 7])], min_overlap=0.1) == []
+    # the loosest setting prunes nothing, even the documents sharing no n-gram are left to score
+    assert index.candidates([np.array([5, 9, 0, 5, 7])]) == ['b']
+
+
+# at the loosest setting the indexed chord ranking should be the exhaustive one, even for a query sharing no n-gram
+def test_chord_index_loosest_scores_everything(tmp_path, monkeypatch):
+    import shutil
+    import interval_index
+    import V1.chord_similarity as cs
+    shutil.copytree('V1/collection', tmp_path / 'collection')
+    monkeypatch.chdir(tmp_path)
+    index = interval_index.build_chord_index(5)
+    for query in ['A C# E | C E G | D F# A | E G# B', 'A C# E | C E G', 'A C# E | C# F A B | C# F A B']:
+        assert cs.ranking_calc([query], 5, index=index) == cs.ranking_calc([query], 5)
+    assert len(cs.ranking_calc(['A C# E | C E G | D F# A | E G# B'], 5, index=index, min_overlap=0.5)) < 5
+
+
+# an index passed to the retrieval functions should be kept in line with the collection and only prune when asked to
+def test_retrieval_with_index(tmp_path):
+    import os
+    import shutil
+    import retrieval
+    import interval_index
+    (tmp_path / 'midi').mkdir()
+    files = write_random_midi(tmp_path / 'midi', 8, seed=7)
+    store = MIDI_store.FeatureStore(str(tmp_path / 'store'))
+    query = pm.PrettyMIDI(files[2])
+    query.instruments[0].notes = query.instruments[0].notes[3:15]
+    index = interval_index.IntervalIndex()
+    for step in range(3):
+        midi_dir = str(tmp_path / 'midi')
+        assert retrieval.rank_midi(query, midi_dir, r=8, store=store, index=index) == \
+            retrieval.rank_midi(query, midi_dir, r=8, store=store)
+        assert list(retrieval.rank_midi(query, midi_dir, r=8, store=store, index=index, max_candidates=1)) == \
+            [files[2].split('.')[0]]
+        assert index.doc_grams == interval_index.build_midi_index(store, retrieval.midi_collection(midi_dir)).doc_grams
+        # an edited and a removed piece are patched into the index on the next call
+        if step == 0:
+            shutil.copy(files[0], files[1])
+        if step == 1:
+            os.remove(files[5])
+
+    shutil.copytree('V1/collection', tmp_path / 'text')
+    text_index = interval_index.IntervalIndex()
+    queries = ['A C# E | C E G | D F# A | E G# B', 'A C# E | C# F A B']
+    assert retrieval.rank_text(queries, str(tmp_path / 'text'), index=text_index) == retrieval.rank_text(queries, str(tmp_path / 'text'))
+    assert text_index.doc_grams == interval_index.build_chord_index(5, collection_dir=str(tmp_path / 'text')).doc_grams
+    pruned = retrieval.rank_text(queries, str(tmp_path / 'text'), index=text_index, max_candidates=2)
+    assert [len(ranking) for ranking in pruned] == [2, 2] and pruned[1][0][:2] == (1, 0.0)
+
+
+# writes n single instrument MIDI files with seeded random melodies to directory, returns the file names
+def write_random_midi(directory, n, seed=0):
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    files = []
+    for i in range(n):
+        midi_file = pm.PrettyMIDI()
+        instrument = pm.Instrument(program=80)
+        for k in range(int(rng.integers(10, 300))):
+            instrument.notes.append(pm.Note(velocity=90, pitch=int(rng.integers(40, 80)), start=k / 4, end=(k + 1) / 4))
+        midi_file.instruments.append(instrument)
+        files.append(str(directory / f'piece{i}.mid'))
+        midi_file.write(files[-1])
+    return files
+
+
+# the parallel top-k ranking (with early abandoning) should match the serial ranking exactly
+def test_parallel_ranking_matches_serial(tmp_path):
+    import parallel_ranking
+    files = write_random_midi(tmp_path, 40)
+    store = MIDI_store.FeatureStore(str(tmp_path / 'store'))
+    query = pm.PrettyMIDI(files[3])
+    query.instruments[0].notes = query.instruments[0].notes[2:12]
+    assert parallel_ranking.return_ranking_parallel(query, files, store, r=5, workers=2, chunk_size=4) == \
+        MIDI_properties.return_ranking(query, files, r=5, store=store)
+
+
+# the compiled chord engine should give the exact weights of scoring chord by chord with calc_chord_similarity
+def test_min_chord_weighted_matches_loop():
+    import random
+    import V1.chord_similarity as cs
+    import V1.note_similarity as ns
+    rng = random.Random(0)
+    names = ns.notes_array + list(ns.equal_notes)
+    chords = [[rng.choice(names) for i in range(rng.randint(2, 5))] for k in range(60)]
+    collection, query = chords[:50], chords[50:54]
+
+    totals = [sum(ns.euclidian_mult_weights(cs.calc_chord_similarity([collection[i + j]], query[j], {}))
+                  for j in range(len(query))) for i in range(len(collection) - len(query) + 1)]
+    best = totals.index(min(totals))
+    assert cs.min_chord_weighted(collection, query) == (round(min(totals), 3), collection[best:best + len(query)])
+
+
+# sync should only parse added/edited files, drop removed ones and keep the other files' tracks readable
+def test_store_sync(tmp_path):
+    import os
+    import shutil
+    files = write_random_midi(tmp_path, 6)
+    store = MIDI_store.FeatureStore(str(tmp_path / 'store'))
+    assert store.sync(files[:4]) == {'added': files[:4], 'changed': [], 'removed': []}
+    before = [t.pitches.tolist() for t in store.tracks(files[0])]
+
+    os.utime(files[1])
+    shutil.copy(files[5], files[2])
+    assert store.sync(files[:2] + files[3:5]) == {'added': [files[4]], 'changed': [], 'removed': [files[2]]}
+    assert store.sync(files[:2] + files[2:5]) == {'added': [files[2]], 'changed': [], 'removed': []}
+
+    reopened = MIDI_store.FeatureStore(str(tmp_path / 'store'))
+    assert [t.pitches.tolist() for t in reopened.tracks(files[0])] == before
+    assert [t.pitches.tolist() for t in reopened.tracks(files[2])] == \
+        [t.pitches.tolist() for t in MIDI_properties.midi_tracks(pm.PrettyMIDI(files[5]))]
+    reopened.compact()
+    assert [t.pitches.tolist() for t in reopened.tracks(files[0])] == before
+    assert len(reopened.segments) == 1
+
+
+
+# pieces far from the query's tempo or instruments (or too short to match it) should be pruned by the prefilter
+def test_prefilter_prunes_dissimilar_pieces(tmp_path):
+    import prefilter
+    files = write_random_midi(tmp_path, 4, seed=3)
+    # the notes of files[1] 8 times faster, files[2] on a piano with a drum track, files[3] cut to 5 notes
+    fast = pm.PrettyMIDI(files[1])
+    for note in fast.instruments[0].notes:
+        note.start, note.end = note.start / 8, note.end / 8
+    fast.write(str(tmp_path / 'fast.mid'))
+    piano = pm.PrettyMIDI(files[2])
+    piano.instruments[0].program = 0
+    drums = pm.Instrument(program=0, is_drum=True)
+    drums.notes = [pm.Note(velocity=90, pitch=36, start=n.start, end=n.end) for n in piano.instruments[0].notes]
+    piano.instruments.append(drums)
+    piano.write(str(tmp_path / 'piano.mid'))
+    short = pm.PrettyMIDI(files[3])
+    short.instruments[0].notes = short.instruments[0].notes[:5]
+    short.write(str(tmp_path / 'short.mid'))
+    collection = files + [str(tmp_path / name) for name in ['fast.mid', 'piano.mid', 'short.mid']]
+    store = MIDI_store.FeatureStore(str(tmp_path / 'store'))
+    store.ingest(collection)
+    query = pm.PrettyMIDI(files[0])
+    query.instruments[0].notes = query.instruments[0].notes[:20]
+
+    scores = prefilter.metadata_scores(prefilter.query_metadata(query, MIDI_properties.midi_tracks(query)), store.metadata())
+    assert scores[:4].tolist() == [0.0] * 4 and scores[6] == float('inf')
+    assert scores[4] > 1 and scores[5] == 1.0
+    assert prefilter.prefilter(query, collection, store, cutoff=0.5) == (files, {'candidates': 7, 'pruned': 3})
+    assert prefilter.prefilter(query, collection, store) == (collection[:6], {'candidates': 7, 'pruned': 1})
+
+    report = {}
+    ranking = MIDI_properties.return_ranking(query, collection, store=store, prefilter_cutoff=0.5, prefilter_report=report)
+    assert report == {'candidates': 7, 'pruned': 3} and set(ranking) <= {f.split('.')[0] for f in files}
+    report = {}
+    assert MIDI_properties.return_ranking(query, collection, store=store, prefilter_cutoff=float('inf'),
+                                          prefilter_report=report) == MIDI_properties.return_ranking(query, collection, store=store)
+    assert report == {'candidates': 7, 'pruned': 0}
+
+    # the metadata is cached until the store changes
+    assert store.metadata() is store.metadata()
+    before = store.metadata()
+    (tmp_path / 'more').mkdir()
+    store.ingest(collection + write_random_midi(tmp_path / 'more', 1, seed=4))
+    assert store.metadata() is not before and len(store.metadata()['rows']) == 8
+
+# a query with one extra note should still be aligned to the passage it was taken from, at a lower cost than the rigid scan
+def test_dtw_tolerates_extra_note():
+    import random
+    import MIDI_alignment
+    rng = random.Random(1)
+    cn = random_notes(rng, 200)
+    qn = cn[50:65]
+    qn.insert(6, MIDI_properties.Note('C', '#', 4, 0.5))
+    dist, match = MIDI_alignment.sequence_distance_dtw(qn, cn)
+    assert match[0] is cn[50] and len(match) in (14, 15, 16)
+    assert dist < MIDI_properties.sequence_distance(qn, cn)[0]
+
+
+
+# the old window by window DTW, every window aligned with the scalar recurrence
+def loop_best_dtw_window(qp, qd, cp, cd, band):
+    import MIDI_alignment
+    m = len(qp)
+    pitches = MIDI_alignment.pitch_costs(qp, cp).tolist()
+    shifts = MIDI_alignment.window_shifts(qd, cd).tolist()
+    best = (float('inf'), -1, 0)
+    for offset in range(len(cp) - max(m - band, 1) + 1):
+        width = min(len(cp) - offset, m + band)
+        costs = [[pitches[i][c] + MIDI_alignment.DURATION_WEIGHT * (qd[i] - cd[c] - shifts[offset])**2 for c in range(len(cp))]
+                 for i in range(m)]
+        prev = [float('inf')] * width
+        for i in range(m):
+            row = [float('inf')] * width
+            for j in range(max(0, i - band), min(width, i + band + 1)):
+                if i == 0:
+                    best_prev = 0 if j == 0 else row[j - 1]
+                else:
+                    best_prev = min(prev[j], prev[j - 1], row[j - 1]) if j > 0 else prev[j]
+                row[j] = costs[i][offset + j] + best_prev
+            prev = row
+        ends = prev[max(0, m - 1 - band):min(width, m + band)]
+        if ends and min(ends) < best[0]:
+            best = (min(ends), offset, max(0, m - 1 - band) + ends.index(min(ends)) + 1)
+    return best
+
+
+# the chunked DTW (over several chunks, with windows dropped over the limit) should give the scalar alignment
+def test_dtw_matches_loop(monkeypatch):
+    import numpy as np
+    import MIDI_alignment
+    monkeypatch.setattr(MIDI_alignment, 'DTW_CHUNK', 64)
+    rng = np.random.default_rng(0)
+    for m, n, band in [(1, 5, 2), (3, 3, 1), (6, 5, 2), (8, 120, 0), (12, 300, 2), (20, 200, 3)]:
+        cp, qp = rng.integers(0, 12, n), rng.integers(0, 12, m)
+        cd = MIDI_alignment.log_durations(rng.choice([0.25, 0.5, 1.0], n))
+        qd = MIDI_alignment.log_durations(rng.choice([0.25, 0.5, 1.0], m))
+        # half of the queries are taken from the collection, repeated so there are ties
+        if m < n // 2 and band:
+            cp[n // 2:n // 2 + m], cd[n // 2:n // 2 + m] = cp[:m], cd[:m] = qp, qd
+        expected = loop_best_dtw_window(qp, qd, cp, cd, band)
+        assert MIDI_alignment.best_dtw_window(qp, qd, cp, cd, band) == expected
+        assert MIDI_alignment.best_dtw_window(qp, qd, cp, cd, band, limit=expected[0]) == expected
+        assert MIDI_alignment.best_dtw_window(qp, qd, cp, cd, band, limit=expected[0] - 0.5) == (float('inf'), -1, 0)
+
+
+# an exact excerpt should score 0 at its own offset, even with a transposed copy at another tempo elsewhere in the track
+def test_dtw_exact_excerpt():
+    import random
+    import MIDI_alignment
+    rng = random.Random(2)
+    melody = random_notes(rng, 16)
+    for n in melody:
+        n.duration = 1.0
+    transposed = [MIDI_properties.Note(n.note, '#' if n.accidental == '' else '', n.octave, 0.25) for n in melody]
+    cn = melody + random_notes(rng, 40) + transposed
+    for band in [0, 2]:
+        dist, match = MIDI_alignment.sequence_distance_dtw(cn[:16], cn, band)
+        assert dist == 0.0 and match[0] is cn[0]
+        # a self excerpt from the middle of the track, whose durations aren't those of the whole track
+        dist, match = MIDI_alignment.sequence_distance_dtw(cn[48:64], cn, band)
+        assert dist == 0.0 and match[0] is cn[48]
+
+
+# the serial store ranking should give the same top r with the running r-th best bound as without it
+def test_bounded_store_ranking(tmp_path):
+    files = write_random_midi(tmp_path, 12, seed=5)
+    store = MIDI_store.FeatureStore(str(tmp_path / 'store'))
+    query = pm.PrettyMIDI(files[3])
+    query.instruments[0].notes = query.instruments[0].notes[5:20]
+    for band in [None, 2]:
+        full = MIDI_properties.rank_collection(query, files, store, band=band)
+        for p, r in [(2000, 3), (30, 5), (2000, 0)]:
+            expected = dict((k, v) for k, v in sorted(full.items(), key=lambda item: item[1])[:r] if v < p)
+            assert MIDI_properties.return_ranking(query, files, p, r, store=store, band=band) == expected
+        bounded = MIDI_properties.rank_collection(query, files, store, band=band, r=3)
+        assert sum(d == float('inf') for d in bounded.values()) > sum(d == float('inf') for d in full.values())
+
+# the optimal instrument pairing should have the highest total similarity of every one to one pairing
+def test_optimal_assignment_matches_brute_force():
+    import itertools
+    import numpy as np
+    rng = np.random.default_rng(0)
+    for n, m in [(0, 3), (1, 1), (3, 5), (5, 3), (4, 4)]:
+        scores = MIDI_properties.program_similarity_matrix()[np.ix_(rng.integers(0, 129, n), rng.integers(0, 129, m))]
+        pairs = MIDI_properties.optimal_assignment(scores)
+        assert len(pairs) == min(n, m) and len(set(c for r, c in pairs)) == len(pairs)
+        best = max(sum(scores[r, c] for r, c in zip(rows, cols)) for rows in itertools.combinations(range(n), min(n, m))
+                   for cols in itertools.permutations(range(m), min(n, m)))
+        assert np.isclose(sum(scores[r, c] for r, c in pairs), best)
+
+
+# after every pushed note, the streaming ranking should match scoring the query so far against every track at once
+def test_streaming_matches_best_window(tmp_path):
+    import numpy as np
+    import streaming
+    files = write_random_midi(tmp_path, 20, seed=1)
+    store = MIDI_store.FeatureStore(str(tmp_path / 'store'))
+    matcher = streaming.StreamingMatcher(store, files, r=5)
+    query = [int(n.pitch) for n in pm.PrettyMIDI(files[7]).instruments[0].notes[5:25]]
+    for k, pitch in enumerate(query):
+        ranking = matcher.push(pitch)
+        expected = {c: min(MIDI_properties.best_window(np.array(query[:k + 1]) % 12, t.pitches % 12)[0]
+                           for t in store.tracks(c)) for c in files}
+        expected = sorted(((round(d, 3), i) for i, d in enumerate(expected.values()) if d != float('inf')))[:5]
+        assert ranking == {files[i].split('.')[0]: d for d, i in expected}
+    assert next(iter(ranking)) == files[7].split('.')[0]
+
+
+# the service should give the same text rankings as retrieval.rank_text, whether requests are batched or not
+def test_service_matches_rank_text(tmp_path):
+    import asyncio
+    import json
+    import retrieval
+    import service
+    queries = ['A C# E | C E G', 'E G# C | F G# C E', 'D F# A']
+
+    async def run():
+        svc = service.RetrievalService('V1/collection', str(tmp_path / 'midi'), str(tmp_path / 'store'), workers=2, r=3)
+        ready = asyncio.Event()
+        server = asyncio.create_task(svc.serve(str(tmp_path / 'service.sock'), ready=ready))
+        await ready.wait()
+        reader, writer = await asyncio.open_unix_connection(str(tmp_path / 'service.sock'))
+        for i, q in enumerate(queries):
+            writer.write((json.dumps({'id': i, 'text': q}) + '\n').encode())
+        await writer.drain()
+        responses = [json.loads(await reader.readline()) for q in queries]
+        writer.close()
+        server.cancel()
+        return sorted(responses, key=lambda response: response['id'])
+
+    expected = retrieval.rank_text(queries, 'V1/collection', r=3)
+    for response, ranking in zip(asyncio.run(run()), expected):
+        assert [(res['document'], res['distance']) for res in response['results']] == [(j, d) for j, d, c in ranking]
+
+
+
+# files that fail to parse should be skipped and reported, and an error scoring a batch should answer its requests
+def test_service_survives_bad_files(tmp_path):
+    import asyncio
+    import json
+    import shutil
+    import service
+    import V1.chord_similarity as cs
+    shutil.copytree('V1/collection', tmp_path / 'text')
+    (tmp_path / 'midi').mkdir()
+    files = write_random_midi(tmp_path / 'midi', 3)
+
+    async def run():
+        svc = service.RetrievalService(str(tmp_path / 'text'), str(tmp_path / 'midi'), str(tmp_path / 'store'), workers=1)
+        ready = asyncio.Event()
+        server = asyncio.create_task(svc.serve(str(tmp_path / 'service.sock'), ready=ready))
+        await ready.wait()
+        reader, writer = await asyncio.open_unix_connection(str(tmp_path / 'service.sock'))
+
+        async def ask(request):
+            writer.write((json.dumps(request) + '\n').encode())
+            await writer.drain()
+            return json.loads(await asyncio.wait_for(reader.readline(), 30))
+
+        # dropped in while the service is running
+        with open(tmp_path / 'midi' / 'bad.mid', 'wb') as bad:
+            bad.write(b'not a MIDI file')
+        with open(tmp_path / 'text' / 'piece6.txt', 'w') as piece:
+            piece.write('A C# E | H2 C E')
+        svc.last_refresh = None
+        midi = await ask({'id': 1, 'midi': files[0]})
+        text = await ask({'id': 2, 'text': 'A C# E'})
+        errors = dict(svc.errors)
+
+        def broken_refresh():
+            raise OSError('collection unreadable')
+        svc.refresh = broken_refresh
+        broken = await ask({'id': 3, 'text': 'A C# E'})
+        del svc.refresh
+        svc.last_refresh = None
+        with open(tmp_path / 'text' / 'piece6.txt', 'w') as piece:
+            piece.write('A C# E | B D F#')
+        fixed = await ask({'id': 4, 'text': 'A C# E'})
+        writer.close()
+        server.cancel()
+        return midi, text, errors, broken, fixed
+
+    midi, text, errors, broken, fixed = asyncio.run(run())
+    assert midi['results'][0] == {'piece': files[0].split('.')[0], 'distance': 0.0}
+    # the malformed piece6 is left out, the other five are still ranked
+    scores = cs.score_query('A C# E', cs.load_collection(5, str(tmp_path / 'text')))
+    assert text['results'] == [{'document': j + 1, 'distance': d, 'chords': ' | '.join(' '.join(c) for c in scores[j][1])}
+                               for j, d in cs.rank_row([d for d, c in scores], float('inf'), 10)]
+    assert len(text['results']) == 5
+    assert sorted(errors) == [str(tmp_path / 'midi' / 'bad.mid'), str(tmp_path / 'text' / 'piece6.txt')]
+    assert broken == {'id': 3, 'error': 'collection unreadable'}
+    assert len(fixed['results']) == 6
+
+# cached rankings should be returned for repeated (or respelled) queries and dropped once the collection changes
+def test_query_cache(tmp_path, monkeypatch):
+    import os
+    import query_cache
+    diff = query_cache.manifest.diff
+    files = write_random_midi(tmp_path, 6, seed=2)
+    cache = query_cache.QueryCache(path=str(tmp_path / 'cache'), check_interval=0.0)
+    query = pm.PrettyMIDI(files[1])
+    query.instruments[0].notes = query.instruments[0].notes[:8]
+    expected = MIDI_properties.return_ranking(query, files, r=3)
+    assert MIDI_properties.return_ranking(query, files, r=3, cache=cache) == expected
+    assert MIDI_properties.return_ranking(query, files, r=3, cache=cache) == expected and cache.hits == 1
+
+    # the disk tier outlives the in memory entries
+    cache = query_cache.QueryCache(path=str(tmp_path / 'cache'), check_interval=0.0)
+    assert MIDI_properties.return_ranking(query, files, r=3, cache=cache) == expected and cache.hits == 1
+
+    # editing a piece invalidates the entry
+    edited = pm.PrettyMIDI(files[1])
+    edited.instruments[0].notes = edited.instruments[0].notes[8:]
+    edited.write(files[1])
+    assert MIDI_properties.return_ranking(query, files, r=3, cache=cache) == \
+        MIDI_properties.return_ranking(query, files, r=3) != expected
+    assert cache.hits == 1
+
+    assert query_cache.text_fingerprint('A# D F | C E G') == query_cache.text_fingerprint('Bb D F | C E G')
+    assert query_cache.text_fingerprint('A# D F') != query_cache.text_fingerprint('B D# F#')
+
+    small = query_cache.QueryCache(max_entries=2)
+    for i in range(3):
+        small.put(i, 'v', [i])
+    assert small.get(0, 'v') is None and small.get(2, 'v') == [2] and small.get(2, 'w') is None
+
+    # the disk tier is bounded too, least recently used first, and a reopened cache knows what's on disk
+    disk = query_cache.QueryCache(max_entries=1, path=str(tmp_path / 'disk'), max_disk_entries=3)
+    for i in range(4):
+        disk.put(i, 'v', [i])
+        if i == 2:
+            assert disk.get(0, 'v') == [0]
+    assert len(os.listdir(tmp_path / 'disk')) == 3 and disk.get(1, 'v') is None and disk.get(0, 'v') == [0]
+    reopened = query_cache.QueryCache(path=str(tmp_path / 'disk'), max_disk_entries=3, max_disk_bytes=2 * disk.disk_size // 3)
+    reopened.put(4, 'v', [4])
+    assert len(os.listdir(tmp_path / 'disk')) == 2 and reopened.get(4, 'v') == [4]
+
+    # within check_interval the collection isn't looked at again
+    calls = []
+    monkeypatch.setattr(query_cache.manifest, 'diff', lambda *args, **kwargs: calls.append(1) or diff(*args, **kwargs))
+    checked = query_cache.QueryCache(check_interval=60)
+    assert checked.version(files) == checked.version(files) == cache.version(files) and len(calls) == 2
+
+
+# the NoteArray of an instrument should read back as the Notes the original name parsing built
+def test_note_array_matches_note_names():
+    for midi_file in [pm.PrettyMIDI('GF_Theme.mid'), pm.PrettyMIDI('Collection/Piece1.mid')]:
+        for instrument in midi_file.instruments:
+            expected = []
+            for note in instrument.notes:
+                name = list(pm.note_number_to_name(note.pitch))
+                expected.append(MIDI_properties.Note(name[0], name[1] if len(name) == 3 else '',
+                                                     int(name[2] if len(name) == 3 else name[1]),
+                                                     round(float(note.end - note.start), 3)))
+            notes = MIDI_properties.notes_details(instrument)
+            assert list(notes) == expected and [notes[i] for i in range(len(notes))] == expected
+            assert list(notes[3:7]) == expected[3:7]
+            assert MIDI_properties.pitch_classes(notes).tolist() == MIDI_properties.pitch_classes(expected).tolist()
+            assert MIDI_properties.sequence_distance(notes[2:6], notes) == \
+                MIDI_properties.sequence_distance(expected[2:6], expected)
+
+
+# profiling should record nothing while disabled, and the stages and counters of a ranking once enabled
+def test_profiling_stages(tmp_path):
+    import profiling
+    files = write_random_midi(tmp_path, 4, seed=3)
+    query = pm.PrettyMIDI(files[0])
+    profiling.reset()
+    MIDI_properties.return_ranking(query, files)
+    assert profiling.report()['stages'] == {}
+
+    profiling.enable()
+    try:
+        MIDI_properties.return_ranking(query, files)
+    finally:
+        profiling.disable()
+    profile = profiling.report()
+    assert profile['stages']['score_piece']['calls'] == len(files)
+    assert profile['counters']['windows scored'] == sum(len(pm.PrettyMIDI(c).instruments[0].notes) -
+                                                        len(query.instruments[0].notes) + 1 for c in files
+                                                        if len(pm.PrettyMIDI(c).instruments[0].notes) >= len(query.instruments[0].notes))
+    assert sorted(call['label'] for call in profile['slowest']['score_piece']) == sorted(files)
+    profiling.reset()
+
+
+# --profile before the query should still profile that query (not generate files), with the report on stderr
+def test_profile_flag_keeps_query(tmp_path, monkeypatch, capsys):
+    import json
+    import os
+    import shutil
+    import sys
+    import main
+    import profiling
+    shutil.copytree('V1/collection', tmp_path / 'collection')
+    monkeypatch.chdir(tmp_path)
+    pieces = {f: open(f'collection/{f}').read() for f in os.listdir('collection')}
+    with open('query.txt', 'w') as query_file:
+        query_file.write('A C# E | C E G')
+    monkeypatch.setattr(sys, 'argv', ['main.py', '--profile', 'query.txt', '--profile-json', 'profile.json'])
+    try:
+        main.main()
+    finally:
+        profiling.disable()
+        profiling.reset()
+    output = capsys.readouterr()
+    assert 'Q1: A C# E | C E G' in output.out and 'total' in output.err
+    assert {f: open(f'collection/{f}').read() for f in os.listdir('collection')} == pieces
+    with open('profile.json') as profile_file:
+        assert json.load(profile_file)['stages']['total']['calls'] == 1
+
+
+# chords played across instruments should be extracted as the chord_prog_diff chords, compiled like the text ones
+def test_midi_chords():
+    import midi_chords
+    import V1.chord_similarity as cs
+    midi_file = pm.PrettyMIDI()
+    piano, bass = pm.Instrument(program=0), pm.Instrument(program=33)
+    for k, chord in enumerate([[60, 64, 67], [57, 60, 64], [55, 59, 62, 65], [55, 59, 62, 65], [72]]):
+        piano.notes.extend(pm.Note(velocity=90, pitch=p, start=k, end=k + 1) for p in chord[1:])
+        # the bass is a bit late, but within the onset resolution
+        bass.notes.append(pm.Note(velocity=90, pitch=chord[0] - 12, start=k + 0.01, end=k + 1))
+    midi_file.instruments.extend([piano, bass])
+
+    chords, compiled = midi_chords.midi_chords(MIDI_properties.midi_tracks(midi_file))
+    assert chords == [['C', 'E', 'G'], ['A', 'C', 'E'], ['G', 'B', 'D', 'F']]
+    roots, shapes = cs.compile_chords(chords)
+    assert roots.tolist() == compiled[0].tolist() and shapes.tolist() == compiled[1].tolist()
+    assert cs.min_chord_weighted(chords, [['A', 'C', 'E']], compiled) == (0.0, [['A', 'C', 'E']])
+
+
+
+# a store-backed MIDI collection should be ranked like its chords extracted straight from the files, and the chords of
+# a file should only be extracted again once it changes
+def test_rank_midi_chords_store(tmp_path, monkeypatch):
+    import numpy as np
+    import midi_chords
+    import V1.chord_similarity as cs
+    rng = np.random.default_rng(6)
+    files = []
+    for i in range(6):
+        midi_file = pm.PrettyMIDI()
+        piano = pm.Instrument(program=0)
+        for k in range(int(rng.integers(8, 30))):
+            root = int(rng.integers(48, 60))
+            shape = [[0, 4, 7], [0, 3, 7], [0, 4, 7, 10]][int(rng.integers(0, 3))]
+            piano.notes.extend(pm.Note(velocity=90, pitch=root + s, start=k / 2, end=(k + 1) / 2) for s in shape)
+        midi_file.instruments.append(piano)
+        files.append(str(tmp_path / f'piece{i}.mid'))
+        midi_file.write(files[-1])
+    store = MIDI_store.FeatureStore(str(tmp_path / 'store'))
+    query = 'A C# E | D F# A | E G# B'
+
+    def expected():
+        extracted = [midi_chords.midi_chords(MIDI_properties.midi_tracks(pm.PrettyMIDI(c))) for c in files]
+        distances = [cs.min_chord_weighted(chords, [['A', 'C#', 'E'], ['D', 'F#', 'A'], ['E', 'G#', 'B']], compiled)[0]
+                     for chords, compiled in extracted]
+        assert midi_chords.chord_collection(store, files)[0] == [chords for chords, compiled in extracted]
+        return {files[j].split('.')[0]: d for j, d in cs.rank_row(distances, float('inf'), 4)}
+
+    assert midi_chords.rank_midi_chords(query, files, store, r=4) == expected()
+    extract = midi_chords.chord_indexes
+    extracted = []
+    # kept in the store index, so a reopened store doesn't extract them again either
+    store = MIDI_store.FeatureStore(str(tmp_path / 'store'))
+    ranking = expected()
+    monkeypatch.setattr(midi_chords, 'chord_indexes', lambda tracks, resolution: extracted.append(len(tracks)) or extract(tracks, resolution))
+    assert midi_chords.rank_midi_chords(query, files, store, r=4) == ranking and extracted == []
+    midi_file = pm.PrettyMIDI(files[0])
+    midi_file.instruments[0].notes = midi_file.instruments[0].notes[:6]
+    midi_file.write(files[0])
+    ranking = midi_chords.rank_midi_chords(query, files, store, r=4)
+    assert extracted == [1] and ranking == expected()
+
+# excerpts of a piece should be found through the LSH shortlist with the exact score of the full ranking
+def test_embedding_index_finds_excerpts(tmp_path):
+    import numpy as np
+    import embedding_index
+    files = write_random_midi(tmp_path, 60, seed=4)
+    store = MIDI_store.FeatureStore(str(tmp_path / 'store'))
+    index = embedding_index.build_embedding_index(store, files)
+    index.save(str(tmp_path / 'index'))
+    loaded = embedding_index.EmbeddingIndex.load(str(tmp_path / 'index'))
+    rng = np.random.default_rng(0)
+    for i in rng.choice(60, 10, replace=False).tolist():
+        query = pm.PrettyMIDI(files[i])
+        notes = query.instruments[0].notes
+        start = int(rng.integers(0, len(notes) - 20))
+        query.instruments[0].notes = notes[start:start + 20]
+        expected = MIDI_properties.return_ranking(query, files, r=1, store=store)
+        assert embedding_index.approximate_ranking(query, store, index, r=1, shortlist=10) == expected
+        assert embedding_index.approximate_ranking(query, store, loaded, r=1, shortlist=10) == expected
+
+
+# the compiled corpus should rank the text collection like reading the pieces, and the heap like a full sort
+def test_chord_corpus_matches_text_files(tmp_path, monkeypatch):
+    import os
+    import random
+    import shutil
+    import retrieval
+    import V1.chord_similarity as cs
+    import V1.chord_corpus as ccorp
+    import V1.note_similarity as ns
+    shutil.copytree('V1/collection', tmp_path / 'collection')
+    monkeypatch.chdir(tmp_path)
+    queries = ['A C# E | C E G', 'E G# C | F G# C E', 'D F# A', 'Bb D F | C E G | A C# E']
+    corpus = ccorp.open_corpus(5)
+    expected_chords = ns.split_notes(open('collection/piece3.txt').read())[:2]
+    assert cs.ranking_calc(queries, 5, corpus=corpus) == cs.ranking_calc(queries, 5)
+    expected = retrieval.rank_text(queries, 'collection', r=3)
+    assert [ccorp.rank_corpus(q, ccorp.open_corpus(5), r=3) for q in queries] == expected
+
+    # an edited piece is compiled into a new generation, a corpus opened before keeps reading its own
+    with open('collection/piece3.txt', 'w') as piece:
+        piece.write('A C# E | C E G | D F# A')
+    assert ccorp.open_corpus(5).min_chord_weighted(2, [['D', 'F#', 'A']], cs.compile_chords([['D', 'F#', 'A']])) == \
+        (0.0, [['D', 'F#', 'A']])
+    with open('collection/piece3.txt', 'a') as piece:
+        piece.write(' | E G# B')
+    recompiled = ccorp.open_corpus(5)
+    assert os.readlink(ccorp.CORPUS_DIR) == ccorp.CORPUS_DIR + '.2' and not os.path.exists(ccorp.CORPUS_DIR + '.0')
+    assert len(recompiled.chord_text(2, 0, 10)) == 4 and corpus.chord_text(2, 0, 2) == expected_chords
+
+    rng = random.Random(0)
+    distances = [rng.choice([0.5, 1.0, 2.0, 3.5, float('inf')]) for i in range(50)]
+    for p, r in [(5, 2), (2.5, 10), (float('inf'), 60), (1, 0)]:
+        assert cs.rank_row(distances, p, r) == \
+            [(j, distances[j]) for j in sorted(range(50), key=lambda j: distances[j])[:r] if distances[j] < p]
+
+
+# a malformed piece should be reported and left out, the rest of the collection is still ranked
+def test_chord_cache_keeps_malformed_pieces(tmp_path):
+    import shutil
+    import retrieval
+    import V1.chord_cache as cc
+    import V1.chord_similarity as cs
+    shutil.copytree('V1/collection', tmp_path / 'collection')
+    with open(tmp_path / 'collection' / 'piece6.txt', 'w') as piece:
+        piece.write('A C# E | H2 C E')
+    cache = cc.ChordCache(str(tmp_path / 'collection'), str(tmp_path / 'cache.json'))
+    assert cache.refresh()['added'][-1].endswith('piece6.txt')
+    assert list(cache.errors.values()) == ["'H2' is not in list"]
+    collection, compiled, documents = cache.collection()
+    assert documents == [1, 2, 3, 4, 5] and cache.compiled[str(tmp_path / 'collection' / 'piece6.txt')] is None
+    scores = cs.score_query('A C# E', cs.load_collection(5, str(tmp_path / 'collection')))
+    expected = [(j + 1, d, scores[j][1]) for j, d in cs.rank_row([d for d, c in scores], float('inf'), 10)]
+    assert retrieval.rank_text(['A C# E'], str(tmp_path / 'collection'), r=10, cache=cache) == [expected]
+    assert len(expected) == 5
+
+    # reloaded from the cache file, and fixed once the piece is edited
+    reloaded = cc.ChordCache(str(tmp_path / 'collection'), str(tmp_path / 'cache.json'))
+    assert list(reloaded.errors.values()) == ["'H2' is not in list"]
+    with open(tmp_path / 'collection' / 'piece6.txt', 'w') as piece:
+        piece.write('A C# E | B D F#')
+    reloaded.refresh()
+    assert reloaded.errors == {} and reloaded.collection()[2] == [1, 2, 3, 4, 5, 6]
+
+
+
+# batch mode should print one line per query with its own results, even for queries with the same best chords
+def test_run_batch_keeps_duplicate_queries_apart(tmp_path, monkeypatch, capsys):
+    import json
+    import shutil
+    import main
+    import V1.chord_similarity as cs
+    shutil.copytree('V1/collection', tmp_path / 'collection')
+    monkeypatch.chdir(tmp_path)
+    queries = ['A C# E | C E G', 'A C# E | C E G', 'A# D F | C E G', 'Bb D F | C E G', 'A C# E | H2']
+    with open('queries.txt', 'w') as query_file:
+        query_file.write('\n'.join(queries) + '\n\n')
+    main.run_batch('queries.txt', float('inf'), 3)
+    lines = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+
+    collection = cs.load_collection(5)
+    assert [line['query'] for line in lines] == [1, 2, 3, 4, 5]
+    for line, query in zip(lines[:4], queries):
+        scores = cs.score_query(query, collection)
+        assert line['text'] == query and [(res['document'], res['distance'], res['chords']) for res in line['results']] == \
+            [(j + 1, d, ' | '.join(' '.join(c) for c in scores[j][1])) for j, d in cs.rank_row([d for d, c in scores], r=3, p=float('inf'))]
+    assert lines[0]['results'] == lines[1]['results'] and lines[2]['results'] == lines[3]['results'] and len(lines[0]['results']) == 3
+    assert lines[4] == {'query': 5, 'text': 'A C# E | H2', 'error': "'H2' is not in list"}
+
+
+# the query file path should print every query's own ranking, even for queries with the same best chords
+def test_query_file_keeps_duplicate_queries_apart(tmp_path, monkeypatch, capsys):
+    import shutil
+    import main
+    import V1.chord_similarity as cs
+    shutil.copytree('V1/collection', tmp_path / 'collection')
+    monkeypatch.chdir(tmp_path)
+    queries = ['A C# E | C E G', 'A C# E | C E G', 'Bb D F | C E G']
+    with open('queries.txt', 'w') as query_file:
+        query_file.write('\n'.join(queries) + '\n')
+    main.run(main.parser.parse_args(['queries.txt', '-r', '3']))
+    output = capsys.readouterr().out
+
+    collection = cs.load_collection(5)
+    expected = ''
+    for q_i, query in enumerate(queries):
+        scores = cs.score_query(query, collection)
+        expected += f"\nQ{q_i + 1}: {query}\n" + ''.join(f"Document {j + 1}: \nChord: '{' | '.join(' '.join(c) for c in scores[j][1])}', distance: {d}\n"
+                                                      for j, d in cs.rank_row([d for d, c in scores], float('inf'), 3))
+    assert output == expected and output.count('Document') == 9